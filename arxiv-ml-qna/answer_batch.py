@@ -0,0 +1,98 @@
+"""Answers a file of questions against a collection, for offline jobs.
+
+Questions are embedded and searched a batch at a time, and the answers are
+generated concurrently. One JSON line per question is written to the output,
+in the order of the input file.
+
+Usage:
+    python answer_batch.py --project-id 1234 --questions questions.txt --output answers.jsonl
+"""
+
+import os
+import json
+import time
+import argparse
+
+import premai
+from dspy import PremAI
+from qdrant_client import QdrantClient
+
+from prem_client import RateLimitedPrem
+from utils import RAG, get_local_retriever, get_retriever
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--project-id", required=True, help="Prem project id")
+    parser.add_argument("--questions", required=True, help="File with one question per line")
+    parser.add_argument("--output", required=True, help="JSON lines file with the answers")
+    parser.add_argument("--collection", default="arxiv-ml-papers-collection")
+    parser.add_argument("--backend", default="qdrant", choices=["qdrant", "local"])
+    parser.add_argument("--qdrant-url", default="http://localhost:6333")
+    parser.add_argument("--local-index-dir", default="local_index")
+    parser.add_argument("--embedding-model", default="mistral-embed")
+    parser.add_argument("--batch-size", type=int, default=64, help="Questions embedded and searched together")
+    parser.add_argument("--max-workers", type=int, default=8, help="Concurrent generation calls")
+    parser.add_argument("--requests-per-minute", type=float, default=None, help="Prem request rate limit")
+    parser.add_argument("--tokens-per-minute", type=float, default=None, help="Prem token rate limit")
+    args = parser.parse_args()
+
+    with open(args.questions) as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    # we assume you have PREMAI_API_KEY in the environment variable.
+    prem_client = RateLimitedPrem(
+        premai.Prem(api_key=os.environ.get("PREMAI_API_KEY")),
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+    )
+    llm = PremAI(project_id=args.project_id, temperature=0.1, max_tokens=1024)
+    llm.client = prem_client
+    if args.backend == "local":
+        retriever = get_local_retriever(
+            index_dir=os.path.join(args.local_index_dir, args.collection),
+            premai_project_id=args.project_id,
+            embedding_model_name=args.embedding_model,
+            prem_client=prem_client,
+            # Every batch of questions is embedded in one request
+            embed_batch_size=args.batch_size,
+        )
+    else:
+        retriever = get_retriever(
+            qdrant_collection_name=args.collection,
+            qdrant_client=QdrantClient(url=args.qdrant_url),
+            premai_project_id=args.project_id,
+            embedding_model_name=args.embedding_model,
+            prem_client=prem_client,
+            # Every batch of questions is embedded in one request
+            embed_batch_size=args.batch_size,
+        )
+    pipeline = RAG(lm=llm, retriever=retriever)
+
+    start = time.perf_counter()
+    results = pipeline.forward_batch(
+        questions,
+        batch_size=args.batch_size,
+        max_workers=args.max_workers,
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    with open(args.output, "w") as f:
+        for question, result in zip(questions, results):
+            if isinstance(result, Exception):
+                failed += 1
+                record = {"question": question, "error": str(result)}
+            else:
+                prediction, titles = result
+                record = {"question": question, "answer": prediction.answer, "titles": titles}
+            f.write(json.dumps(record) + "\n")
+    print(
+        f"Answered {len(questions) - failed} of {len(questions)} questions in {elapsed:.1f}s "
+        f"({len(questions) / max(elapsed, 1e-9):.1f} questions/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
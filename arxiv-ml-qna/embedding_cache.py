@@ -0,0 +1,33 @@
+import numpy as np
+from dsp.modules.sentence_vectorizer import PremAIVectorizer
+
+import tracing
+from embedding_store import EmbeddingCache
+
+
+# ------ Cached Prem vectorizer ------ #
+
+
+class CachedPremAIVectorizer(PremAIVectorizer):
+    """PremAIVectorizer which only sends the texts missing from the cache."""
+
+    def __init__(self, cache: EmbeddingCache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def __call__(self, inp_examples) -> np.ndarray:
+        texts = self._extract_text_from_examples(inp_examples)
+        embed, computed = super().__call__, []
+
+        def compute_fn(missing_texts):
+            computed.extend(missing_texts)
+            return embed(missing_texts)
+
+        vectors = self.cache.get_or_compute(
+            model_name=self.model_name,
+            texts=texts,
+            compute_fn=compute_fn,
+        )
+        for idx in range(len(texts)):
+            tracing.cache("embedding", hit=idx >= len(computed))
+        return vectors
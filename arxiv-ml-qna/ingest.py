@@ -0,0 +1,262 @@
+"""Bulk ingestion of the ML-ArXiv-Papers dataset into a Qdrant collection.
+
+The dataset is streamed lazily from HuggingFace, embedded with a bounded
+number of concurrent requests and uploaded to Qdrant as the batches finish.
+Point ids are derived from the content, and progress is checkpointed, so an
+interrupted run can be started again with the same command and resumes.
+
+With `--backend local` the points are written to a local index directory
+instead, which the app can search without a Qdrant server.
+
+Usage:
+    python ingest.py --project-id 1234 --collection arxiv-ml-papers-collection
+    python ingest.py --project-id 1234 --backend local --build-ivf
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+from itertools import islice
+from typing import Callable, Iterable, List, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from tqdm.auto import tqdm
+from datasets import load_dataset
+from qdrant_client import QdrantClient, models
+from dsp.modules.sentence_vectorizer import PremAIVectorizer
+from local_index import LocalIndexWriter, LocalVectorIndex
+from prem_client import is_transient_error
+
+DATASET_NAME = "CShorten/ML-ArXiv-Papers"
+PAYLOAD_FIELDS = ["title", "abstract"]
+
+
+# ------ Helpers ------ #
+
+
+def content_id(record: dict, fields: List[str]) -> str:
+    """Stable point id, the same paper always maps to the same point."""
+    content = "\x00".join(str(record.get(field, "")) for field in fields)
+    return str(uuid.UUID(hashlib.md5(content.encode("utf-8")).hexdigest()))
+
+
+def iter_batches(records: Iterable[dict], batch_size: int):
+    records = iter(records)
+    while batch := list(islice(records, batch_size)):
+        yield batch
+
+
+def default_checkpoint_path(collection_name: str, backend: str = "qdrant") -> str:
+    return f".ingest-{backend}-{collection_name}.json"
+
+
+def load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"rows_done": 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def ensure_collection(client: QdrantClient, collection_name: str, embedding_size: int):
+    existing = [collection.name for collection in client.get_collections().collections]
+    if collection_name not in existing:
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=models.VectorParams(
+                size=embedding_size, distance=models.Distance.COSINE
+            ),
+        )
+
+
+def make_qdrant_upload_fn(client: QdrantClient, collection_name: str) -> Callable:
+    def upload(ids: List[str], vectors, payloads: List[dict]):
+        points = [
+            models.PointStruct(id=point_id, vector=vector.tolist(), payload=payload)
+            for point_id, vector, payload in zip(ids, vectors, payloads)
+        ]
+        client.upload_points(collection_name=collection_name, points=points, wait=True)
+
+    return upload
+
+
+# ------ Ingestion ------ #
+
+
+def embed_and_upload(
+    batch: List[dict],
+    vectorizer: PremAIVectorizer,
+    upload_fn: Callable,
+    embed_fields: List[str],
+    max_retries: int = 3,
+    base_delay: float = 1.0,
+    max_delay: float = 30.0,
+) -> int:
+    texts = [
+        "\n".join(record[field] or "" for field in embed_fields) for record in batch
+    ]
+    for attempt in range(max_retries + 1):
+        try:
+            embeddings = vectorizer(texts)
+            break
+        except Exception as e:
+            if attempt == max_retries or not is_transient_error(e):
+                raise
+            # Full jitter, so the workers which failed together do not retry together
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2**attempt)))
+
+    upload_fn(
+        ids=[content_id(record, PAYLOAD_FIELDS) for record in batch],
+        vectors=embeddings,
+        payloads=[{field: record[field] for field in PAYLOAD_FIELDS} for record in batch],
+    )
+    return len(batch)
+
+
+def ingest(
+    collection_name: str,
+    vectorizer: PremAIVectorizer,
+    upload_fn: Callable,
+    dataset_name: str = DATASET_NAME,
+    embed_fields: Optional[List[str]] = None,
+    batch_size: int = 32,
+    max_in_flight: int = 4,
+    limit: Optional[int] = None,
+    checkpoint_path: Optional[str] = None,
+    backend: str = "qdrant",
+):
+    """Embeds and uploads the dataset, returns the number of rows done.
+
+    Without `checkpoint_path`, the checkpoint is named after the collection
+    and `backend` (the store `upload_fn` writes to), like the CLI's.
+    """
+    embed_fields = embed_fields or PAYLOAD_FIELDS
+    checkpoint_path = checkpoint_path or default_checkpoint_path(collection_name, backend)
+    checkpoint = load_checkpoint(checkpoint_path)
+    rows_done = checkpoint["rows_done"]
+
+    dataset = load_dataset(dataset_name, split="train", streaming=True)
+    dataset = dataset.select_columns(PAYLOAD_FIELDS)
+    if limit is not None:
+        dataset = dataset.take(limit)
+    # Resume after the last row of which every batch before it was uploaded
+    dataset = dataset.skip(rows_done)
+
+    batch_sizes, completed = {}, set()
+    next_batch_idx = 0
+    progress = tqdm(initial=rows_done, total=limit, unit="papers")
+
+    def on_done(futures):
+        nonlocal rows_done, next_batch_idx
+        for future in futures:
+            completed.add(pending.pop(future))
+            progress.update(future.result())
+
+        # Batches finish out of order, only the contiguous prefix is checkpointed
+        while next_batch_idx in completed:
+            completed.remove(next_batch_idx)
+            rows_done += batch_sizes.pop(next_batch_idx)
+            next_batch_idx += 1
+        save_checkpoint(
+            checkpoint_path,
+            {"dataset": dataset_name, "collection": collection_name, "rows_done": rows_done},
+        )
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for batch_idx, batch in enumerate(iter_batches(dataset, batch_size)):
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                on_done(done)
+
+            batch_sizes[batch_idx] = len(batch)
+            future = executor.submit(
+                embed_and_upload,
+                batch=batch,
+                vectorizer=vectorizer,
+                upload_fn=upload_fn,
+                embed_fields=embed_fields,
+            )
+            pending[future] = batch_idx
+
+        if pending:
+            on_done(wait(pending).done)
+
+    progress.close()
+    return rows_done
+
+
+# ------ CLI ------ #
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--project-id", required=True, help="Prem project id")
+    parser.add_argument("--collection", default="arxiv-ml-papers-collection")
+    parser.add_argument("--backend", default="qdrant", choices=["qdrant", "local"])
+    parser.add_argument("--qdrant-url", default="http://localhost:6333")
+    parser.add_argument("--local-index-dir", default="local_index")
+    parser.add_argument(
+        "--build-ivf",
+        action="store_true",
+        help="Cluster the local index once loaded, for faster searches on large sets",
+    )
+    parser.add_argument("--dataset", default=DATASET_NAME)
+    parser.add_argument("--embedding-model", default="mistral-embed")
+    parser.add_argument(
+        "--embed-fields", nargs="+", default=PAYLOAD_FIELDS, choices=PAYLOAD_FIELDS
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--max-in-flight", type=int, default=4, help="Concurrent embedding batches"
+    )
+    parser.add_argument("--limit", type=int, default=None, help="Only load the first N rows")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file path")
+    args = parser.parse_args()
+
+    # we assume you have PREMAI_API_KEY in the environment variable.
+    vectorizer = PremAIVectorizer(
+        project_id=args.project_id,
+        model_name=args.embedding_model,
+        embed_batch_size=args.batch_size,
+    )
+    if args.backend == "local":
+        writer = LocalIndexWriter(os.path.join(args.local_index_dir, args.collection))
+        upload_fn = writer.add
+    else:
+        client = QdrantClient(url=args.qdrant_url)
+        embedding_size = vectorizer(["embedding size probe"]).shape[1]
+        ensure_collection(client, args.collection, embedding_size=embedding_size)
+        upload_fn = make_qdrant_upload_fn(client, args.collection)
+
+    rows_done = ingest(
+        collection_name=args.collection,
+        vectorizer=vectorizer,
+        upload_fn=upload_fn,
+        dataset_name=args.dataset,
+        embed_fields=args.embed_fields,
+        batch_size=args.batch_size,
+        max_in_flight=args.max_in_flight,
+        limit=args.limit,
+        checkpoint_path=args.checkpoint,
+        backend=args.backend,
+    )
+    print(f"Uploaded {rows_done} papers to {args.collection}")
+
+    if args.backend == "local" and args.build_ivf:
+        LocalVectorIndex(os.path.join(args.local_index_dir, args.collection)).build_ivf()
+        print("Built the IVF lists of the local index")
+
+
+if __name__ == "__main__":
+    main()
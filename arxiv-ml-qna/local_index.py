@@ -0,0 +1,257 @@
+import os
+import json
+import threading
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+
+VECTORS_FILE = "vectors.f32"
+PAYLOADS_FILE = "payloads.jsonl"
+META_FILE = "meta.json"
+IVF_FILE = "ivf.npz"
+
+
+@dataclass
+class SearchHit:
+    id: str
+    score: float
+    payload: dict
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores: np.ndarray, k: int):
+    """Indices and scores of the k largest entries of each row, best first."""
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+# ------ Local vector index ------ #
+
+
+class LocalVectorIndex:
+    """In-process cosine similarity index over a memory-mapped embedding matrix.
+
+    An index is a directory holding the L2-normalized embeddings as a raw
+    float32 matrix, the payloads as JSON lines and a small `meta.json`. Search
+    is a brute force top-k over the matrix, scanned in blocks so that memory
+    stays bounded. For larger collections `build_ivf` clusters the rows, and
+    searches then only scan the `n_probe` closest clusters.
+
+    Args:
+        index_dir (str): Directory of the index.
+        n_probe (int, optional): Clusters scanned per query once an IVF is built. Default: 8.
+    """
+
+    def __init__(self, index_dir: str, n_probe: int = 8):
+        self.index_dir = index_dir
+        self.n_probe = n_probe
+
+        with open(os.path.join(index_dir, META_FILE)) as f:
+            meta = json.load(f)
+        self.dim, self.count = meta["dim"], meta["count"]
+        self.vectors = np.memmap(
+            os.path.join(index_dir, VECTORS_FILE),
+            dtype=np.float32,
+            mode="r",
+            shape=(self.count, self.dim),
+        )
+
+        # Byte offsets of the payload lines, so that payloads are read on demand
+        self._payloads_path = os.path.join(index_dir, PAYLOADS_FILE)
+        offsets, position = [], 0
+        with open(self._payloads_path, "rb") as f:
+            for line in f:
+                offsets.append(position)
+                position += len(line)
+        self._payload_offsets = np.array(offsets[: self.count] + [position], dtype=np.int64)
+
+        self.ivf = None
+        ivf_path = os.path.join(index_dir, IVF_FILE)
+        if os.path.exists(ivf_path):
+            ivf = np.load(ivf_path)
+            self.ivf = {key: ivf[key] for key in ("centroids", "order", "offsets")}
+
+    @staticmethod
+    def list_indexes(root_dir: str) -> List[str]:
+        if not os.path.isdir(root_dir):
+            return []
+        return sorted(
+            name
+            for name in os.listdir(root_dir)
+            if os.path.exists(os.path.join(root_dir, name, META_FILE))
+        )
+
+    def get_payload(self, row: int) -> dict:
+        start, end = self._payload_offsets[row], self._payload_offsets[row + 1]
+        with open(self._payloads_path, "rb") as f:
+            f.seek(start)
+            return json.loads(f.read(end - start))
+
+    def _search_rows(self, queries: np.ndarray, rows: Optional[np.ndarray], k: int, block_size: int):
+        # Sorted rows keep the reads from the memory-mapped file sequential
+        rows = np.arange(self.count) if rows is None else np.sort(rows)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(rows), block_size):
+            block = rows[start : start + block_size]
+            if block[-1] - block[0] + 1 == len(block):
+                matrix = self.vectors[block[0] : block[-1] + 1]
+            else:
+                matrix = self.vectors[block]
+            scores = queries @ matrix.T
+            # Keep a running top-k over the blocks seen so far
+            merged_rows = np.concatenate(
+                [best_rows, np.broadcast_to(block, scores.shape)], axis=1
+            )
+            merged_scores = np.concatenate([best_scores, scores], axis=1)
+            top, best_scores = _top_k(merged_scores, k)
+            best_rows = np.take_along_axis(merged_rows, top, axis=1)
+        return best_rows, best_scores
+
+    def search(self, query_vectors: np.ndarray, k: int = 3, block_size: int = 65536) -> List[List[SearchHit]]:
+        queries = _normalize(np.atleast_2d(query_vectors))
+        if self.count == 0:
+            return [[] for _ in queries]
+
+        if self.ivf is None:
+            rows, scores = self._search_rows(queries, None, k, block_size)
+        else:
+            centroids, order, offsets = self.ivf["centroids"], self.ivf["order"], self.ivf["offsets"]
+            probes, _ = _top_k(queries @ centroids.T, self.n_probe)
+            rows = np.full((len(queries), k), -1, dtype=np.int64)
+            scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+            for idx, query_probes in enumerate(probes):
+                candidates = np.concatenate(
+                    [order[offsets[cluster] : offsets[cluster + 1]] for cluster in query_probes]
+                )
+                if len(candidates) == 0:
+                    continue
+                found_rows, found_scores = self._search_rows(
+                    queries[idx : idx + 1], candidates, k, block_size
+                )
+                rows[idx, : found_rows.shape[1]] = found_rows[0]
+                scores[idx, : found_scores.shape[1]] = found_scores[0]
+
+        results = []
+        for query_rows, query_scores in zip(rows, scores):
+            hits = []
+            for row, score in zip(query_rows, query_scores):
+                if row < 0:
+                    continue
+                payload = self.get_payload(int(row))
+                hits.append(SearchHit(id=payload.pop("id"), score=float(score), payload=payload))
+            results.append(hits)
+        return results
+
+    def build_ivf(self, n_lists: Optional[int] = None, n_iter: int = 10, sample_size: int = 50_000, seed: int = 0):
+        """Clusters the rows with spherical k-means and saves the inverted lists."""
+        n_lists = n_lists or max(1, int(np.sqrt(self.count)))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(self.count, size=min(sample_size, self.count), replace=False))
+        sample = np.asarray(self.vectors[sample_rows])
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=len(sample) < n_lists)]
+
+        for _ in range(n_iter):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(n_lists):
+                members = sample[assignments == cluster]
+                # Empty clusters are restarted on a random sample row
+                centroids[cluster] = members.sum(axis=0) if len(members) else sample[rng.integers(len(sample))]
+            centroids = _normalize(centroids)
+
+        assignments = np.concatenate(
+            [
+                np.argmax(np.asarray(self.vectors[start : start + 65536]) @ centroids.T, axis=1)
+                for start in range(0, self.count, 65536)
+            ]
+        )
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        np.savez(os.path.join(self.index_dir, IVF_FILE), centroids=centroids, order=order, offsets=offsets)
+        self.ivf = {"centroids": centroids, "order": order, "offsets": offsets}
+
+
+# ------ Local index writer ------ #
+
+
+class LocalIndexWriter:
+    """Appends embeddings and payloads to a local index directory.
+
+    Rows are deduplicated by id, and `meta.json` is only updated after the
+    rows were written, so an interrupted run never leaves a half written row
+    visible to the readers.
+    """
+
+    def __init__(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self._lock = threading.Lock()
+        self._meta_path = os.path.join(index_dir, META_FILE)
+        self._vectors_path = os.path.join(index_dir, VECTORS_FILE)
+        self._payloads_path = os.path.join(index_dir, PAYLOADS_FILE)
+
+        self.dim, self.count = None, 0
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            self.dim, self.count = meta["dim"], meta["count"]
+
+        # Drop whatever was written after the last committed row
+        self.ids = set()
+        kept_bytes = 0
+        if os.path.exists(self._payloads_path):
+            with open(self._payloads_path, "rb") as f:
+                for line in f:
+                    if len(self.ids) == self.count:
+                        break
+                    self.ids.add(json.loads(line)["id"])
+                    kept_bytes += len(line)
+        for path, size in [
+            (self._payloads_path, kept_bytes),
+            (self._vectors_path, self.count * (self.dim or 0) * 4),
+        ]:
+            with open(path, "ab") as f:
+                f.truncate(size)
+
+    def add(self, ids: List[str], vectors: np.ndarray, payloads: List[dict]) -> int:
+        vectors = _normalize(vectors)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            # The first row of an id wins, also when a batch repeats it
+            new_rows, batch_ids = [], set()
+            for idx, point_id in enumerate(ids):
+                if point_id not in self.ids and point_id not in batch_ids:
+                    batch_ids.add(point_id)
+                    new_rows.append(idx)
+            if not new_rows:
+                return 0
+
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors[new_rows].tobytes())
+            with open(self._payloads_path, "ab") as f:
+                for idx in new_rows:
+                    line = json.dumps({"id": ids[idx], **payloads[idx]}) + "\n"
+                    f.write(line.encode("utf-8"))
+
+            # The inverted lists do not know the new rows, rebuild them afterwards
+            ivf_path = os.path.join(self.index_dir, IVF_FILE)
+            if os.path.exists(ivf_path):
+                os.remove(ivf_path)
+
+            self.ids.update(ids[idx] for idx in new_rows)
+            self.count += len(new_rows)
+            tmp_path = f"{self._meta_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"dim": self.dim, "count": self.count}, f)
+            os.replace(tmp_path, self._meta_path)
+            return len(new_rows)
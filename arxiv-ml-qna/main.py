@@ -1,47 +1,153 @@
-import dspy
+import os
+import premai
 from dspy import PremAI
+from dsp.modules.sentence_vectorizer import PremAIVectorizer
 from qdrant_client import QdrantClient
 
 import streamlit as st
-from utils import RAG, get_retriever, get_all_collections, chat
+from embedding_cache import EmbeddingCache
+from local_index import LocalVectorIndex
+from tracing import Tracer
+from prem_client import RateLimitedPrem
+from utils import (
+    RAG,
+    PipelineRegistry,
+    get_retriever,
+    get_local_retriever,
+    get_all_collections,
+    chat,
+)
 
 # ---- Configurations ---- #
 premai_api_key = st.secrets.premai_api_key
 premai_project_id = st.secrets.premai_project_id
 embedding_model_name = "mistral-embed"
 qdrant_server_url = "http://localhost:6333"
+# "qdrant" searches the Qdrant server, "local" searches the index files written
+# by `python ingest.py --backend local` in process, without any server
+retriever_backend = "qdrant"
+local_index_dir = "local_index"
+generation_kwargs = {"temperature": 0.1, "max_tokens": 1024}
+embedding_cache_dir = ".embedding_cache"
+# Optional file with one popular question per line, embedded once at startup
+seed_questions_path = "seed_questions.txt"
+# Stage timings of every message are exported as Prometheus metrics on this
+# port (needs `prometheus-client`) and as OpenTelemetry spans (needs `opentelemetry-api`)
+prometheus_port = None
+opentelemetry_enabled = False
+# Limits of the Prem client shared by every session, set them to the limits
+# of your Prem plan. Requests over them wait instead of failing with a 429
+prem_rate_limits = dict(requests_per_minute=300, tokens_per_minute=None)
+
+# The registry is keyed on these settings, change any of them and the
+# pipelines get rebuilt on the next message.
+pipeline_settings = {
+    "retriever_backend": retriever_backend,
+    "embedding_model_name": embedding_model_name,
+    **generation_kwargs,
+}
+
 
 # ---- Define the Prem LLM and QdrantRM ---- #
-qdrant_client = QdrantClient(qdrant_server_url)
+# The client, the registry and the embedding cache live for the whole process,
+# so that they survive the Streamlit reruns triggered by each chat message.
 
 
-def setup_retriever_and_llm(collection_name: str):
-    llm = PremAI(
-        project_id=premai_project_id, **{"temperature": 0.1, "max_tokens": 1024}
-    )
-    abstract_retriever = get_retriever(
-        premai_api_key=premai_api_key,
-        qdrant_collection_name=collection_name,
-        qdrant_client=qdrant_client,
-        premai_project_id=premai_project_id,
-        document_field="abstract",
-        embedding_model_name=embedding_model_name,
-    )
+@st.cache_resource
+def get_qdrant_client(server_url: str) -> QdrantClient:
+    return QdrantClient(server_url)
+
+
+@st.cache_resource
+def get_pipeline_registry() -> PipelineRegistry:
+    return PipelineRegistry()
+
 
-    title_retriever = get_retriever(
-        premai_api_key=premai_api_key,
-        qdrant_collection_name=collection_name,
-        qdrant_client=qdrant_client,
-        premai_project_id=premai_project_id,
-        document_field="title",
-        embedding_model_name=embedding_model_name,
+# Rate limited, retried and coalesced across every session of this process
+@st.cache_resource
+def get_prem_client() -> RateLimitedPrem:
+    return RateLimitedPrem(premai.Prem(api_key=premai_api_key), **prem_rate_limits)
+
+
+@st.cache_resource
+def get_embedding_cache(cache_dir: str) -> EmbeddingCache:
+    cache = EmbeddingCache(cache_dir=cache_dir)
+    if os.path.exists(seed_questions_path):
+        with open(seed_questions_path) as f:
+            questions = [line.strip() for line in f if line.strip()]
+        vectorizer = PremAIVectorizer(
+            project_id=premai_project_id,
+            model_name=embedding_model_name,
+            api_key=premai_api_key,
+        )
+        vectorizer.client = get_prem_client()
+        cache.seed(
+            model_name=embedding_model_name,
+            texts=questions,
+            compute_fn=vectorizer,
+        )
+    return cache
+
+
+@st.cache_resource
+def get_tracer() -> Tracer:
+    return Tracer(
+        app="arxiv-ml-qna",
+        prometheus_port=prometheus_port,
+        opentelemetry=opentelemetry_enabled,
     )
 
-    dspy.settings.configure(lm=llm, rm=abstract_retriever)
-    pipeline = RAG(title_retriever=title_retriever)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def list_collections(server_url: str) -> list:
+    if retriever_backend == "local":
+        return LocalVectorIndex.list_indexes(local_index_dir)
+    return get_all_collections(client=get_qdrant_client(server_url))
+
+
+qdrant_client = get_qdrant_client(qdrant_server_url)
+prem_client = get_prem_client()
+pipeline_registry = get_pipeline_registry()
+embedding_cache = get_embedding_cache(cache_dir=embedding_cache_dir)
+tracer = get_tracer()
+
+
+def setup_retriever_and_llm(collection_name: str):
+    llm = PremAI(project_id=premai_project_id, **generation_kwargs)
+    # The DSPy LM creates its own client, it is replaced by the shared one
+    llm.client = prem_client
+    if retriever_backend == "local":
+        retriever = get_local_retriever(
+            premai_api_key=premai_api_key,
+            index_dir=os.path.join(local_index_dir, collection_name),
+            premai_project_id=premai_project_id,
+            embedding_model_name=embedding_model_name,
+            embedding_cache=embedding_cache,
+            prem_client=prem_client,
+        )
+    else:
+        retriever = get_retriever(
+            premai_api_key=premai_api_key,
+            qdrant_collection_name=collection_name,
+            qdrant_client=qdrant_client,
+            premai_project_id=premai_project_id,
+            embedding_model_name=embedding_model_name,
+            embedding_cache=embedding_cache,
+            prem_client=prem_client,
+        )
+
+    pipeline = RAG(lm=llm, retriever=retriever)
     return pipeline
 
 
+def get_pipeline(collection_name: str):
+    return pipeline_registry.get(
+        collection_name=collection_name,
+        settings=pipeline_settings,
+        build_fn=setup_retriever_and_llm,
+    )
+
+
 # ---- Streamlit Stuffs ---- #
 st.set_page_config(page_title="arxiv paper search", page_icon="🧩")
 st.markdown(
@@ -67,7 +173,18 @@ with st.sidebar:
             """
         )
 
-    all_collections = get_all_collections(client=qdrant_client)
+    all_collections = list_collections(server_url=qdrant_server_url)
+
+    # Warm up once per process: every collection gets its pipeline built
+    # before the first message, later reruns only hit the registry.
+    if all_collections:
+        with st.spinner("Warming up the pipelines ..."):
+            pipeline_registry.warm_up(
+                collection_names=all_collections,
+                settings=pipeline_settings,
+                build_fn=setup_retriever_and_llm,
+            )
+
     selected_collection = st.selectbox(
         label="Select your collection", options=all_collections
     )
@@ -76,10 +193,26 @@ with st.sidebar:
     else:
         st.success(f"You will be chatting with Table: {selected_collection}")
 
+    # Use this after re-ingesting or re-creating a collection
+    if st.button("Reload collections"):
+        list_collections.clear()
+        pipeline_registry.invalidate(collection_name=selected_collection)
+        st.rerun()
+
+    cache_stats = embedding_cache.stats()
+    st.caption(
+        f"Embedding cache hit rate: {cache_stats['hit_rate']:.0%} "
+        f"({cache_stats['memory_hits'] + cache_stats['disk_hits']} hits, "
+        f"{cache_stats['misses']} misses)"
+    )
+
 # ---- Main UI ---- #
 
 if selected_collection is None:
-    st.error("Please set up Qdrant Engine properly. No Collections found.")
+    if retriever_backend == "local":
+        st.error(f"No local index found in {local_index_dir}. Run ingest.py first.")
+    else:
+        st.error("Please set up Qdrant Engine properly. No Collections found.")
 else:
-    pipeline = setup_retriever_and_llm(collection_name=selected_collection)
-    chat(pipeline=pipeline)
+    pipeline = get_pipeline(collection_name=selected_collection)
+    chat(pipeline=pipeline, tracer=tracer)
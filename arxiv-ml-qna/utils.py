@@ -1,30 +1,212 @@
-import time
-from typing import Optional
+import threading
+from typing import Any, Callable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import dsp
 import dspy
-from qdrant_client import QdrantClient
-from dspy.retrieve.qdrant_rm import QdrantRM
-from dsp.modules.sentence_vectorizer import PremAIVectorizer
+from dspy.signatures.signature import signature_to_template
+from qdrant_client import QdrantClient, models
+from dsp.modules.sentence_vectorizer import BaseSentenceVectorizer, PremAIVectorizer
+import tracing
+from embedding_cache import EmbeddingCache, CachedPremAIVectorizer
+from local_index import LocalVectorIndex
+from streaming import render_stream, iter_premai_stream
+from prem_client import open_premai_stream
 
 import streamlit as st
 
 
+# ------ Qdrant Retriever ------ #
+
+
+class TitleAbstractRM(dspy.Retrieve):
+    """A retrieval module that returns the abstracts and the titles of the top papers.
+
+    Titles and abstracts are payload of the same Qdrant points, so the query is
+    embedded once and searched once. Passages, titles and point ids come back
+    in the same order so they stay aligned.
+
+    Args:
+        qdrant_collection_name (str): The name of the Qdrant collection.
+        qdrant_client (QdrantClient): An instance of `qdrant_client.QdrantClient`.
+        vectorizer (BaseSentenceVectorizer): Vectorizer used to embed the query.
+        k (int, optional): The default number of top papers to retrieve. Default: 3.
+        abstract_field (str, optional): The payload key with the abstract. Default: `"abstract"`.
+        title_field (str, optional): The payload key with the title. Default: `"title"`.
+    """
+
+    def __init__(
+        self,
+        qdrant_collection_name: str,
+        qdrant_client: QdrantClient,
+        vectorizer: BaseSentenceVectorizer,
+        k: int = 3,
+        abstract_field: str = "abstract",
+        title_field: str = "title",
+    ):
+        self._collection_name = qdrant_collection_name
+        self._client = qdrant_client
+        self._vectorizer = vectorizer
+        self._abstract_field = abstract_field
+        self._title_field = title_field
+        super().__init__(k=k)
+
+    def _to_prediction(self, results) -> dspy.Prediction:
+        return dspy.Prediction(
+            passages=[result.payload.get(self._abstract_field) for result in results],
+            titles=[result.payload.get(self._title_field) for result in results],
+            ids=[result.id for result in results],
+        )
+
+    def forward(self, query: str, k: Optional[int] = None) -> dspy.Prediction:
+        with tracing.stage("embed"):
+            vector = self._vectorizer([query])[0]
+        with tracing.stage("vector_search"):
+            results = self._client.search(
+                collection_name=self._collection_name,
+                query_vector=vector.tolist(),
+                limit=k or self.k,
+                with_payload=[self._abstract_field, self._title_field],
+            )
+        return self._to_prediction(results)
+
+    def forward_batch(self, queries: List[str], k: Optional[int] = None) -> List[dspy.Prediction]:
+        """Retrieves for many queries with one `search_batch`.
+
+        The queries are embedded in one request when there are at most
+        `embed_batch_size` of them (see `get_retriever`).
+        """
+        if not queries:
+            return []
+        with tracing.stage("embed"):
+            vectors = self._vectorizer(queries)
+        with tracing.stage("vector_search"):
+            batch_results = self._client.search_batch(
+                collection_name=self._collection_name,
+                requests=[
+                    models.SearchRequest(
+                        vector=vector.tolist(),
+                        limit=k or self.k,
+                        with_payload=[self._abstract_field, self._title_field],
+                    )
+                    for vector in vectors
+                ],
+            )
+        return [self._to_prediction(results) for results in batch_results]
+
+
+class LocalTitleAbstractRM(dspy.Retrieve):
+    """Same interface as `TitleAbstractRM`, backed by a `LocalVectorIndex`.
+
+    Args:
+        index (LocalVectorIndex): The loaded local index of the collection.
+        vectorizer (BaseSentenceVectorizer): Vectorizer used to embed the query.
+        k (int, optional): The default number of top papers to retrieve. Default: 3.
+    """
+
+    def __init__(self, index: LocalVectorIndex, vectorizer: BaseSentenceVectorizer, k: int = 3):
+        self._index = index
+        self._vectorizer = vectorizer
+        super().__init__(k=k)
+
+    @staticmethod
+    def _to_prediction(hits) -> dspy.Prediction:
+        return dspy.Prediction(
+            passages=[hit.payload.get("abstract") for hit in hits],
+            titles=[hit.payload.get("title") for hit in hits],
+            ids=[hit.id for hit in hits],
+        )
+
+    def forward(self, query: str, k: Optional[int] = None) -> dspy.Prediction:
+        with tracing.stage("embed"):
+            vector = self._vectorizer([query])[0]
+        with tracing.stage("vector_search"):
+            hits = self._index.search(vector, k=k or self.k)[0]
+        return self._to_prediction(hits)
+
+    def forward_batch(self, queries: List[str], k: Optional[int] = None) -> List[dspy.Prediction]:
+        """Retrieves for many queries with one matrix search.
+
+        The queries are embedded in one request when there are at most
+        `embed_batch_size` of them (see `get_local_retriever`).
+        """
+        if not queries:
+            return []
+        with tracing.stage("embed"):
+            vectors = self._vectorizer(queries)
+        with tracing.stage("vector_search"):
+            batch_hits = self._index.search(vectors, k=k or self.k)
+        return [self._to_prediction(hits) for hits in batch_hits]
+
+
+def get_vectorizer(
+    premai_project_id: str,
+    embedding_model_name: str,
+    premai_api_key: Optional[str] = None,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    prem_client: Optional[Any] = None,
+    embed_batch_size: int = 64,
+):
+    vectorizer_kwargs = dict(
+        project_id=premai_project_id,
+        model_name=embedding_model_name,
+        api_key=premai_api_key,
+        embed_batch_size=embed_batch_size,
+    )
+    if embedding_cache is not None:
+        vectorizer = CachedPremAIVectorizer(cache=embedding_cache, **vectorizer_kwargs)
+    else:
+        vectorizer = PremAIVectorizer(**vectorizer_kwargs)
+    # The vectorizer creates its own client, a shared one replaces it
+    if prem_client is not None:
+        vectorizer.client = prem_client
+    return vectorizer
+
+
 def get_retriever(
     qdrant_collection_name: str,
     qdrant_client: QdrantClient,
     premai_project_id: str,
     embedding_model_name: str,
-    document_field: str,
     premai_api_key: Optional[str] = None,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    prem_client: Optional[Any] = None,
+    embed_batch_size: int = 64,
 ):
-    retriever = QdrantRM(
+    retriever = TitleAbstractRM(
         qdrant_collection_name=qdrant_collection_name,
         qdrant_client=qdrant_client,
-        vectorizer=PremAIVectorizer(
-            project_id=premai_project_id,
-            model_name=embedding_model_name,
-            api_key=premai_api_key,
+        vectorizer=get_vectorizer(
+            premai_project_id=premai_project_id,
+            embedding_model_name=embedding_model_name,
+            premai_api_key=premai_api_key,
+            embedding_cache=embedding_cache,
+            prem_client=prem_client,
+            embed_batch_size=embed_batch_size,
+        ),
+        k=3,
+    )
+    return retriever
+
+
+def get_local_retriever(
+    index_dir: str,
+    premai_project_id: str,
+    embedding_model_name: str,
+    premai_api_key: Optional[str] = None,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    prem_client: Optional[Any] = None,
+    embed_batch_size: int = 64,
+):
+    retriever = LocalTitleAbstractRM(
+        index=LocalVectorIndex(index_dir=index_dir),
+        vectorizer=get_vectorizer(
+            premai_project_id=premai_project_id,
+            embedding_model_name=embedding_model_name,
+            premai_api_key=premai_api_key,
+            embedding_cache=embedding_cache,
+            prem_client=prem_client,
+            embed_batch_size=embed_batch_size,
         ),
-        document_field=document_field,
         k=3,
     )
     return retriever
@@ -45,22 +227,154 @@ class GenerateAnswer(dspy.Signature):
 
 
 class RAG(dspy.Module):
-    def __init__(self, title_retriever):
+    def __init__(self, lm, retriever):
+        self.lm = lm
         self.generate_answer = dspy.Predict(GenerateAnswer)
-        self.retriever = dspy.Retrieve(k=3)
-        self.title_retriever = title_retriever
+        self.retriever = retriever
 
-    def forward(self, question):
-        context = self.retriever(question).passages
-        titles = self.title_retriever(question)
-        prediction = self.generate_answer(context=context, question=question)
+    def _generate(self, question, retrieved):
+        context = retrieved.passages
+        # Use the pipeline's own LM instead of the global dspy settings, so that
+        # cached pipelines for different collections can be used side by side.
+        with dspy.context(lm=self.lm), tracing.stage("llm_generation"):
+            prediction = self.generate_answer(context=context, question=question)
         return [
-            dspy.Prediction(context=context, answer=prediction.answer),
-            [title["long_text"] for title in titles],
+            dspy.Prediction(context=context, answer=prediction.answer, ids=retrieved.ids),
+            retrieved.titles,
         ]
 
+    def forward(self, question):
+        return self._generate(question, self.retriever(question))
 
-# ------ DSPy Signature ------ #
+    def forward_batch(
+        self,
+        questions: List[str],
+        batch_size: int = 64,
+        max_workers: int = 8,
+        return_exceptions: bool = False,
+    ) -> list:
+        """Answers many questions, results are in the order of `questions`.
+
+        Every `batch_size` questions are searched in one batch, and embedded in
+        one request when `batch_size` is at most the `embed_batch_size` of the
+        retriever. Their answers are generated by a pool of `max_workers`
+        threads. With `return_exceptions`, a failed question gets its exception
+        in place of the result, otherwise the first failure cancels the answers
+        not started yet and is raised.
+        """
+
+        def retrieve(batch):
+            try:
+                return self.retriever.forward_batch(batch)
+            except Exception:
+                if not return_exceptions:
+                    raise
+            # One failed batch request fails every question of the batch, so
+            # each one is retrieved on its own to find the failed ones
+            results = []
+            for question in batch:
+                try:
+                    results.append(self.retriever(question))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        def generate(args):
+            question, retrieved = args
+            if isinstance(retrieved, Exception):
+                return retrieved
+            try:
+                return self._generate(question, retrieved)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                # The next batch is retrieved while the answers of the previous ones are generated
+                for start in range(0, len(questions), batch_size):
+                    batch = questions[start : start + batch_size]
+                    retrieved = retrieve(batch)
+                    futures.extend(
+                        executor.submit(tracing.propagate(generate), args)
+                        for args in zip(batch, retrieved)
+                    )
+                return [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def stream(self, question):
+        """Retrieves like `forward` but returns the answer as a stream of tokens.
+
+        DSPy modules have no streaming mode, so the prompt is rendered with the
+        template of `generate_answer` (demos included) and sent to Prem with
+        `stream=True`. Returns the retrieved prediction and the token generator.
+        """
+        retrieved = self.retriever(question)
+        template = signature_to_template(self.generate_answer.signature)
+        example = dsp.Example(
+            demos=self.generate_answer.demos,
+            context=retrieved.passages,
+            question=question,
+        )
+        prompt = template(example)
+        # Prem does not report the usage of streamed completions, about 4 characters per token
+        tracing.count("prompt_tokens", len(prompt) // 4)
+        with tracing.stage("llm_request"):
+            response = self.lm.client.chat.completions.create(
+                project_id=self.lm.project_id,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True,
+                **self.lm.kwargs,
+            )
+            # Sends the request, so an error status raises here
+            response = open_premai_stream(response)
+        return retrieved, tracing.traced_stream(iter_premai_stream(response))
+
+
+# ------ Pipeline registry ------ #
+
+
+class PipelineRegistry:
+    """Process wide cache of the built pipelines.
+
+    Pipelines are keyed by the collection name and the model settings, so a
+    Streamlit rerun only pays for a dictionary lookup instead of rebuilding the
+    LLM, the retrievers and their embedding clients.
+    """
+
+    def __init__(self):
+        self._pipelines = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(collection_name: str, settings: dict):
+        return (collection_name, tuple(sorted(settings.items())))
+
+    def get(self, collection_name: str, settings: dict, build_fn: Callable):
+        key = self._make_key(collection_name, settings)
+        with self._lock:
+            if key not in self._pipelines:
+                self._pipelines[key] = build_fn(collection_name)
+            return self._pipelines[key]
+
+    def warm_up(self, collection_names: list, settings: dict, build_fn: Callable):
+        for collection_name in collection_names:
+            self.get(collection_name, settings, build_fn)
+
+    def invalidate(self, collection_name: Optional[str] = None):
+        """Drop the pipelines of one collection, or all of them when None."""
+        with self._lock:
+            for key in list(self._pipelines):
+                if collection_name is None or key[0] == collection_name:
+                    del self._pipelines[key]
+
+
+# ------ Qdrant utility ------ #
 
 
 def get_all_collections(client: QdrantClient):
@@ -70,7 +384,7 @@ def get_all_collections(client: QdrantClient):
 # ------ Streamlit chat utility ------ #
 
 
-def chat(pipeline):
+def chat(pipeline, tracer: Optional[tracing.Tracer] = None):
     if "messages" not in st.session_state:
         st.session_state.messages = []
 
@@ -86,38 +400,32 @@ def chat(pipeline):
 
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
-            full_response = ""
-
-            while not full_response:
-                with st.spinner("Thinking ...."):
-                    try:
-                        response, titles = pipeline(prompt)
-                        response_str = response.answer
-                        response_contexts = response.context
-                        response_meta = [
-                            {"title": title, "abstract": abstract}
-                            for title, abstract in zip(titles, response_contexts)
-                        ]
-                    except Exception:
-                        response_str = "Failed to respond"
-                        response_meta = []
-
-                fr = ""
-                full_response = str(response_str)
-                for i in full_response:
-                    time.sleep(0.01)
-                    fr += i
-                    message_placeholder.write(fr + "▌")
-                message_placeholder.write(f"{full_response}")
-
-                if response_meta is not None and len(response_meta) > 0:
-                    for meta in response_meta:
-                        title = meta["title"]
-                        abstract = meta["abstract"]
-                        with st.expander(label=title):
-                            st.write(abstract)
-                else:
-                    st.warning("No contexts found")
+            trace = tracer.start_trace("chat") if tracer else tracing.Trace("chat")
+            try:
+                with trace.activate():
+                    with st.spinner("Thinking ...."):
+                        retrieved, tokens = pipeline.stream(prompt)
+                    full_response = render_stream(message_placeholder, tokens)
+                response_meta = [
+                    {"title": title, "abstract": abstract}
+                    for title, abstract in zip(retrieved.titles, retrieved.passages)
+                ]
+            except Exception as e:
+                # Shown instead of retried, a retry would repeat the whole request
+                full_response = "Failed to respond"
+                message_placeholder.error(f"{full_response}: {e}")
+                response_meta = []
+
+            if response_meta is not None and len(response_meta) > 0:
+                for meta in response_meta:
+                    title = meta["title"]
+                    abstract = meta["abstract"]
+                    with st.expander(label=title):
+                        st.write(abstract)
+            else:
+                st.warning("No contexts found")
+            trace.finish()
+            st.caption(trace.summary())
 
             st.session_state.messages.append(
                 {"role": "assistant", "content": full_response}
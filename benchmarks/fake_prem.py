@@ -0,0 +1,280 @@
+import os
+import time
+import random
+import hashlib
+import threading
+from dataclasses import dataclass, asdict
+from types import SimpleNamespace
+from typing import Callable, Iterator, List, Optional
+
+import numpy as np
+
+WORDS = (
+    "model data training retrieval query answer paper context token vector index "
+    "latency summary table column result page document chunk embedding search "
+    "prompt cache batch stream request response network layer attention score"
+).split()
+
+
+def estimate_tokens(text: str) -> int:
+    # About 4 characters per token, like the apps do when Prem reports no usage
+    return max(1, len(text) // 4)
+
+
+def stable_seed(*parts: str) -> int:
+    return int(hashlib.md5("\x00".join(parts).encode("utf-8")).hexdigest()[:8], 16)
+
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """Deterministic unit vector of `text`, the same text always gets the same vector."""
+    vector = np.random.default_rng(stable_seed(text)).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+
+def fake_text(prompt: str, n_words: int) -> str:
+    rng = random.Random(stable_seed(prompt))
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)) + "."
+
+
+# ------ Latency model ------ #
+
+
+@dataclass
+class Latency:
+    """Simulated latencies of the Prem API, in milliseconds.
+
+    A chat completion waits `first_token_ms` plus `prompt_token_ms` per prompt
+    token before its first token, then `token_ms` per completion token. An
+    embedding request waits `embedding_ms` plus `embedding_text_ms` per text,
+    and a document upload `upload_ms` plus `upload_mb_ms` per MB. Every wait is
+    scaled by a random factor within `1 ± jitter`.
+    """
+
+    first_token_ms: float = 300.0
+    prompt_token_ms: float = 0.05
+    token_ms: float = 15.0
+    completion_tokens: int = 64
+    embedding_ms: float = 60.0
+    embedding_text_ms: float = 1.0
+    upload_ms: float = 250.0
+    upload_mb_ms: float = 200.0
+    page_ms: float = 50.0
+    jitter: float = 0.1
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+# ------ Fake Prem client ------ #
+
+
+class FakePrem:
+    """In-process stand-in of `premai.Prem` with simulated latencies.
+
+    Implements the calls the cookbook apps make through the SDK and the
+    LangChain, llama-index and DSPy wrappers: `chat.completions.create` (with
+    and without `stream=True`), `embeddings.create` and
+    `repository.document.create`. Waits are `time.sleep`, so like real network
+    calls they release the GIL and overlap across threads.
+
+    Args:
+        latency (Latency): Simulated latencies. Default: `Latency()`.
+        responder (Callable, optional): Returns the completion of a list of
+            chat messages, or None for the default filler text. Default: None.
+        embedding_dim (int): Dimension of the embeddings. Default: 1024.
+        max_concurrent_requests (int, optional): Requests served at the same
+            time, the others wait like behind a rate limited API. Default: None.
+        seed (int): Seed of the jitter. Default: 0.
+    """
+
+    def __init__(
+        self,
+        latency: Optional[Latency] = None,
+        responder: Optional[Callable[[list], Optional[str]]] = None,
+        embedding_dim: int = 1024,
+        max_concurrent_requests: Optional[int] = None,
+        seed: int = 0,
+    ):
+        self.latency = latency or Latency()
+        self.responder = responder
+        self.embedding_dim = embedding_dim
+        self._slots = (
+            threading.BoundedSemaphore(max_concurrent_requests)
+            if max_concurrent_requests
+            else None
+        )
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {
+            "chat_calls": 0,
+            "stream_calls": 0,
+            "embedding_calls": 0,
+            "embedded_texts": 0,
+            "upload_calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "simulated_s": 0.0,
+        }
+
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self._create_chat_completion)
+        )
+        self.embeddings = SimpleNamespace(create=self._create_embeddings)
+        self.repository = SimpleNamespace(
+            document=SimpleNamespace(create=self._create_document)
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _record(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                self._stats[name] += value
+
+    def _sleep(self, ms: float):
+        with self._lock:
+            factor = self._random.uniform(1 - self.latency.jitter, 1 + self.latency.jitter)
+        seconds = max(0.0, ms * factor / 1000)
+        self._record(simulated_s=seconds)
+        time.sleep(seconds)
+
+    def _serve(self, fn: Callable):
+        if self._slots is None:
+            return fn()
+        with self._slots:
+            return fn()
+
+    # ---- chat completions ---- #
+
+    def _complete(self, messages: list, kwargs: dict) -> str:
+        completion = self.responder(messages) if self.responder else None
+        if completion is None:
+            prompt = str(messages[-1].get("content", "")) if messages else ""
+            completion = fake_text(prompt, self.latency.completion_tokens)
+        return completion
+
+    def _create_chat_completion(self, project_id=None, messages=None, stream: bool = False, **kwargs):
+        messages = list(messages or [])
+        prompt_tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+        prompt_tokens += estimate_tokens(kwargs.get("system_prompt") or "")
+        completion = self._complete(messages, kwargs)
+        tokens = completion.split(" ")
+        deltas = [token if idx == 0 else f" {token}" for idx, token in enumerate(tokens)]
+        self._record(
+            chat_calls=1,
+            stream_calls=int(bool(stream)),
+            prompt_tokens=prompt_tokens,
+            completion_tokens=len(deltas),
+        )
+        first_token_ms = (
+            self.latency.first_token_ms + self.latency.prompt_token_ms * prompt_tokens
+        )
+
+        if stream:
+            return self._stream(deltas, first_token_ms)
+
+        def respond():
+            self._sleep(first_token_ms + self.latency.token_ms * len(deltas))
+            return SimpleNamespace(
+                choices=[
+                    SimpleNamespace(
+                        index=0,
+                        message=SimpleNamespace(role="assistant", content=completion),
+                        finish_reason="stop",
+                    )
+                ],
+                document_chunks=None,
+                usage=SimpleNamespace(
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=len(deltas),
+                    total_tokens=prompt_tokens + len(deltas),
+                ),
+                model="fake-prem",
+                provider_name="fake",
+                provider_id="fake",
+                trace_id=None,
+            )
+
+        return self._serve(respond)
+
+    def _stream(self, deltas: List[str], first_token_ms: float) -> Iterator:
+        def chunk(delta: dict, finish_reason=None):
+            return SimpleNamespace(
+                id="fake",
+                model="fake-prem",
+                choices=[SimpleNamespace(index=0, delta=delta, finish_reason=finish_reason)],
+            )
+
+        def generate():
+            if self._slots is not None:
+                self._slots.acquire()
+            try:
+                self._sleep(first_token_ms)
+                for idx, delta in enumerate(deltas):
+                    if idx:
+                        self._sleep(self.latency.token_ms)
+                    yield chunk({"role": "assistant", "content": delta})
+                yield chunk({"role": "assistant", "content": ""}, finish_reason="stop")
+            finally:
+                if self._slots is not None:
+                    self._slots.release()
+
+        return generate()
+
+    # ---- embeddings ---- #
+
+    def _create_embeddings(self, project_id=None, model=None, input=None, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        self._record(embedding_calls=1, embedded_texts=len(texts))
+
+        def respond():
+            self._sleep(self.latency.embedding_ms + self.latency.embedding_text_ms * len(texts))
+            return SimpleNamespace(
+                data=[
+                    SimpleNamespace(index=idx, embedding=fake_embedding(text, self.embedding_dim))
+                    for idx, text in enumerate(texts)
+                ],
+                model=model,
+                usage=SimpleNamespace(
+                    prompt_tokens=sum(estimate_tokens(text) for text in texts),
+                    total_tokens=sum(estimate_tokens(text) for text in texts),
+                ),
+            )
+
+        return self._serve(respond)
+
+    # ---- repository documents ---- #
+
+    def _create_document(self, repository_id=None, file=None, **kwargs):
+        size_mb = os.path.getsize(file) / 2**20
+        with self._lock:
+            self._stats["upload_calls"] += 1
+            document_id = self._stats["upload_calls"]
+
+        def respond():
+            self._sleep(self.latency.upload_ms + self.latency.upload_mb_ms * size_mb)
+            return SimpleNamespace(
+                repository_id=repository_id,
+                document_id=document_id,
+                name=os.path.basename(file),
+                types="pdf",
+                status="UPLOADED",
+                chunk_count=0,
+                error=None,
+            )
+
+        return self._serve(respond)
+
+
+def install(client: FakePrem):
+    """Makes every `premai.Prem(...)` of the process return `client`.
+
+    Must run before the app modules are imported, some wrappers bind
+    `premai.Prem` at import time.
+    """
+    import premai
+
+    premai.Prem = lambda *args, **kwargs: client
+    os.environ.setdefault("PREMAI_API_KEY", "fake-key")
@@ -0,0 +1,174 @@
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from fake_prem import WORDS
+
+TOPICS = (
+    "graph neural networks", "contrastive learning", "sparse attention",
+    "reinforcement learning from feedback", "diffusion models", "retrieval augmented generation",
+    "quantization", "federated learning", "speculative decoding", "mixture of experts",
+)
+
+
+def sentence(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+# ------ Papers and questions ------ #
+
+
+def make_papers(n: int, seed: int = 0) -> List[dict]:
+    rng = random.Random(seed)
+    papers = []
+    for idx in range(n):
+        topic = TOPICS[idx % len(TOPICS)]
+        papers.append(
+            {
+                "title": f"On {topic} for {rng.choice(WORDS)} {rng.choice(WORDS)} ({idx})",
+                "abstract": " ".join(sentence(rng, 20) for _ in range(6)),
+            }
+        )
+    return papers
+
+
+def make_questions(n: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        f"What do recent papers say about {rng.choice(TOPICS)} and {rng.choice(WORDS)} {rng.choice(WORDS)}?"
+        for _ in range(n)
+    ]
+
+
+# ------ Web pages ------ #
+
+
+def make_page(idx: int, n_tokens: int, seed: int = 0) -> str:
+    """HTML page of about `n_tokens` tokens, in paragraphs of about 80 words."""
+    rng = random.Random(seed * 100_003 + idx)
+    n_paragraphs = max(1, n_tokens // 100)
+    paragraphs = "\n\n".join(
+        f"<p>{' '.join(sentence(rng, 16) for _ in range(5))}</p>" for _ in range(n_paragraphs)
+    )
+    return (
+        f"<html><head><title>Benchmark page {idx}</title></head>"
+        f"<body><h1>{TOPICS[idx % len(TOPICS)].title()}</h1>\n\n{paragraphs}</body></html>"
+    )
+
+
+class FixtureServer:
+    """Serves HTML pages from memory on a local port, each after `latency_ms`.
+
+    Args:
+        pages (dict): Page of each path, e.g. `{"/page-0.html": "<html>..."}`.
+        latency_ms (float): Time to first byte of every response. Default: 0.
+    """
+
+    def __init__(self, pages: Dict[str, str], latency_ms: float = 0.0):
+        encoded = {path: html.encode("utf-8") for path, html in pages.items()}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(latency_ms / 1000)
+                body = encoded.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def url(self, path: str) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}{path}"
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# ------ PDF uploads ------ #
+
+
+def make_pdf(idx: int, size_kb: int) -> bytes:
+    """One page PDF padded with a comment to about `size_kb` KB, unique per `idx`."""
+    content = f"BT /F1 12 Tf 72 720 Td (Benchmark document {idx}) Tj ET".encode("ascii")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+    ]
+    pdf, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n" % (len(objects) + 1, xref)
+    padding = max(0, size_kb * 1024 - len(pdf) - 8)
+    return pdf + b"%" + b"x" * padding + b"\n%%EOF\n"
+
+
+class UploadedFile:
+    """What `st.file_uploader` returns, as far as the upload code uses it."""
+
+    def __init__(self, name: str, data: bytes, file_id: str):
+        self.name = name
+        self.file_id = file_id
+        self._data = data
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self._data)
+
+
+# ------ Postgres table ------ #
+
+
+def seed_orders_table(engine, table: str, n_rows: int, seed: int = 0):
+    """Creates `table` with `n_rows` orders, unless it already has them."""
+    from sqlalchemy import Column, Integer, MetaData, Numeric, String, Table, func, insert, select
+
+    metadata = MetaData()
+    orders = Table(
+        table,
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("customer", String(64)),
+        Column("region", String(32)),
+        Column("product", String(64)),
+        Column("amount", Numeric(10, 2)),
+    )
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        if connection.execute(select(func.count()).select_from(orders)).scalar() == n_rows:
+            return
+        connection.execute(orders.delete())
+        rng = random.Random(seed)
+        regions = ["north", "south", "east", "west"]
+        connection.execute(
+            insert(orders),
+            [
+                {
+                    "id": idx,
+                    "customer": f"customer-{rng.randrange(n_rows // 10 + 1)}",
+                    "region": rng.choice(regions),
+                    "product": rng.choice(WORDS),
+                    "amount": round(rng.uniform(1, 500), 2),
+                }
+                for idx in range(n_rows)
+            ],
+        )
@@ -1,14 +1,80 @@
-import time
 import premai
 import streamlit as st
 import utils
+from streaming import render_stream, iter_premai_stream
+from upload_manifest import UploadManifest
+import tracing
+from conversation import ConversationContext, estimate_tokens
+from local_index import LocalPDFIndex, embed_texts
+from tracing import Tracer
+from prem_client import RateLimitedPrem, open_premai_stream
 
 # Set all the constants here
 # Please make sure to change the Project and repository ID to a correct one
 premai_api_key = st.secrets.premai_api_key
 premai_project_id = 123456789
 premai_repository_id = 123456789
-prem_client = premai.Prem(api_key=premai_api_key)
+# Number of files uploaded to the repository at the same time
+upload_workers = 4
+# Tokens of recent messages sent with every question, older ones are summarized
+history_token_budget = 1500
+# "repository" retrieves from the Prem repository, "local" parses, chunks and
+# embeds the PDFs on this machine and retrieves from a local index
+retrieval_mode = "repository"
+local_settings = dict(
+    embedding_model="mistral-embed",
+    chunk_size=1000,
+    chunk_overlap=200,
+    parse_workers=4,
+    embed_batch_size=32,
+    top_k=5,
+)
+# Stage timings of every message are exported as Prometheus metrics on this
+# port (needs `prometheus-client`) and as OpenTelemetry spans (needs `opentelemetry-api`)
+prometheus_port = None
+opentelemetry_enabled = False
+# Limits of the Prem client shared by every session, set them to the limits
+# of your Prem plan. Requests over them wait instead of failing with a 429
+prem_rate_limits = dict(requests_per_minute=300, tokens_per_minute=None)
+
+
+# Rate limited, retried and coalesced across every session of this process
+@st.cache_resource
+def get_prem_client() -> RateLimitedPrem:
+    return RateLimitedPrem(premai.Prem(api_key=premai_api_key), **prem_rate_limits)
+
+
+prem_client = get_prem_client()
+
+
+# Record of the files already in each repository, shared by every session
+@st.cache_resource
+def get_upload_manifest() -> UploadManifest:
+    return UploadManifest(path=".upload_manifest.sqlite")
+
+
+upload_manifest = get_upload_manifest()
+
+
+@st.cache_resource
+def get_tracer() -> Tracer:
+    return Tracer(
+        app="chat-with-pdf",
+        prometheus_port=prometheus_port,
+        opentelemetry=opentelemetry_enabled,
+    )
+
+
+tracer = get_tracer()
+
+
+# Local index of the parsed PDFs, shared by every session
+@st.cache_resource
+def get_local_index() -> LocalPDFIndex:
+    return LocalPDFIndex(index_dir=".pdf_index", batch_size=local_settings["embed_batch_size"])
+
+
+local_index = get_local_index() if retrieval_mode == "local" else None
 
 # Set the webpage config
 st.set_page_config(page_title="chat with pdf", page_icon="💬")
@@ -36,22 +102,43 @@ with st.sidebar:
         )
     with st.container(border=True):
         st.write(
-            "Upload pdf files. Once uploading is fininshed, please remove "
-            "all the files by crossing out them. Otherwise streamlit loads "
-            "the files everytime with each new chat."
+            "Upload pdf files. Files already uploaded to the repository are "
+            "recognized by their content and skipped, so they can stay in "
+            "the uploader while you chat."
         )
         st.warning("Please note: Max size per article/file is 10 MB")
     uploaded_files = st.file_uploader(
         label="Upload PDF files", accept_multiple_files=True, type=[".pdf"]
     )
 
-    if uploaded_files:
+    if uploaded_files and local_index is not None:
+        utils.index_multiple_files_locally(
+            client=prem_client,
+            project_id=premai_project_id,
+            uploadedfiles=uploaded_files,
+            index=local_index,
+            embedding_model=local_settings["embedding_model"],
+            chunk_size=local_settings["chunk_size"],
+            chunk_overlap=local_settings["chunk_overlap"],
+            max_workers=local_settings["parse_workers"],
+        )
+    elif uploaded_files:
         utils.upload_multiple_files_to_pre_repo(
             client=prem_client,
             prem_repo_id=premai_repository_id,
             uploadedfiles=uploaded_files,
+            max_workers=upload_workers,
+            manifest=upload_manifest,
         )
 
+    # Files rejected by the repository are not sent again, the others are
+    # retried the next time they are in the uploader
+    if local_index is None and (failures := upload_manifest.failures(premai_repository_id)):
+        with st.expander(f"{len(failures)} files failed to upload"):
+            for failure in failures:
+                status = "rejected" if failure["rejected"] else "will be retried"
+                st.write(f"❌ {failure['name']} ({status}): {failure['error']}")
+
 uploaded_files = None
 
 # Chat with the PDF section
@@ -59,6 +146,13 @@ uploaded_files = None
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+conversation = ConversationContext(
+    client=prem_client,
+    project_id=premai_project_id,
+    state=st.session_state,
+    token_budget=history_token_budget,
+)
+
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
@@ -70,38 +164,69 @@ repositories = dict(ids=[premai_repository_id], similarity_threshold=0.25, limit
 
 if prompt := st.chat_input("Please write your query"):
     user_content = {"role": "user", "content": prompt}
+    history = list(st.session_state.messages)
     st.session_state.messages.append(user_content)
     with st.chat_message("user"):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
-        full_response = ""
-
-        while not full_response:
-            with st.spinner("Thinking ...."):
-                try:
+        trace = tracer.start_trace("chat")
+        try:
+            with trace.activate():
+                # Recent messages, a summary of the older ones and the question
+                # rewritten to stand on its own, which is also what is retrieved with
+                request = conversation.build_request(history, prompt)
+                if local_index is not None:
+                    question = request["messages"][-1]["content"]
+                    with tracing.stage("embed"):
+                        [query_vector] = embed_texts(
+                            prem_client,
+                            premai_project_id,
+                            local_settings["embedding_model"],
+                            [question],
+                        )
+                    with tracing.stage("vector_search"):
+                        local_hits = local_index.search(
+                            query_vector, k=local_settings["top_k"]
+                        )
+                    request["messages"][-1] = {
+                        "role": "user",
+                        "content": utils.with_local_context(question, local_hits),
+                    }
+                else:
+                    request["repositories"] = repositories
+                # Prem does not report the usage of streamed completions
+                tracing.count(
+                    "prompt_tokens",
+                    sum(estimate_tokens(message["content"]) for message in request["messages"])
+                    + estimate_tokens(request.get("system_prompt", "")),
+                )
+                # Repository retrieval runs on the server, as part of the request
+                with tracing.stage("llm_request"):
                     response = prem_client.chat.completions.create(
                         project_id=premai_project_id,
-                        messages=[user_content],
-                        repositories=repositories,
-                        stream=False,
+                        stream=True,
+                        **request,
                     )
-                    response_content = response.choices[0].message.content
-                    response_doc_chunks = response.document_chunks
-                except Exception:
-                    response_content = "Failed to respond"
-                    response_doc_chunks = []
-
-            fr = ""
-            full_response = str(response_content)
-
-            for i in full_response:
-                time.sleep(0.01)
-                fr += i
-                message_placeholder.write(fr + "▌")
-            message_placeholder.write(f"{full_response}")
-            utils.see_repos(retrieved_docs=response_doc_chunks)
+                    # Sends the request, so an error status raises here
+                    response = open_premai_stream(response)
+                full_response = render_stream(
+                    message_placeholder, tracing.traced_stream(iter_premai_stream(response))
+                )
+            # Only available once the stream has been consumed
+            if local_index is not None:
+                response_doc_chunks = local_hits
+            else:
+                response_doc_chunks = response.document_chunks or []
+        except Exception as e:
+            # Shown instead of retried, a retry would repeat the whole request
+            full_response = "Failed to respond"
+            message_placeholder.error(f"{full_response}: {e}")
+            response_doc_chunks = []
+
+        trace.finish()
+        utils.see_repos(retrieved_docs=response_doc_chunks, trace=trace)
 
         st.session_state.messages.append(
             {"role": "assistant", "content": full_response}
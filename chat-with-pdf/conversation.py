@@ -0,0 +1,154 @@
+from typing import Any, List, MutableMapping
+
+import tracing
+
+summary_template = """
+Summary of the conversation so far:
+{summary}
+
+New messages:
+{messages}
+
+Update the summary with the new messages. Keep the facts, names and numbers
+the user may refer to later, in at most {max_words} words.
+Updated summary:
+"""
+
+condense_template = """
+Summary of the earlier conversation:
+{summary}
+
+Recent messages:
+{messages}
+
+Follow up question: {question}
+
+Rewrite the follow up question into a standalone question, which can be
+understood without the conversation. Only write the question.
+Standalone question:
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    # About 4 characters per token for English text, good enough for a budget
+    return len(text) // 4 + 1
+
+
+def format_messages(messages: List[dict]) -> str:
+    return "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+
+
+# ------ Conversation context ------ #
+
+
+class ConversationContext:
+    """Builds bounded chat requests from the whole conversation.
+
+    The most recent messages which fit in `token_budget` are sent as they
+    are. Older messages are folded into a running summary, each message only
+    once, and the summary is sent as the system prompt. Follow up questions
+    are rewritten into a standalone question, which is what the repository
+    retrieval searches with. The prompt size stays flat however long the
+    conversation gets.
+
+    The summary lives in `state` (e.g. `st.session_state`), next to the messages.
+
+    Args:
+        client: Prem client.
+        project_id (int): Prem project id.
+        state (MutableMapping): Per conversation state.
+        token_budget (int): Tokens of recent messages sent as they are. Default: 1500.
+        summary_max_words (int): Length of the running summary. Default: 200.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        project_id: int,
+        state: MutableMapping,
+        token_budget: int = 1500,
+        summary_max_words: int = 200,
+    ):
+        self.client = client
+        self.project_id = project_id
+        self.state = state
+        self.token_budget = token_budget
+        self.summary_max_words = summary_max_words
+        self.state.setdefault("conversation_summary", "")
+        self.state.setdefault("summarized_messages", 0)
+
+    def _complete(self, prompt: str, stage: str) -> str:
+        with tracing.stage(stage):
+            response = self.client.chat.completions.create(
+                project_id=self.project_id,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.0,
+            )
+        for name in ["prompt_tokens", "completion_tokens"]:
+            value = getattr(getattr(response, "usage", None), name, None)
+            # completion_tokens is `Unset` when the server does not report it
+            if isinstance(value, int):
+                tracing.count(name, value)
+        # The content is None when the model returned no text
+        return (response.choices[0].message.content or "").strip()
+
+    def window_start(self, history: List[dict]) -> int:
+        """Index of the oldest message of `history` which is sent as it is."""
+        start, used = len(history), 0
+        while start > 0:
+            tokens = estimate_tokens(history[start - 1]["content"])
+            if used + tokens > self.token_budget:
+                break
+            used += tokens
+            start -= 1
+        # The window has to start with a user message
+        while start < len(history) and history[start]["role"] != "user":
+            start += 1
+        return max(start, self.state["summarized_messages"])
+
+    def update_summary(self, history: List[dict], window_start: int):
+        """Folds the messages which left the window into the summary."""
+        summarized = self.state["summarized_messages"]
+        if window_start <= summarized:
+            return
+        self.state["conversation_summary"] = self._complete(
+            summary_template.format(
+                summary=self.state["conversation_summary"] or "(empty)",
+                messages=format_messages(history[summarized:window_start]),
+                max_words=self.summary_max_words,
+            ),
+            stage="history_summary",
+        )
+        self.state["summarized_messages"] = window_start
+
+    def condense_question(self, recent: List[dict], question: str) -> str:
+        if not recent and not self.state["conversation_summary"]:
+            return question
+        return self._complete(
+            condense_template.format(
+                summary=self.state["conversation_summary"] or "(empty)",
+                messages=format_messages(recent),
+                question=question,
+            ),
+            stage="condense_question",
+        ) or question
+
+    def build_request(self, history: List[dict], question: str) -> dict:
+        """Keyword arguments of the chat completion answering `question`.
+
+        `history` holds the earlier messages of the conversation, without `question`.
+        """
+        start = self.window_start(history)
+        self.update_summary(history, start)
+        recent = history[start:]
+        standalone_question = self.condense_question(recent, question)
+
+        # Prem retrieves from the repositories with the last message only, so
+        # it is the standalone question in place of the user's own words
+        request = {"messages": recent + [{"role": "user", "content": standalone_question}]}
+        if self.state["conversation_summary"]:
+            request["system_prompt"] = (
+                "Summary of the earlier conversation with the user:\n"
+                + self.state["conversation_summary"]
+            )
+        return request
@@ -0,0 +1,204 @@
+import io
+import os
+import json
+import threading
+from typing import Any, Callable, List
+
+import numpy as np
+from pypdf import PdfReader
+
+VECTORS_FILE = "vectors.f32"
+CHUNKS_FILE = "chunks.jsonl"
+DOCUMENTS_FILE = "documents.json"
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+# ------ Parsing and chunking ------ #
+
+
+def parse_pdf(data: bytes) -> List[str]:
+    """Text of every page of a PDF, run in a worker process."""
+    reader = PdfReader(io.BytesIO(data))
+    return [page.extract_text() or "" for page in reader.pages]
+
+
+def chunk_pages(pages: List[str], chunk_size: int = 1000, chunk_overlap: int = 200) -> List[dict]:
+    """Splits the pages into chunks of about `chunk_size` characters.
+
+    Chunks never span two pages, so every chunk keeps its page number. Cuts
+    are moved back to the last whitespace, and consecutive chunks of a page
+    share `chunk_overlap` characters.
+    """
+    if chunk_overlap >= chunk_size:
+        raise ValueError("chunk_overlap has to be smaller than chunk_size")
+    chunks = []
+    for page_number, page in enumerate(pages, start=1):
+        text = " ".join(page.split())
+        start = 0
+        while start < len(text):
+            end = min(start + chunk_size, len(text))
+            if end < len(text):
+                space = text.rfind(" ", start + chunk_overlap + 1, end)
+                if space != -1:
+                    end = space
+            chunks.append({"page": page_number, "text": text[start:end].strip()})
+            if end == len(text):
+                break
+            start = max(end - chunk_overlap, start + 1)
+    return [chunk for chunk in chunks if chunk["text"]]
+
+
+def embed_texts(client: Any, project_id: int, model: str, texts: List[str]) -> List[List[float]]:
+    response = client.embeddings.create(project_id=project_id, model=model, input=texts)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+# ------ Local PDF index ------ #
+
+
+class LocalPDFIndex:
+    """Persistent vector index over the chunks of PDFs parsed locally.
+
+    The L2-normalized embeddings are appended to a raw float32 file which is
+    memory mapped for search, so the index does not have to fit in memory
+    and no copy of it is made when it grows. `documents.json` records the
+    committed row count and the rows of every document, keyed by the SHA-256
+    of the file, and the last error of every file which failed to be indexed.
+    A document is searchable as soon as `add_document` returns.
+
+    Args:
+        index_dir (str): Directory of the index. Default: `".pdf_index"`.
+        batch_size (int): Number of chunks embedded per request. Default: 32.
+    """
+
+    def __init__(self, index_dir: str = ".pdf_index", batch_size: int = 32):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._vectors_path = os.path.join(index_dir, VECTORS_FILE)
+        self._chunks_path = os.path.join(index_dir, CHUNKS_FILE)
+        self._documents_path = os.path.join(index_dir, DOCUMENTS_FILE)
+
+        self.dim, self.count, self.documents, self.failures = None, 0, {}, {}
+        if os.path.exists(self._documents_path):
+            with open(self._documents_path) as f:
+                meta = json.load(f)
+            self.dim, self.count, self.documents = meta["dim"], meta["count"], meta["documents"]
+            self.failures = meta.get("failures", {})
+
+        # Rows are only trusted up to the count committed in `documents.json`
+        self.chunks = []
+        kept_bytes = 0
+        if os.path.exists(self._chunks_path):
+            with open(self._chunks_path, "rb") as f:
+                for line in f:
+                    if len(self.chunks) == self.count:
+                        break
+                    self.chunks.append(json.loads(line))
+                    kept_bytes += len(line)
+        for path, size in [
+            (self._chunks_path, kept_bytes),
+            (self._vectors_path, self.count * (self.dim or 0) * 4),
+        ]:
+            with open(path, "ab") as f:
+                f.truncate(size)
+        self._map_vectors()
+
+    def _map_vectors(self):
+        if self.count == 0:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+        else:
+            self.vectors = np.memmap(
+                self._vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dim)
+            )
+
+    def __contains__(self, sha256: str) -> bool:
+        return sha256 in self.documents
+
+    def _save_documents(self):
+        tmp_path = f"{self._documents_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "count": self.count,
+                    "documents": self.documents,
+                    "failures": self.failures,
+                },
+                f,
+            )
+        os.replace(tmp_path, self._documents_path)
+
+    def add_failure(self, sha256: str, name: str, error: str):
+        with self._lock:
+            self.failures[sha256] = {"name": name, "error": error}
+            self._save_documents()
+
+    def add_document(
+        self,
+        sha256: str,
+        name: str,
+        chunks: List[dict],
+        embed_fn: Callable[[List[str]], List[List[float]]],
+    ) -> int:
+        """Embeds the chunks of a document in batches and makes them searchable.
+
+        Returns how many chunks were added, 0 when the document is already indexed.
+        """
+        if sha256 in self:
+            return 0
+        vectors = []
+        for start in range(0, len(chunks), self.batch_size):
+            batch = chunks[start : start + self.batch_size]
+            vectors.append(
+                np.asarray(embed_fn([chunk["text"] for chunk in batch]), dtype=np.float32)
+            )
+
+        with self._lock:
+            if sha256 in self:
+                return 0
+            if vectors:
+                vectors = np.concatenate(vectors)
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                if vectors.shape[1] != self.dim:
+                    raise ValueError(
+                        f"Expected embeddings of size {self.dim}, got {vectors.shape[1]}"
+                    )
+                with open(self._vectors_path, "ab") as f:
+                    f.write(vectors.tobytes())
+                with open(self._chunks_path, "a") as f:
+                    for chunk in chunks:
+                        entry = {"document": name, "sha256": sha256, **chunk}
+                        self.chunks.append(entry)
+                        f.write(json.dumps(entry) + "\n")
+
+            first_row = self.count
+            self.count = len(self.chunks)
+            self.documents[sha256] = {"name": name, "rows": [first_row, self.count]}
+            self.failures.pop(sha256, None)
+            self._save_documents()
+            self._map_vectors()
+            return len(chunks)
+
+    def search(self, query_vector: List[float], k: int = 5) -> List[dict]:
+        """Returns the `k` chunks most similar to the query, best first, with a `score`."""
+        with self._lock:
+            vectors, chunks = self.vectors, self.chunks[: self.count]
+        if len(chunks) == 0:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        scores = vectors @ query
+        top = _top_k(scores, k)
+        return [{**chunks[idx], "score": float(scores[idx])} for idx in top]
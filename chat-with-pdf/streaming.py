@@ -0,0 +1,48 @@
+import time
+from typing import Iterable
+
+from prem_client import open_premai_stream
+
+
+class EmptyStreamError(RuntimeError):
+    """Raised when a streamed answer ends without a single token."""
+
+
+# ------ Streamlit streaming renderer ------ #
+
+
+def render_stream(placeholder, tokens: Iterable[str], refresh_interval: float = 0.05) -> str:
+    """Writes the tokens into `placeholder` as they arrive and returns the full text.
+
+    The placeholder is refreshed at most once every `refresh_interval` seconds,
+    so a long answer does not turn into one websocket message per token.
+    """
+    chunks = []
+    last_render = 0.0
+    placeholder.write("▌")
+    for token in tokens:
+        if not token:
+            continue
+        chunks.append(token)
+        now = time.monotonic()
+        if now - last_render >= refresh_interval:
+            placeholder.write("".join(chunks) + "▌")
+            last_render = now
+
+    full_response = "".join(chunks)
+    if not full_response:
+        # Errors of streamed requests can surface as an empty stream
+        placeholder.empty()
+        raise EmptyStreamError("The model returned an empty answer")
+    placeholder.write(full_response)
+    return full_response
+
+
+def iter_premai_stream(response) -> Iterable[str]:
+    """Yields the content deltas of a `stream=True` Prem chat completion."""
+    for chunk in open_premai_stream(response):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta is not None and delta.get("content"):
+            yield delta["content"]
@@ -0,0 +1,120 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Optional
+
+
+def file_digest(data) -> str:
+    """SHA-256 of the file content, `data` being bytes or a buffer."""
+    return hashlib.sha256(data).hexdigest()
+
+
+# ------ Upload manifest ------ #
+
+
+class UploadManifest:
+    """Persistent record of the files uploaded to each Prem repository.
+
+    Files are identified by the SHA-256 of their content, so the same PDF is
+    never uploaded twice to a repository, whatever its name and however many
+    times Streamlit reruns the upload while it stays in the file uploader.
+    The last error of every file which failed to upload is kept until it is
+    uploaded. A file the repository rejected for its content is marked
+    `rejected`, and is not sent again.
+
+    Args:
+        path (str): Path of the sqlite file. Default: `".upload_manifest.sqlite"`.
+    """
+
+    def __init__(self, path: str = ".upload_manifest.sqlite"):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS uploads (
+                repository_id INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                name TEXT,
+                document_id INTEGER,
+                uploaded_at REAL,
+                PRIMARY KEY (repository_id, sha256)
+            )
+            """
+        )
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS failures (
+                repository_id INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                name TEXT,
+                error TEXT,
+                rejected INTEGER NOT NULL DEFAULT 0,
+                failed_at REAL,
+                PRIMARY KEY (repository_id, sha256)
+            )
+            """
+        )
+        self._db.commit()
+
+    def contains(self, repository_id: int, sha256: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM uploads WHERE repository_id = ? AND sha256 = ?",
+                (repository_id, sha256),
+            ).fetchone()
+        return row is not None
+
+    def is_rejected(self, repository_id: int, sha256: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM failures WHERE repository_id = ? AND sha256 = ? AND rejected",
+                (repository_id, sha256),
+            ).fetchone()
+        return row is not None
+
+    def add(self, repository_id: int, sha256: str, name: str, document_id: Optional[int] = None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO uploads "
+                "(repository_id, sha256, name, document_id, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                (repository_id, sha256, name, document_id, time.time()),
+            )
+            self._db.execute(
+                "DELETE FROM failures WHERE repository_id = ? AND sha256 = ?",
+                (repository_id, sha256),
+            )
+            self._db.commit()
+
+    def add_failure(
+        self, repository_id: int, sha256: str, name: str, error: str, rejected: bool = False
+    ):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO failures "
+                "(repository_id, sha256, name, error, rejected, failed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (repository_id, sha256, name, error, int(rejected), time.time()),
+            )
+            self._db.commit()
+
+    def failures(self, repository_id: int) -> List[dict]:
+        """Files which failed to upload to the repository, most recent first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT sha256, name, error, rejected, failed_at FROM failures "
+                "WHERE repository_id = ? ORDER BY failed_at DESC",
+                (repository_id,),
+            ).fetchall()
+        return [
+            {
+                "sha256": sha256,
+                "name": name,
+                "error": error,
+                "rejected": bool(rejected),
+                "failed_at": failed_at,
+            }
+            for sha256, name, error, rejected, failed_at in rows
+        ]
@@ -1,53 +1,232 @@
 import os
-import time
 import json
+import tempfile
+from typing import Any, Optional, Tuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import premai
 import streamlit as st
-from typing import Any
 
+from upload_manifest import UploadManifest, file_digest
+from local_index import LocalPDFIndex, chunk_pages, embed_texts, parse_pdf
+from tracing import Trace
 
-# Utility function to save the docs into a temporary directory
-def temp_save_uploaded_file(uploadedfile):
-    if not os.path.isdir(".tempdir"):
-        os.makedirs(".tempdir")
 
-    save_path = os.path.join(".tempdir", uploadedfile.name)
-    try:
-        with open(save_path, "wb") as f:
+# Function to upload one file to prem repository, the client retries transient errors
+def upload_file_to_prem_repo(client: Any, uploadedfile: Any, prem_repo_id: int):
+    # The SDK uploads from a path and names the document after the file, so the
+    # file is written under its own name into a temporary directory which is
+    # always removed afterwards
+    with tempfile.TemporaryDirectory(prefix="prem-upload-") as temp_dir:
+        file_path = os.path.join(temp_dir, os.path.basename(uploadedfile.name))
+        with open(file_path, "wb") as f:
             f.write(uploadedfile.getbuffer())
-        return save_path
-    except Exception:
-        st.sidebar.toast("Failed to upload the file. Try again", icon="❌")
-        return None
+        return client.repository.document.create(
+            repository_id=prem_repo_id, file=file_path
+        )
+
+
+# Statuses of a file the repository refuses for its content (malformed, too
+# large, unsupported), sending the same content again would fail again
+REJECTED_STATUS_CODES = {400, 413, 415, 422}
+
+
+def is_rejected_file(error: Exception) -> bool:
+    return (
+        isinstance(error, premai.errors.UnexpectedStatus)
+        and error.status_code in REJECTED_STATUS_CODES
+    )
+
 
+# Function to hash an uploaded file, only once per file in the uploader
+def get_file_digest(uploadedfile: Any) -> str:
+    file_id = getattr(uploadedfile, "file_id", None)
+    digests = st.session_state.setdefault("file_digests", {})
+    if file_id is None or file_id not in digests:
+        digest = file_digest(uploadedfile.getbuffer())
+        if file_id is None:
+            return digest
+        digests[file_id] = digest
+    return digests[file_id]
 
-# Function to upload multiple files to prem repository
+
+# Function to upload multiple files to prem repository, returns the names of the
+# uploaded files and the (name, error) of the failed ones
 def upload_multiple_files_to_pre_repo(
-    client: Any, uploadedfiles: list, prem_repo_id: int
-):
+    client: Any,
+    uploadedfiles: list,
+    prem_repo_id: int,
+    max_workers: int = 4,
+    manifest: Optional[UploadManifest] = None,
+) -> Tuple[list, list]:
+    # Files whose content is already in the repository, was rejected by it, or
+    # is earlier in this batch, are skipped before anything is shown or sent
+    digests = []
+    if manifest is not None:
+        pending, seen = [], set()
+        for uploadedfile in uploadedfiles:
+            digest = get_file_digest(uploadedfile)
+            if (
+                digest in seen
+                or manifest.contains(prem_repo_id, digest)
+                or manifest.is_rejected(prem_repo_id, digest)
+            ):
+                continue
+            seen.add(digest)
+            pending.append(uploadedfile)
+            digests.append(digest)
+        uploadedfiles = pending
+    if not uploadedfiles:
+        return [], []
+
     len_uploaded_files = len(uploadedfiles)
     progress_text = "Uploading files to Prem repository"
     my_bar = st.progress(0, text=progress_text)
+    uploaded, failed = [], []
+
+    # Files are uploaded concurrently, their status is updated as each one finishes
+    with st.status(f"Uploading {len_uploaded_files} files") as status:
+        file_rows = []
+        for uploadedfile in uploadedfiles:
+            file_rows.append(st.empty())
+            file_rows[-1].write(f"⏳ {uploadedfile.name}")
 
-    for i in range(len_uploaded_files):
-        file_path = temp_save_uploaded_file(uploadedfile=uploadedfiles[i])
-        time.sleep(0.1)
-        try:
-            _ = client.repository.document.create(
-                repository_id=prem_repo_id, file=file_path
-            )
-            my_bar.progress(
-                (i + 1) / len_uploaded_files, text=progress_text
-            )  # Update progress bar within the try block
-        except Exception as e:
-            print(e)
-            st.toast(f"Error with file: {uploadedfiles[i].name}", icon="❌")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    upload_file_to_prem_repo,
+                    client=client,
+                    uploadedfile=uploadedfile,
+                    prem_repo_id=prem_repo_id,
+                ): idx
+                for idx, uploadedfile in enumerate(uploadedfiles)
+            }
+            for num_done, future in enumerate(as_completed(futures), start=1):
+                idx = futures[future]
+                name = uploadedfiles[idx].name
+                try:
+                    document = future.result()
+                    if manifest is not None:
+                        manifest.add(
+                            prem_repo_id,
+                            digests[idx],
+                            name=name,
+                            document_id=getattr(document, "document_id", None),
+                        )
+                    file_rows[idx].write(f"✅ {name}")
+                    uploaded.append(name)
+                except Exception as e:
+                    if manifest is not None:
+                        manifest.add_failure(
+                            prem_repo_id,
+                            digests[idx],
+                            name=name,
+                            error=str(e),
+                            rejected=is_rejected_file(e),
+                        )
+                    file_rows[idx].write(f"❌ {name}: {e}")
+                    failed.append((name, str(e)))
+                my_bar.progress(num_done / len_uploaded_files, text=progress_text)
+
+        status.update(
+            label=f"Uploaded {len(uploaded)} of {len_uploaded_files} files",
+            state="error" if failed else "complete",
+            expanded=bool(failed),
+        )
 
     my_bar.empty()
-    st.toast(body=f"Uploaded {len_uploaded_files} files", icon="🚀")
+    st.toast(body=f"Uploaded {len(uploaded)} files", icon="🚀")
+    for name, error in failed:
+        st.toast(f"Error with file {name}: {error}", icon="❌")
+    return uploaded, failed
+
+
+# Function to parse, chunk and embed multiple files into the local index, returns
+# the names of the indexed files and the (name, error) of the failed ones
+def index_multiple_files_locally(
+    client: Any,
+    project_id: int,
+    uploadedfiles: list,
+    index: LocalPDFIndex,
+    embedding_model: str,
+    chunk_size: int = 1000,
+    chunk_overlap: int = 200,
+    max_workers: int = 4,
+) -> Tuple[list, list]:
+    digests = {}
+    for uploadedfile in uploadedfiles:
+        digest = get_file_digest(uploadedfile)
+        if digest not in index and digest not in digests:
+            digests[digest] = uploadedfile
+    if not digests:
+        return [], []
+
+    pending = list(digests.items())
+    embed_fn = partial(embed_texts, client, project_id, embedding_model)
+    indexed, failed = [], []
+
+    # PDFs are parsed in worker processes, and each one is chunked, embedded
+    # and searchable as soon as its pages are ready
+    with st.status(f"Indexing {len(pending)} files") as status:
+        file_rows = []
+        for _, uploadedfile in pending:
+            file_rows.append(st.empty())
+            file_rows[-1].write(f"⏳ {uploadedfile.name}")
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(parse_pdf, uploadedfile.getvalue()): idx
+                for idx, (_, uploadedfile) in enumerate(pending)
+            }
+            for future in as_completed(futures):
+                idx = futures[future]
+                digest, uploadedfile = pending[idx]
+                name = uploadedfile.name
+                try:
+                    pages = future.result()
+                    chunks = chunk_pages(pages, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+                    index.add_document(digest, name=name, chunks=chunks, embed_fn=embed_fn)
+                    file_rows[idx].write(f"✅ {name}: {len(pages)} pages, {len(chunks)} chunks")
+                    indexed.append(name)
+                except Exception as e:
+                    index.add_failure(digest, name=name, error=str(e))
+                    file_rows[idx].write(f"❌ {name}: {e}")
+                    failed.append((name, str(e)))
+
+        status.update(
+            label=f"Indexed {len(indexed)} of {len(pending)} files",
+            state="error" if failed else "complete",
+            expanded=bool(failed),
+        )
+    for name, error in failed:
+        st.toast(f"Error with file {name}: {error}", icon="❌")
+    return indexed, failed
+
+
+local_qna_template = """
+Answer the question using the context from the user's documents below. If
+the context does not contain the answer, say that you don't know.
+
+Context:
+{context}
+
+Question: {question}
+"""
+
+
+# Function to put the chunks retrieved from the local index into the question
+def with_local_context(question: str, hits: list) -> str:
+    context = "\n\n".join(
+        f"[{hit['document']}, page {hit['page']}]\n{hit['text']}" for hit in hits
+    )
+    return local_qna_template.format(context=context, question=question)
 
 
-# Function to watch retrieved chunks
-def see_repos(retrieved_docs):
-    docs = [doc.to_dict() for doc in retrieved_docs]
+# Function to watch retrieved chunks, and where the time of the message went
+def see_repos(retrieved_docs, trace: Optional[Trace] = None):
+    docs = [doc if isinstance(doc, dict) else doc.to_dict() for doc in retrieved_docs]
     with st.expander("See retrieved docs"):
+        if trace is not None:
+            st.caption(trace.summary())
         st.json(json.dumps(docs, indent=4))
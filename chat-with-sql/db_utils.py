@@ -1,31 +1,52 @@
 from typing import Union, Optional
-from sqlalchemy import MetaData, create_engine
 
-from llama_index.core import SQLDatabase
 from llama_index.core.query_engine import NLSQLTableQueryEngine
 from llama_index.core.indices.struct_store import SQLTableRetrieverQueryEngine
-from llama_index.core.objects import (
-    SQLTableNodeMapping,
-    ObjectIndex,
-    SQLTableSchema
-)
-from llama_index.core import VectorStoreIndex
+from engine_registry import EngineRegistry, get_engine
+from schema_cache import SchemaCache, default_cache_dir
+from sql_execution import BoundedSQLDatabase
+from sql_cache import TextToSQLCache, with_sql_cache
+
+
+def resolve_schema_cache(
+    db_config: dict,
+    engine_registry: Optional[EngineRegistry] = None,
+    schema_cache: Optional[SchemaCache] = None,
+) -> SchemaCache:
+    # Without a long lived cache the schema is still loaded from disk, lazily
+    if schema_cache is not None:
+        return schema_cache
+    engine = get_engine(db_config, registry=engine_registry)
+    return SchemaCache(engine, cache_dir=default_cache_dir(db_config))
+
+
+def get_sql_database(
+    schema_cache: SchemaCache,
+    include_tables: Optional[list] = None,
+    execution_limits: Optional[dict] = None,
+    sql_cache: Optional[TextToSQLCache] = None,
+) -> BoundedSQLDatabase:
+    # Generated SQL runs with a row limit, a statement timeout and a server-side
+    # cursor, and its results are reused from `sql_cache` while the data is unchanged
+    schema_cache.refresh()
+    return BoundedSQLDatabase(
+        schema_cache.engine,
+        schema_cache=schema_cache,
+        include_tables=include_tables,
+        result_cache=sql_cache,
+        **(execution_limits or {}),
+    )
 
-# ---- Function to fetch all the tables from pg database ----
-def get_all_tables_from_db(db_config: dict) -> Union[list, None]:
-    metadata = MetaData()
-    username = db_config["username"]
-    host = db_config["host"]
-    password = db_config["password"]
-    port = db_config["port"]
-    database = db_config["database"]
 
+# ---- Function to fetch all the tables from pg database ----
+def get_all_tables_from_db(
+    db_config: dict,
+    engine_registry: Optional[EngineRegistry] = None,
+    schema_cache: Optional[SchemaCache] = None,
+) -> Union[list, None]:
     try:
-        engine = create_engine(
-            f"postgresql://{username}:{password}@{host}:{port}/{database}"
-        )
-        metadata.reflect(bind=engine)
-        table_names = metadata.tables.keys()
+        schema_cache = resolve_schema_cache(db_config, engine_registry, schema_cache)
+        table_names = schema_cache.table_names()
     except Exception as e:
         print(f"Error: {e}")
         return None
@@ -34,60 +55,90 @@ def get_all_tables_from_db(db_config: dict) -> Union[list, None]:
 
 # ---- Function using llama-index to call Text2SQL for semantic QnA ----
 
-def setup_index_before_chat(db_config: dict, table: str, ):
-    username = db_config["username"]
-    host = db_config["host"]
-    password = db_config["password"]
-    port = db_config["port"]
-    database = db_config["database"]
-    engine = create_engine(
-        f"postgresql://{username}:{password}@{host}:{port}/{database}"
+def setup_index_before_chat(
+    db_config: dict,
+    table: str,
+    streaming: bool = False,
+    engine_registry: Optional[EngineRegistry] = None,
+    schema_cache: Optional[SchemaCache] = None,
+    execution_limits: Optional[dict] = None,
+    sql_cache: Optional[TextToSQLCache] = None,
+):
+    schema_cache = resolve_schema_cache(db_config, engine_registry, schema_cache)
+    sql_database = get_sql_database(
+        schema_cache,
+        include_tables=[table],
+        execution_limits=execution_limits,
+        sql_cache=sql_cache,
     )
-
-    sql_database = SQLDatabase(engine=engine, include_tables=[table])
     query_engine = NLSQLTableQueryEngine(
         sql_database=sql_database,
+        streaming=streaming,
     )
+    if sql_cache is not None:
+        query_engine = with_sql_cache(query_engine, sql_cache, schema_cache)
     return query_engine
 
 
 # ---- Function using llama-index to index the SQL entries with embeddings ----
 
-def setup_index_before_chat_use_embedding(db_config: dict):
-    username = db_config["username"]
-    host = db_config["host"]
-    password = db_config["password"]
-    port = db_config["port"]
-    database = db_config["database"]
-    engine = create_engine(
-        f"postgresql://{username}:{password}@{host}:{port}/{database}"
-    )
-
-    sql_database = SQLDatabase(engine=engine)
-    table_node_mapping = SQLTableNodeMapping(sql_database)
-    table_schema_objs = []
-
-    all_table_names = get_all_tables_from_db(db_config)
-    for table_name in all_table_names:
-        table_schema_objs.append(SQLTableSchema(table_name=table_name))
-    
-    object_index = ObjectIndex.from_objects(
-        table_schema_objs,
-        table_node_mapping,
-        VectorStoreIndex,
+def setup_index_before_chat_use_embedding(
+    db_config: dict,
+    streaming: bool = False,
+    engine_registry: Optional[EngineRegistry] = None,
+    schema_cache: Optional[SchemaCache] = None,
+    execution_limits: Optional[dict] = None,
+    sql_cache: Optional[TextToSQLCache] = None,
+):
+    # The reflected schema and the table embeddings are persisted by the
+    # schema cache, only the tables which changed are embedded again
+    schema_cache = resolve_schema_cache(db_config, engine_registry, schema_cache)
+    sql_database = get_sql_database(
+        schema_cache, execution_limits=execution_limits, sql_cache=sql_cache
     )
+    object_index = schema_cache.get_object_index(sql_database)
     query_engine = SQLTableRetrieverQueryEngine(
         sql_database,
         object_index.as_retriever(similarity_top_k=1),
+        streaming=streaming,
     )
+    if sql_cache is not None:
+        query_engine = with_sql_cache(query_engine, sql_cache, schema_cache)
     return query_engine
 
 
-def setup_index(db_config, table: Optional[str]=None, use_all: bool=False):
+def setup_index(
+    db_config,
+    table: Optional[str]=None,
+    use_all: bool=False,
+    streaming: bool=False,
+    engine_registry: Optional[EngineRegistry]=None,
+    schema_cache: Optional[SchemaCache]=None,
+    execution_limits: Optional[dict]=None,
+    sql_cache: Optional[TextToSQLCache]=None,
+):
+    # With streaming=True the engines return a StreamingResponse whose
+    # `response_gen` yields the synthesized answer token by token.
+    # All the engines of one db_config share the pooled engine of the registry
     if use_all:
         # we assume that we are calling for all the tables 
-        query_engine = setup_index_before_chat_use_embedding(db_config=db_config) 
+        query_engine = setup_index_before_chat_use_embedding(
+            db_config=db_config,
+            streaming=streaming,
+            engine_registry=engine_registry,
+            schema_cache=schema_cache,
+            execution_limits=execution_limits,
+            sql_cache=sql_cache,
+        )
     else:
         assert table is not None, ValueError("Table must not be None")
-        query_engine = setup_index_before_chat(db_config=db_config, table=table)
-    return query_engine
\ No newline at end of file
+        query_engine = setup_index_before_chat(
+            db_config=db_config,
+            table=table,
+            streaming=streaming,
+            engine_registry=engine_registry,
+            schema_cache=schema_cache,
+            execution_limits=execution_limits,
+            sql_cache=sql_cache,
+        )
+    return query_engine
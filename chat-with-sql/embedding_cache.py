@@ -0,0 +1,56 @@
+from typing import Any, List, Optional
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.premai import PremAIEmbeddings
+
+import tracing
+from embedding_store import EmbeddingCache
+
+
+# ------ Cached Prem embeddings ------ #
+
+
+class CachedPremAIEmbeddings(PremAIEmbeddings):
+    """PremAIEmbeddings which only sends the texts missing from the cache."""
+
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(
+        self, cache: EmbeddingCache, prem_client: Optional[Any] = None, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self._cache = cache
+        # e.g. the rate limited client shared by every session
+        if prem_client is not None:
+            self._premai_client = prem_client
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        embeddings = self._premai_client.embeddings.create(
+            project_id=self.project_id, model=self.model_name, input=texts
+        ).data
+        return [embedding.embedding for embedding in embeddings]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._get_text_embeddings([query])[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        computed = []
+
+        def compute_fn(missing_texts: List[str]) -> List[List[float]]:
+            computed.extend(missing_texts)
+            return self._embed(missing_texts)
+
+        with tracing.stage("embed"):
+            vectors = self._cache.get_or_compute(
+                model_name=self.model_name, texts=texts, compute_fn=compute_fn
+            )
+        for idx in range(len(texts)):
+            tracing.cache("embedding", hit=idx >= len(computed))
+        return vectors.tolist()
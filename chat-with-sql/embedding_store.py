@@ -0,0 +1,267 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+# ------ Embedding cache ------ #
+
+
+class EmbeddingCache:
+    """Two level cache of embeddings keyed by (model name, normalized text).
+
+    The first level is an in-memory LRU. The second level lives in `cache_dir`:
+    one float32 matrix per model in a memory-mapped file, and an sqlite index
+    which maps every key to its row in that matrix. Once a model reaches
+    `max_disk_items` rows, the least recently used row is overwritten in place.
+
+    Args:
+        cache_dir (str): Directory of the on-disk store. Default: `".embedding_cache"`.
+        max_memory_items (int): Size of the in-memory LRU. Default: 4096.
+        max_disk_items (int): Maximum number of rows kept on disk per model. Default: 100000.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = ".embedding_cache",
+        max_memory_items: int = 4096,
+        max_disk_items: int = 100_000,
+    ):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._matrices = {}
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), check_same_thread=False
+        )
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS models (
+                model TEXT PRIMARY KEY, dim INTEGER NOT NULL, n_rows INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (model, last_used);
+            """
+        )
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        return hashlib.sha1(
+            f"{model_name}\x00{normalize_text(text)}".encode("utf-8")
+        ).hexdigest()
+
+    def _matrix_path(self, model_name: str) -> str:
+        return os.path.join(
+            self.cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name) + ".f32"
+        )
+
+    def _get_matrix(self, model_name: str) -> Optional[np.memmap]:
+        row = self._db.execute(
+            "SELECT dim, n_rows FROM models WHERE model = ?", (model_name,)
+        ).fetchone()
+        if row is None or row[1] == 0:
+            return None
+        dim, n_rows = row
+        matrix = self._matrices.get(model_name)
+        # The file only grows, so the memmap is reopened when new rows were appended
+        if matrix is None or matrix.shape[0] != n_rows:
+            matrix = np.memmap(
+                self._matrix_path(model_name),
+                dtype=np.float32,
+                mode="r+",
+                shape=(n_rows, dim),
+            )
+            self._matrices[model_name] = matrix
+        return matrix
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Looks up the embeddings of `texts`, None is returned for every miss."""
+        keys = [self.make_key(model_name, text) for text in texts]
+        results = [None] * len(texts)
+
+        with self._lock:
+            disk_lookups = {}
+            for idx, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    results[idx] = self._memory[key]
+                    self.memory_hits += 1
+                else:
+                    disk_lookups.setdefault(key, []).append(idx)
+
+            if disk_lookups:
+                placeholders = ",".join("?" * len(disk_lookups))
+                rows = self._db.execute(
+                    f"SELECT key, row FROM embeddings WHERE key IN ({placeholders})",
+                    list(disk_lookups),
+                ).fetchall()
+                matrix = self._get_matrix(model_name) if rows else None
+                for key, row in rows:
+                    vector = np.array(matrix[row])
+                    self._remember(key, vector)
+                    for idx in disk_lookups.pop(key):
+                        results[idx] = vector
+                        self.disk_hits += 1
+                if rows:
+                    now = time.time()
+                    self._db.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(now, key) for key, _ in rows],
+                    )
+                    self._db.commit()
+
+                for indices in disk_lookups.values():
+                    self.misses += len(indices)
+        return results
+
+    def put_many(self, model_name: str, texts: List[str], vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            model_row = self._db.execute(
+                "SELECT dim, n_rows FROM models WHERE model = ?", (model_name,)
+            ).fetchone()
+            if model_row is None:
+                dim, n_rows = vectors.shape[1], 0
+                self._db.execute(
+                    "INSERT INTO models (model, dim, n_rows) VALUES (?, ?, 0)",
+                    (model_name, dim),
+                )
+            else:
+                dim, n_rows = model_row
+            if vectors.shape[1] != dim:
+                raise ValueError(
+                    f"Expected embeddings of size {dim} for {model_name}, got {vectors.shape[1]}"
+                )
+
+            now = time.time()
+            appended = []
+            for text, vector in zip(texts, vectors):
+                key = self.make_key(model_name, text)
+                self._remember(key, vector)
+                if self._db.execute(
+                    "SELECT 1 FROM embeddings WHERE key = ?", (key,)
+                ).fetchone():
+                    continue
+
+                if n_rows + len(appended) < self.max_disk_items:
+                    row = n_rows + len(appended)
+                    appended.append(vector)
+                else:
+                    # Disk store is full: reuse the row of the least recently used entry
+                    evicted_key, row = self._db.execute(
+                        "SELECT key, row FROM embeddings WHERE model = ? "
+                        "ORDER BY last_used LIMIT 1",
+                        (model_name,),
+                    ).fetchone()
+                    self._db.execute("DELETE FROM embeddings WHERE key = ?", (evicted_key,))
+                    self._memory.pop(evicted_key, None)
+                    if row < n_rows:
+                        matrix = self._get_matrix(model_name)
+                        matrix[row] = vector
+                        matrix.flush()
+                    else:
+                        appended[row - n_rows] = vector
+                self._db.execute(
+                    "INSERT INTO embeddings (key, model, row, last_used) VALUES (?, ?, ?, ?)",
+                    (key, model_name, row, now),
+                )
+
+            if appended:
+                # Write at the offset of `n_rows` so leftovers of an interrupted
+                # write can never shift the rows out of line with the index
+                path = self._matrix_path(model_name)
+                with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                    f.seek(n_rows * dim * 4)
+                    f.write(np.stack(appended).astype(np.float32).tobytes())
+                    f.truncate()
+                self._db.execute(
+                    "UPDATE models SET n_rows = ? WHERE model = ?",
+                    (n_rows + len(appended), model_name),
+                )
+            self._db.commit()
+
+    def get_or_compute(
+        self, model_name: str, texts: List[str], compute_fn: Callable
+    ) -> np.ndarray:
+        """Returns the embeddings of `texts`, calling `compute_fn` once for all the misses."""
+        if not texts:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT dim FROM models WHERE model = ?", (model_name,)
+                ).fetchone()
+            return np.empty((0, row[0] if row else 0), dtype=np.float32)
+        results = self.get_many(model_name, texts)
+        missing = list(
+            dict.fromkeys(
+                normalize_text(text)
+                for text, result in zip(texts, results)
+                if result is None
+            )
+        )
+        if missing:
+            computed = np.asarray(compute_fn(missing), dtype=np.float32)
+            self.put_many(model_name, missing, computed)
+            by_text = dict(zip(missing, computed))
+            results = [
+                by_text[normalize_text(text)] if result is None else result
+                for text, result in zip(texts, results)
+            ]
+        return np.stack(results)
+
+    def seed(self, model_name: str, texts: List[str], compute_fn: Callable) -> int:
+        """Pre-computes the embeddings of `texts`, returns how many were missing."""
+        # Counted from the texts sent to `compute_fn`, the miss counter also
+        # moves with the lookups of other threads
+        computed = []
+
+        def compute(missing_texts):
+            computed.extend(missing_texts)
+            return compute_fn(missing_texts)
+
+        self.get_or_compute(model_name, texts, compute)
+        return len(computed)
+
+    def stats(self) -> dict:
+        # One snapshot of the counters, taken under the lock that guards the lookups
+        with self._lock:
+            disk_items = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            memory_hits, disk_hits, misses = self.memory_hits, self.disk_hits, self.misses
+            memory_items = len(self._memory)
+        lookups = memory_hits + disk_hits + misses
+        return {
+            "memory_hits": memory_hits,
+            "disk_hits": disk_hits,
+            "misses": misses,
+            "hit_rate": (memory_hits + disk_hits) / lookups if lookups else 0.0,
+            "memory_items": memory_items,
+            "disk_items": disk_items,
+        }
@@ -0,0 +1,187 @@
+import time
+import threading
+from typing import Optional
+
+from sqlalchemy import URL, create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+
+def make_url(db_config: dict) -> URL:
+    return URL.create(
+        "postgresql",
+        username=db_config["username"],
+        password=db_config["password"],
+        host=db_config["host"],
+        port=db_config["port"],
+        database=db_config["database"],
+    )
+
+
+# ------ Pool metrics ------ #
+
+
+class PoolMetrics:
+    """Counters of one connection pool, updated from the pool events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_hold = 0.0
+        self.checkins = 0
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def record_invalidation(self):
+        with self._lock:
+            self.invalidations += 1
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def record_hold(self, seconds: float):
+        with self._lock:
+            self.checkins += 1
+            self.total_hold += seconds
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "invalidations": self.invalidations,
+                "mean_checkout_wait_ms": 1000 * self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_checkout_wait_ms": 1000 * self.max_wait,
+                "mean_hold_ms": 1000 * self.total_hold / self.checkins if self.checkins else 0.0,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool which measures how long every checkout waited for a connection."""
+
+    def __init__(self, *args, metrics: Optional[PoolMetrics] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics or PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.metrics.record_wait(time.perf_counter() - start)
+
+    def recreate(self):
+        # Keep the same counters when the engine recreates its pool
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+# ------ Engine registry ------ #
+
+
+class EngineRegistry:
+    """One pooled SQLAlchemy engine per database configuration.
+
+    Every function of `db_utils` and every query engine built from the same
+    `db_config` share the engine, so a Streamlit rerun or a new chat message
+    never opens a new pool against Postgres.
+
+    Args:
+        pool_size (int): Connections kept open per engine. Default: 5.
+        max_overflow (int): Extra connections opened under load. Default: 10.
+        pool_timeout (float): Seconds to wait for a free connection. Default: 30.
+        pool_pre_ping (bool): Test connections on checkout, replacing dead ones. Default: True.
+        pool_recycle (int): Seconds after which a connection is reopened. Default: 1800.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_timeout: float = 30,
+        pool_pre_ping: bool = True,
+        pool_recycle: int = 1800,
+    ):
+        self.pool_kwargs = {
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "pool_timeout": pool_timeout,
+            "pool_pre_ping": pool_pre_ping,
+            "pool_recycle": pool_recycle,
+        }
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(db_config: dict) -> tuple:
+        return tuple(
+            str(db_config[field])
+            for field in ("username", "password", "host", "port", "database")
+        )
+
+    def get(self, db_config: dict) -> Engine:
+        key = self.make_key(db_config)
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is None:
+                engine = create_engine(
+                    make_url(db_config), poolclass=TimedQueuePool, **self.pool_kwargs
+                )
+                self._add_listeners(engine)
+                self._engines[key] = engine
+            return engine
+
+    @staticmethod
+    def _add_listeners(engine: Engine):
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            engine.pool.metrics.record_connect()
+
+        @event.listens_for(engine, "checkout")
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            connection_record.info["checked_out_at"] = time.perf_counter()
+
+        @event.listens_for(engine, "checkin")
+        def on_checkin(dbapi_connection, connection_record):
+            checked_out_at = connection_record.info.pop("checked_out_at", None)
+            if checked_out_at is not None:
+                engine.pool.metrics.record_hold(time.perf_counter() - checked_out_at)
+
+        @event.listens_for(engine, "invalidate")
+        def on_invalidate(dbapi_connection, connection_record, exception):
+            engine.pool.metrics.record_invalidation()
+
+    def metrics(self, db_config: dict) -> dict:
+        """Pool state and checkout metrics of the engine of `db_config`."""
+        engine = self.get(db_config)
+        pool = engine.pool
+        return {
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            **pool.metrics.as_dict(),
+        }
+
+    def dispose(self):
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+
+
+# Used when no registry is passed explicitly, e.g. outside of Streamlit
+default_registry = EngineRegistry()
+
+
+def get_engine(db_config: dict, registry: Optional[EngineRegistry] = None) -> Engine:
+    return (registry or default_registry).get(db_config)
@@ -1,14 +1,25 @@
-import time
+import premai
 import streamlit as st
 from llama_index.core import Settings
 from llama_index.llms.premai import PremAI
-from llama_index.embeddings.premai import PremAIEmbeddings
+from embedding_cache import EmbeddingCache, CachedPremAIEmbeddings
 from db_utils import get_all_tables_from_db, setup_index
+from engine_registry import EngineRegistry
+from schema_cache import SchemaCache, default_cache_dir
+from sql_cache import TextToSQLCache
+from streaming import render_stream
+import tracing
+from tracing import Tracer
+from prem_client import RateLimitedPrem
 
 # ---- PremAI configuration ----
 premai_api_key = st.secrets.premai_api_key
 premai_project_id = st.secrets.premai_project_id
 embedding_model_name = "text-embedding-3-large"
+embedding_cache_dir = ".embedding_cache"
+# Limits of the Prem client shared by every session, set them to the limits
+# of your Prem plan. Requests over them wait instead of failing with a 429
+prem_rate_limits = dict(requests_per_minute=300, tokens_per_minute=None)
 
 # ---- Database configuration ----
 username = st.secrets.username
@@ -25,11 +36,99 @@ db_config = {
     "database": dbname,
 }
 
+# ---- Connection pool configuration ----
+pool_settings = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+}
+
+# ---- Limits of the generated SQL ----
+# Rows kept per query, statement timeout, rows per server-side cursor fetch
+# and the maximum size of the result passed to the answer synthesis
+execution_limits = {
+    "max_rows": 50,
+    "statement_timeout_ms": 15_000,
+    "fetch_size": 500,
+    "max_result_chars": 6000,
+}
+
+
+# ---- Tracing ----
+# Stage timings of every message are exported as Prometheus metrics on this
+# port (needs `prometheus-client`) and as OpenTelemetry spans (needs `opentelemetry-api`)
+prometheus_port = None
+opentelemetry_enabled = False
+
+
+@st.cache_resource
+def get_tracer() -> Tracer:
+    return Tracer(
+        app="chat-with-sql",
+        prometheus_port=prometheus_port,
+        opentelemetry=opentelemetry_enabled,
+    )
+
+
+tracer = get_tracer()
+
+
+# One pooled engine per database, shared by every session and rerun
+@st.cache_resource
+def get_engine_registry() -> EngineRegistry:
+    return EngineRegistry(**pool_settings)
+
+
+engine_registry = get_engine_registry()
+
+
+# Reflected schema and table embeddings, persisted and shared by every session
+@st.cache_resource
+def get_schema_cache() -> SchemaCache:
+    return SchemaCache(
+        engine_registry.get(db_config), cache_dir=default_cache_dir(db_config)
+    )
+
+
+schema_cache = get_schema_cache()
+
+
+# Generated SQL per question and schema, and query results per data version,
+# in a directory of their own for every database
+@st.cache_resource
+def get_sql_cache(cache_dir: str) -> TextToSQLCache:
+    return TextToSQLCache(cache_dir=cache_dir, result_ttl=300)
+
+
+sql_cache = get_sql_cache(cache_dir=default_cache_dir(db_config, root_dir=".sql_cache"))
+
 # ---- Define the LLM and Embedding model using Prem ----
+# The embedding cache is shared by all the sessions of this process
+
+
+@st.cache_resource
+def get_embedding_cache(cache_dir: str) -> EmbeddingCache:
+    return EmbeddingCache(cache_dir=cache_dir)
+
+
+# Rate limited, retried and coalesced across every session of this process
+@st.cache_resource
+def get_prem_client() -> RateLimitedPrem:
+    return RateLimitedPrem(premai.Prem(api_key=premai_api_key), **prem_rate_limits)
+
+
+embedding_cache = get_embedding_cache(cache_dir=embedding_cache_dir)
+prem_client = get_prem_client()
 llm = PremAI(
     project_id=premai_project_id, premai_api_key=premai_api_key, temperature=0.1
 )
-embedding_model = PremAIEmbeddings(
+# The llama-index LLM creates its own client, it is replaced by the shared one
+llm._client = prem_client
+embedding_model = CachedPremAIEmbeddings(
+    cache=embedding_cache,
+    prem_client=prem_client,
     project_id=premai_project_id,
     premai_api_key=premai_api_key,
     model_name=embedding_model_name,
@@ -63,7 +162,9 @@ with st.sidebar:
             """
         )
 
-    all_tables = get_all_tables_from_db(db_config=db_config)
+    all_tables = get_all_tables_from_db(
+        db_config=db_config, engine_registry=engine_registry, schema_cache=schema_cache
+    )
     options = st.selectbox(label="Select your database", options=all_tables)
     if options is None:
         st.error("No table found")
@@ -74,13 +175,33 @@ with st.sidebar:
             ("\nIndexing all the tables" if use_all_tables else "")
         )
 
+    cache_stats = embedding_cache.stats()
+    st.caption(
+        f"Embedding cache hit rate: {cache_stats['hit_rate']:.0%} "
+        f"({cache_stats['memory_hits'] + cache_stats['disk_hits']} hits, "
+        f"{cache_stats['misses']} misses)"
+    )
+    pool_stats = engine_registry.metrics(db_config)
+    st.caption(
+        f"DB pool: {pool_stats['checked_out']}/{pool_stats['pool_size']} in use, "
+        f"{pool_stats['checkouts']} checkouts, "
+        f"mean wait {pool_stats['mean_checkout_wait_ms']:.1f} ms"
+    )
+
 # ---- Main chat UI code that will return the response and the SQL used to retrieve ----
 if options is None:
     st.error("Please set up the SQL DB Engine connection properly. No Tables found.")
 
 else:
     query_engine = setup_index(
-        db_config=db_config, table=options, use_all=use_all_tables
+        db_config=db_config,
+        table=options,
+        use_all=use_all_tables,
+        streaming=True,
+        engine_registry=engine_registry,
+        schema_cache=schema_cache,
+        execution_limits=execution_limits,
+        sql_cache=sql_cache,
     )
 
     if "messages" not in st.session_state:
@@ -98,29 +219,39 @@ else:
 
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
-            full_response = ""
-
-            while not full_response:
-                with st.spinner("Thinking ...."):
-                    try:
+            trace = tracer.start_trace("chat")
+            try:
+                with trace.activate():
+                    with st.spinner("Thinking ...."), tracing.stage("query"):
                         response = query_engine.query(prompt)
-                        response_str, response_meta = (
-                            response.response,
-                            response,
-                        )
-                    except Exception:
-                        response_str = "Failed to respond"
-                        response_meta = []
-
-                fr = ""
-                full_response = str(response_str)
-                for i in full_response:
-                    time.sleep(0.01)
-                    fr += i
-                    message_placeholder.write(fr + "▌")
-                message_placeholder.write(f"{full_response}")
-                with st.expander(label="See what was run inside the model"):
-                    st.write(response_meta)
+                    full_response = render_stream(
+                        message_placeholder, tracing.traced_stream(response.response_gen)
+                    )
+                response_meta = response
+                sql_metadata = response.metadata or {}
+                if sql_metadata.get("truncated"):
+                    total = sql_metadata.get("row_count") or "more"
+                    st.caption(
+                        f"The answer is based on the first {len(sql_metadata['result'])} "
+                        f"of {total} rows returned by the query"
+                    )
+            except Exception as e:
+                # Shown instead of retried, a retry would repeat the whole query
+                full_response = "Failed to respond"
+                message_placeholder.error(f"{full_response}: {e}")
+                response_meta = []
+            trace.finish()
+
+            with st.expander(label="See what was run inside the model"):
+                st.caption(trace.summary())
+                if response_meta:
+                    sql_metadata = response_meta.metadata or {}
+                    if sql_metadata.get("sql_cache_hit"):
+                        st.caption("SQL reused from the cache")
+                    if sql_metadata.get("result_cache_hit"):
+                        st.caption("Result reused from the cache")
+                    st.code(sql_metadata.get("sql_query", ""), language="sql")
+                st.write(response_meta)
 
             st.session_state.messages.append(
                 {"role": "assistant", "content": full_response}
@@ -0,0 +1,248 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+import httpx
+import premai
+
+# HTTP status codes worth retrying a request for
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# Errors of the Prem SDK models raised on rate limits and provider outages
+TRANSIENT_ERROR_NAMES = {
+    "RateLimitError",
+    "ProviderAPIConnectionError",
+    "ProviderAPITimeoutError",
+    "ProviderInternalServerError",
+}
+
+
+def is_transient_error(error: Exception) -> bool:
+    if isinstance(error, premai.errors.UnexpectedStatus):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    if type(error).__name__ in TRANSIENT_ERROR_NAMES:
+        return True
+    # Timeouts, dropped connections and other network errors
+    return isinstance(error, httpx.TransportError)
+
+
+def request_key(endpoint: str, kwargs: dict) -> str:
+    content = json.dumps({"endpoint": endpoint, **kwargs}, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def count_request_tokens(kwargs: dict) -> int:
+    """Tokens of a chat or embedding request, about 4 characters a token, plus `max_tokens`."""
+    texts = kwargs.get("input") or []
+    texts = [texts] if isinstance(texts, str) else list(texts)
+    for message in kwargs.get("messages") or []:
+        texts.append(message.get("content") if isinstance(message, dict) else message)
+    characters = sum(len(str(text or "")) for text in texts)
+    return characters // 4 + (kwargs.get("max_tokens") or 0)
+
+
+# ------ Prem streams ------ #
+
+
+class _OpenedStream:
+    """Context manager handing out an HTTP response which is already open."""
+
+    def __init__(self, stream, http_response):
+        self._stream = stream
+        self._http_response = http_response
+
+    def __enter__(self):
+        return self._http_response
+
+    def __exit__(self, *exc_info):
+        return self._stream.__exit__(*exc_info)
+
+
+def open_premai_stream(response):
+    """Sends the request of a `stream=True` Prem chat completion and checks its status.
+
+    premai only sends the request once the stream is iterated, and then drops
+    any error response, so the stream just ends empty. This opens it right
+    away, raises `premai.errors.UnexpectedStatus` on an error status and
+    returns the same response, ready to be iterated.
+    """
+    stream = getattr(response, "_stream", None)
+    if stream is None or isinstance(stream, _OpenedStream):
+        return response
+    http_response = stream.__enter__()
+    if http_response.status_code >= 400:
+        try:
+            content = http_response.read()
+        finally:
+            stream.__exit__(None, None, None)
+        raise premai.errors.UnexpectedStatus(http_response.status_code, content)
+    response._stream = _OpenedStream(stream, http_response)
+    return response
+
+
+# ------ Token bucket ------ #
+
+
+class TokenBucket:
+    """Allows `per_minute` units a minute, in bursts of at most `capacity` units, across threads."""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self._available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        """Blocks until `amount` units are available and takes them, returns the seconds waited."""
+        # A request larger than a burst waits for a full bucket
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._available = min(
+                    self.capacity, self._available + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._available >= amount:
+                    self._available -= amount
+                    return waited
+                delay = (amount - self._available) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+# ------ Shared Prem client ------ #
+
+
+class RateLimitedPrem:
+    """Prem client shared by every session, with rate limits, retries and coalescing.
+
+    Wraps a `premai.Prem` client and exposes the calls the apps make through it
+    and through the LangChain, llama-index and DSPy wrappers:
+    `chat.completions.create`, `embeddings.create` and
+    `repository.document.create`. Any other attribute is the wrapped client's.
+
+    - Every request takes one request from the requests per minute bucket and
+      its estimated tokens from the tokens per minute bucket, and waits while
+      they are empty instead of running into 429s.
+    - Rate limits, provider outages and network errors are retried with
+      exponential backoff and full jitter, so the retries of concurrent
+      sessions do not arrive together. Streamed completions are opened
+      before they are returned, so their errors are retried the same way.
+    - Identical chat completions and embedding requests in flight at the same
+      time share one upstream call. Streamed completions and uploads are never
+      shared.
+
+    Args:
+        client (premai.Prem): The client sending the requests.
+        requests_per_minute (float, optional): Request rate limit. Default: None, no limit.
+        tokens_per_minute (float, optional): Token rate limit. Default: None, no limit.
+        max_retries (int): Retries of a failed request. Default: 4.
+        base_delay (float): Maximum backoff of the first retry, in seconds. Default: 1.0.
+        max_delay (float): Maximum backoff of any retry, in seconds. Default: 30.0.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 4,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+    ):
+        self.client = client
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "retries": 0, "coalesced": 0, "rate_limited_s": 0.0}
+
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self._create_chat_completion)
+        )
+        self.embeddings = SimpleNamespace(create=self._create_embeddings)
+        self.repository = SimpleNamespace(
+            document=SimpleNamespace(create=self._create_document)
+        )
+
+    def __getattr__(self, name: str):
+        if name == "client":
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _record(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                self._stats[name] += value
+
+    def _send(self, fn: Callable, tokens: int, kwargs: dict):
+        for attempt in range(self.max_retries + 1):
+            waited = self._requests.acquire() if self._requests else 0.0
+            if self._tokens and tokens:
+                waited += self._tokens.acquire(tokens)
+            self._record(requests=1, rate_limited_s=waited)
+            try:
+                return fn(**kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient_error(e):
+                    raise
+                self._record(retries=1)
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt)))
+
+    def _coalesce(self, key: str, send: Callable):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        if not leader:
+            self._record(coalesced=1)
+            return future.result()
+
+        try:
+            result = send()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _create_chat_completion(self, **kwargs):
+        create = self.client.chat.completions.create
+
+        def send():
+            return self._send(create, count_request_tokens(kwargs), kwargs)
+
+        if kwargs.get("stream"):
+            # The request of a stream is only sent once it is read, opening it
+            # here puts an error status through the retries
+            return self._send(
+                lambda **kw: open_premai_stream(create(**kw)), count_request_tokens(kwargs), kwargs
+            )
+        return self._coalesce(request_key("chat", kwargs), send)
+
+    def _create_embeddings(self, **kwargs):
+        def send():
+            return self._send(self.client.embeddings.create, count_request_tokens(kwargs), kwargs)
+
+        return self._coalesce(request_key("embeddings", kwargs), send)
+
+    def _create_document(self, **kwargs):
+        return self._send(self.client.repository.document.create, 0, kwargs)
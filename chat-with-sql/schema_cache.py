@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+from sqlalchemy import MetaData, text
+from sqlalchemy.engine import Engine
+
+from llama_index.core import Settings, StorageContext, VectorStoreIndex, SQLDatabase
+from llama_index.core import load_index_from_storage
+from llama_index.core.objects import ObjectIndex, SQLTableNodeMapping, SQLTableSchema
+from llama_index.core.schema import TextNode
+
+SCHEMA_FILE = "schema.pkl"
+OBJECT_INDEX_DIR = "object_index"
+OBJECT_INDEX_STATE_FILE = "index_state.json"
+
+COLUMNS_FINGERPRINT_QUERY = text(
+    """
+    SELECT c.table_name,
+           md5(string_agg(
+               c.column_name || ':' || c.data_type || ':' || c.is_nullable || ':'
+               || coalesce(c.column_default, ''),
+               ',' ORDER BY c.ordinal_position
+           ))
+    FROM information_schema.columns c
+    JOIN information_schema.tables t
+      ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+    WHERE c.table_schema = :schema AND t.table_type = 'BASE TABLE'
+    GROUP BY c.table_name
+    """
+)
+
+CONSTRAINTS_FINGERPRINT_QUERY = text(
+    """
+    SELECT kcu.table_name,
+           md5(string_agg(
+               tc.constraint_type || ':' || kcu.constraint_name || ':' || kcu.column_name,
+               ',' ORDER BY kcu.constraint_name, kcu.ordinal_position
+           ))
+    FROM information_schema.key_column_usage kcu
+    JOIN information_schema.table_constraints tc
+      ON tc.constraint_schema = kcu.constraint_schema
+     AND tc.constraint_name = kcu.constraint_name
+     AND tc.table_name = kcu.table_name
+    WHERE kcu.table_schema = :schema
+    GROUP BY kcu.table_name
+    """
+)
+
+
+def default_cache_dir(db_config: dict, root_dir: str = ".schema_cache") -> str:
+    database_id = f"{db_config['host']}:{db_config['port']}/{db_config['database']}"
+    return os.path.join(root_dir, hashlib.md5(database_id.encode("utf-8")).hexdigest())
+
+
+def save_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# ------ SQLDatabase and node mapping backed by the cache ------ #
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """SQLDatabase sharing the reflected metadata and table descriptions of a SchemaCache.
+
+    The metadata passed to SQLDatabase already holds the tables, so its
+    constructor does not reflect them again.
+    """
+
+    def __init__(self, engine: Engine, schema_cache: "SchemaCache", **kwargs):
+        self._schema_cache = schema_cache
+        super().__init__(engine, metadata=schema_cache.metadata, **kwargs)
+
+    def get_single_table_info(self, table_name: str) -> str:
+        table_info = self._schema_cache.table_info.get(table_name)
+        return table_info or super().get_single_table_info(table_name)
+
+
+class StableSQLTableNodeMapping(SQLTableNodeMapping):
+    """SQLTableNodeMapping whose node ids are the table names.
+
+    The upstream ids come from `hash()`, which changes with every process, so
+    the nodes of a persisted index could never be found again.
+    """
+
+    def to_node(self, obj: SQLTableSchema) -> TextNode:
+        node = super().to_node(obj)
+        node.id_ = obj.table_name
+        return node
+
+
+# ------ Schema cache ------ #
+
+
+class SchemaCache:
+    """Reflected schema and table embedding index of one database, persisted to disk.
+
+    Tables are tracked by a fingerprint of their columns and constraints read
+    from `information_schema`, one cheap query for the whole database. Only
+    the tables whose fingerprint changed are reflected and embedded again.
+    Nothing is read from disk or from the database until first used, and the
+    table embedding index is only loaded by `get_object_index`.
+
+    Args:
+        engine (Engine): Engine of the database.
+        cache_dir (str): Directory of the cached schema and index.
+        schema (str): Database schema to cache. Default: `"public"`.
+        check_interval (float): Seconds during which the fingerprints are not
+            queried again. Default: 30.
+    """
+
+    def __init__(self, engine: Engine, cache_dir: str, schema: str = "public", check_interval: float = 30):
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self.schema = schema
+        self.check_interval = check_interval
+
+        self._lock = threading.RLock()
+        self._state = None
+        self._checked_at = 0.0
+        self._object_index = None
+        self._indexed = None
+
+    # ---- schema ---- #
+
+    def _load(self):
+        if self._state is not None:
+            return
+        path = os.path.join(self.cache_dir, SCHEMA_FILE)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self._state = pickle.load(f)
+        else:
+            self._state = {"fingerprints": {}, "metadata": MetaData(), "table_info": {}}
+
+    def fingerprints(self) -> Dict[str, str]:
+        with self.engine.connect() as connection:
+            columns = dict(
+                connection.execute(COLUMNS_FINGERPRINT_QUERY, {"schema": self.schema}).all()
+            )
+            constraints = dict(
+                connection.execute(CONSTRAINTS_FINGERPRINT_QUERY, {"schema": self.schema}).all()
+            )
+        return {
+            table: hashlib.md5(f"{fingerprint}:{constraints.get(table, '')}".encode("utf-8")).hexdigest()
+            for table, fingerprint in columns.items()
+        }
+
+    def refresh(self, force: bool = False) -> Dict[str, List[str]]:
+        """Reflects the tables which were added or changed since the last refresh."""
+        with self._lock:
+            self._load()
+            if not force and time.monotonic() - self._checked_at < self.check_interval:
+                return {"changed": [], "removed": []}
+
+            current = self.fingerprints()
+            known = self._state["fingerprints"]
+            metadata = self._state["metadata"]
+            changed = sorted(table for table, fp in current.items() if known.get(table) != fp)
+            removed = sorted(table for table in known if table not in current)
+
+            for table in changed + removed:
+                self._state["table_info"].pop(table, None)
+                if table in metadata.tables:
+                    metadata.remove(metadata.tables[table])
+            if changed:
+                # Only the changed tables are reflected, the others are already in `metadata`
+                sql_database = SQLDatabase(self.engine, metadata=metadata, include_tables=changed)
+                for table in changed:
+                    self._state["table_info"][table] = sql_database.get_single_table_info(table)
+
+            self._state["fingerprints"] = current
+            self._checked_at = time.monotonic()
+            if changed or removed:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                save_atomic(os.path.join(self.cache_dir, SCHEMA_FILE), pickle.dumps(self._state))
+            return {"changed": changed, "removed": removed}
+
+    @property
+    def metadata(self) -> MetaData:
+        self._load()
+        return self._state["metadata"]
+
+    @property
+    def table_info(self) -> Dict[str, str]:
+        self._load()
+        return self._state["table_info"]
+
+    def fingerprint(self, tables: List[str]) -> str:
+        """Single fingerprint of the definitions of `tables`."""
+        self._load()
+        fingerprints = self._state["fingerprints"]
+        content = ",".join(f"{table}:{fingerprints.get(table, '')}" for table in sorted(tables))
+        return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+    def table_names(self) -> List[str]:
+        self.refresh()
+        return sorted(self._state["fingerprints"])
+
+    def get_sql_database(self, include_tables: Optional[List[str]] = None) -> CachedSQLDatabase:
+        self.refresh()
+        return CachedSQLDatabase(self.engine, schema_cache=self, include_tables=include_tables)
+
+    # ---- table embedding index ---- #
+
+    def _load_object_index(self, persist_dir: str, embed_model_name: str):
+        state_path = os.path.join(persist_dir, OBJECT_INDEX_STATE_FILE)
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            # Vectors of another embedding model can not be compared, rebuild
+            if state["embed_model"] == embed_model_name:
+                storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+                return load_index_from_storage(storage_context), state["tables"]
+        return VectorStoreIndex([]), {}
+
+    def get_object_index(self, sql_database: Optional[CachedSQLDatabase] = None) -> ObjectIndex:
+        """Table embedding index, only the added or changed tables are embedded."""
+        self.refresh()
+        with self._lock:
+            persist_dir = os.path.join(self.cache_dir, OBJECT_INDEX_DIR)
+            embed_model_name = Settings.embed_model.model_name
+            if self._object_index is None:
+                self._object_index, self._indexed = self._load_object_index(
+                    persist_dir, embed_model_name
+                )
+            index, indexed = self._object_index, self._indexed
+
+            mapping = StableSQLTableNodeMapping(sql_database or self.get_sql_database())
+            current = self._state["fingerprints"]
+            stale = [table for table in indexed if indexed[table] != current.get(table)]
+            new = [table for table in current if indexed.get(table) != current[table]]
+            if stale:
+                index.delete_nodes(stale, delete_from_docstore=True)
+                for table in stale:
+                    index.index_struct.delete(table)
+                    del indexed[table]
+                index.storage_context.index_store.add_index_struct(index.index_struct)
+            if new:
+                index.insert_nodes(
+                    [mapping.to_node(SQLTableSchema(table_name=table)) for table in new]
+                )
+                indexed.update({table: current[table] for table in new})
+            if stale or new:
+                index.storage_context.persist(persist_dir=persist_dir)
+                save_atomic(
+                    os.path.join(persist_dir, OBJECT_INDEX_STATE_FILE),
+                    json.dumps({"embed_model": embed_model_name, "tables": indexed}).encode("utf-8"),
+                )
+            return ObjectIndex(index, mapping)
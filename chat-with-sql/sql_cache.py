@@ -0,0 +1,197 @@
+import os
+import re
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from llama_index.core.indices.struct_store.sql_query import BaseSQLTableQueryEngine
+from llama_index.core.indices.struct_store.sql_retriever import NLSQLRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+import tracing
+from schema_cache import SchemaCache
+
+
+def normalize_question(question: str) -> str:
+    """Lower case, single spaces and no trailing punctuation."""
+    return re.sub(r"[\s?.!]+$", "", " ".join(question.lower().split()))
+
+
+# ------ Text-to-SQL cache ------ #
+
+
+class TextToSQLCache:
+    """Two level cache of the text-to-SQL pipeline, stored in sqlite.
+
+    - Level 1 maps (normalized question, table set, schema fingerprint) to
+      the generated SQL. A change of the schema of one of the tables changes
+      the key, so no SQL written for an old schema is ever reused.
+    - Level 2 maps (SQL, data version) to the result of running it. Results
+      expire after `result_ttl` seconds, and only `max_results` are kept.
+
+    Neither key tells databases apart, so every database needs a cache
+    directory of its own, e.g. `default_cache_dir(db_config, root_dir=".sql_cache")`.
+
+    Args:
+        cache_dir (str): Directory of the sqlite file. Default: `".sql_cache"`.
+        sql_ttl (float): Seconds a generated SQL is reused. Default: one week.
+        result_ttl (float): Seconds a query result is reused. Default: 300.
+        max_sql (int): Maximum number of cached SQL queries. Default: 10000.
+        max_results (int): Maximum number of cached results. Default: 1000.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = ".sql_cache",
+        sql_ttl: float = 7 * 24 * 3600,
+        result_ttl: float = 300,
+        max_sql: int = 10_000,
+        max_results: int = 1000,
+    ):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.ttl = {"sql": sql_ttl, "results": result_ttl}
+        self.max_items = {"sql": max_sql, "results": max_results}
+        self.hits = {"sql": 0, "results": 0}
+        self.misses = {"sql": 0, "results": 0}
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, "cache.sqlite"), check_same_thread=False
+        )
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sql (
+                key TEXT PRIMARY KEY, value BLOB, created_at REAL, last_used REAL
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, value BLOB, created_at REAL, last_used REAL
+            );
+            """
+        )
+
+    @staticmethod
+    def make_sql_key(question: str, tables: List[str], schema_fingerprint: str) -> str:
+        content = "\x00".join([normalize_question(question), ",".join(sorted(tables)), schema_fingerprint])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_result_key(sql_query: str, data_version: Optional[str]) -> str:
+        content = f"{' '.join(sql_query.split())}\x00{data_version}"
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _get(self, table: str, key: str):
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT value, created_at FROM {table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or time.time() - row[1] > self.ttl[table]:
+                self.misses[table] += 1
+                return None
+            self.hits[table] += 1
+            self._db.execute(
+                f"UPDATE {table} SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+            return pickle.loads(row[0])
+
+    def _put(self, table: str, key: str, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {table} (key, value, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, pickle.dumps(value), now, now),
+            )
+            # Expired entries first, then the least recently used ones
+            self._db.execute(
+                f"DELETE FROM {table} WHERE created_at < ?", (now - self.ttl[table],)
+            )
+            self._db.execute(
+                f"DELETE FROM {table} WHERE key IN ("
+                f"SELECT key FROM {table} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_items[table],),
+            )
+            self._db.commit()
+
+    def get_sql(self, key: str) -> Optional[str]:
+        return self._get("sql", key)
+
+    def put_sql(self, key: str, sql_query: str):
+        self._put("sql", key, sql_query)
+
+    def get_result(self, key: str) -> Optional[Tuple[str, Dict]]:
+        return self._get("results", key)
+
+    def put_result(self, key: str, result: Tuple[str, Dict]):
+        self._put("results", key, result)
+
+    def stats(self) -> dict:
+        return {"hits": dict(self.hits), "misses": dict(self.misses)}
+
+
+# ------ Cached text-to-SQL retriever ------ #
+
+
+class CachedNLSQLRetriever:
+    """Wraps the NLSQLRetriever of a query engine with the level 1 cache.
+
+    On a hit, the cached SQL is run directly and the text-to-SQL LLM call is
+    skipped. The metadata tells whether the SQL came from the cache.
+    """
+
+    def __init__(self, retriever: NLSQLRetriever, cache: TextToSQLCache, schema_cache: SchemaCache):
+        self._retriever = retriever
+        self._cache = cache
+        self._schema_cache = schema_cache
+
+    def __getattr__(self, name):
+        return getattr(self._retriever, name)
+
+    def retrieve_with_metadata(self, str_or_query_bundle) -> Tuple[List[NodeWithScore], Dict]:
+        if isinstance(str_or_query_bundle, str):
+            query_bundle = QueryBundle(str_or_query_bundle)
+        else:
+            query_bundle = str_or_query_bundle
+
+        with tracing.stage("table_retrieval"):
+            tables = sorted(
+                table.table_name for table in self._retriever._get_tables(query_bundle.query_str)
+            )
+        key = self._cache.make_sql_key(
+            query_bundle.query_str, tables, self._schema_cache.fingerprint(tables)
+        )
+        sql_query = self._cache.get_sql(key)
+        tracing.cache("sql", hit=sql_query is not None)
+        if sql_query is None:
+            # Includes running the SQL, which is recorded as its own stage
+            with tracing.stage("sql_generation"):
+                retrieved_nodes, metadata = self._retriever.retrieve_with_metadata(query_bundle)
+            # Only SQL which ran without errors is worth reusing
+            if "result" in metadata:
+                self._cache.put_sql(key, metadata["sql_query"])
+            return retrieved_nodes, {**metadata, "sql_cache_hit": False}
+
+        try:
+            retrieved_nodes, metadata = self._retriever._sql_retriever.retrieve_with_metadata(
+                sql_query
+            )
+        except BaseException as e:
+            # same error handling as NLSQLRetriever
+            if not self._retriever._handle_sql_errors:
+                raise
+            retrieved_nodes = [NodeWithScore(node=TextNode(text=f"Error: {e!s}"))]
+            metadata = {}
+        return retrieved_nodes, {"sql_query": sql_query, "sql_cache_hit": True, **metadata}
+
+
+def with_sql_cache(
+    query_engine: BaseSQLTableQueryEngine, cache: TextToSQLCache, schema_cache: SchemaCache
+) -> BaseSQLTableQueryEngine:
+    # The engines only expose their retriever through `sql_retriever`, which
+    # returns the `_sql_retriever` attribute
+    query_engine._sql_retriever = CachedNLSQLRetriever(
+        query_engine.sql_retriever, cache=cache, schema_cache=schema_cache
+    )
+    return query_engine
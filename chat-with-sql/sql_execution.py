@@ -0,0 +1,184 @@
+import re
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+import tracing
+from schema_cache import CachedSQLDatabase, SchemaCache
+from sql_cache import TextToSQLCache
+
+# Write counters of the tables, a marker which changes when their data changes
+DATA_VERSION_QUERY = text(
+    """
+    SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0)
+    FROM pg_stat_user_tables
+    WHERE relname IN :tables
+    """
+).bindparams(bindparam("tables", expanding=True))
+
+
+def is_numeric(value) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+# ------ Bounded SQL execution ------ #
+
+
+class BoundedSQLDatabase(CachedSQLDatabase):
+    """CachedSQLDatabase whose `run_sql` bounds the cost of the generated SQL.
+
+    - Only SELECT (and WITH) statements are run, wrapped in an outer query with
+      a LIMIT of `max_rows + 1`, so a `SELECT *` on a large table never loads
+      the whole table.
+    - Every statement runs with a `statement_timeout` on Postgres.
+    - Rows are read from a server-side cursor, `fetch_size` at a time.
+    - When the result is truncated, the total row count and min / max / avg of
+      the numeric columns are computed by the database, and passed to the
+      answer synthesis instead of the missing rows.
+    - The result text sent to the LLM is cut at `max_result_chars`.
+
+    The metadata of the result reports `row_count`, `truncated_rows` and the
+    `aggregates`, next to the usual `result` and `col_keys`.
+
+    With a `result_cache`, results are reused as long as the data version of
+    the tables (their write counters on Postgres) did not change. The
+    counters are updated by the statistics collector with a small delay, and
+    other databases have no data version, so the TTL of the cache bounds how
+    stale a result can be.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        schema_cache: SchemaCache,
+        max_rows: int = 50,
+        statement_timeout_ms: int = 15_000,
+        fetch_size: int = 500,
+        max_result_chars: int = 6000,
+        result_cache: Optional[TextToSQLCache] = None,
+        **kwargs,
+    ):
+        super().__init__(engine, schema_cache=schema_cache, **kwargs)
+        self.max_rows = max_rows
+        self.statement_timeout_ms = statement_timeout_ms
+        self.fetch_size = fetch_size
+        self.max_result_chars = max_result_chars
+        self.result_cache = result_cache
+
+    def data_version(self) -> Optional[str]:
+        if self.dialect != "postgresql":
+            return None
+        with self._engine.connect() as connection:
+            version = connection.execute(
+                DATA_VERSION_QUERY, {"tables": sorted(self._usable_tables)}
+            ).scalar()
+        return str(version)
+
+    def _set_timeout(self, connection: Connection):
+        if self.dialect == "postgresql":
+            connection.execute(
+                text(f"SET LOCAL statement_timeout = {int(self.statement_timeout_ms)}")
+            )
+
+    def _fetch_rows(self, connection: Connection, command: str) -> Tuple[List[tuple], List[str]]:
+        result = connection.execution_options(
+            stream_results=True, max_row_buffer=self.fetch_size
+        ).execute(text(f"SELECT * FROM ({command}) AS bounded_query LIMIT {self.max_rows + 1}"))
+        col_keys = list(result.keys())
+        rows = []
+        for partition in result.partitions(self.fetch_size):
+            rows.extend(tuple(row) for row in partition)
+        result.close()
+        return rows, col_keys
+
+    def _summarize(self, connection: Connection, command: str, col_keys: List[str], rows: List[tuple]) -> Tuple[Optional[int], Dict[str, dict]]:
+        """Total row count and numeric aggregates of the whole result, computed by the database."""
+        numeric_columns = [
+            idx
+            for idx in range(len(col_keys))
+            if any(row[idx] is not None for row in rows)
+            and all(row[idx] is None or is_numeric(row[idx]) for row in rows)
+        ]
+        quote = self._engine.dialect.identifier_preparer.quote
+        selects = ["count(*)"] + [
+            f"min({quote(col_keys[idx])}), max({quote(col_keys[idx])}), avg({quote(col_keys[idx])})"
+            for idx in numeric_columns
+        ]
+        try:
+            # A savepoint, so that a failing summary does not abort the transaction
+            with connection.begin_nested():
+                values = connection.execute(
+                    text(f"SELECT {', '.join(selects)} FROM ({command}) AS bounded_query")
+                ).one()
+        except (ProgrammingError, OperationalError):
+            return None, {}
+
+        aggregates = {}
+        for position, idx in enumerate(numeric_columns):
+            minimum, maximum, average = values[1 + 3 * position : 4 + 3 * position]
+            aggregates[col_keys[idx]] = {"min": minimum, "max": maximum, "avg": average}
+        return values[0], aggregates
+
+    def run_sql(self, command: str) -> Tuple[str, Dict]:
+        command = command.strip().rstrip(";").strip()
+        if not re.match(r"^(select|with)\b", command, re.IGNORECASE):
+            raise NotImplementedError(f"Statement {command!r} is not a SELECT query.")
+
+        if self.result_cache is None:
+            return self._run_bounded_sql(command)
+        key = self.result_cache.make_result_key(command, self.data_version())
+        cached = self.result_cache.get_result(key)
+        tracing.cache("result", hit=cached is not None)
+        if cached is not None:
+            result_str, metadata = cached
+            return result_str, {**metadata, "result_cache_hit": True}
+        result_str, metadata = self._run_bounded_sql(command)
+        self.result_cache.put_result(key, (result_str, metadata))
+        return result_str, {**metadata, "result_cache_hit": False}
+
+    def _run_bounded_sql(self, command: str) -> Tuple[str, Dict]:
+        try:
+            with tracing.stage("sql_execution"):
+                with self._engine.connect() as connection, connection.begin():
+                    self._set_timeout(connection)
+                    rows, col_keys = self._fetch_rows(connection, command)
+                    truncated = len(rows) > self.max_rows
+                    rows = rows[: self.max_rows]
+                    row_count, aggregates = len(rows), {}
+                    if truncated:
+                        row_count, aggregates = self._summarize(connection, command, col_keys, rows)
+        except (ProgrammingError, OperationalError) as exc:
+            if "statement timeout" in str(exc):
+                raise NotImplementedError(
+                    f"Statement {command!r} was cancelled after {self.statement_timeout_ms} ms."
+                ) from exc
+            raise NotImplementedError(f"Statement {command!r} is invalid SQL.") from exc
+
+        # truncate the results to the max string length, like SQLDatabase.run_sql
+        truncated_results = [
+            tuple(self.truncate_word(column, length=self._max_string_length) for column in row)
+            for row in rows
+        ]
+        result_str = str(truncated_results)
+        if len(result_str) > self.max_result_chars:
+            result_str = result_str[: self.max_result_chars] + " ...]"
+        if truncated:
+            total = f"{row_count} rows" if row_count is not None else "more rows"
+            result_str += f"\nOnly the first {len(rows)} rows are shown, the query returned {total}."
+            if aggregates:
+                result_str += " Over all the rows: " + "; ".join(
+                    f"{column}: min={values['min']}, max={values['max']}, avg={values['avg']}"
+                    for column, values in aggregates.items()
+                )
+
+        return result_str, {
+            "result": truncated_results,
+            "col_keys": col_keys,
+            "row_count": row_count,
+            "truncated": truncated,
+            "truncated_rows": row_count - len(rows) if row_count is not None else None,
+            "aggregates": aggregates,
+        }
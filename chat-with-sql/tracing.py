@@ -0,0 +1,345 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def format_duration(seconds: float) -> str:
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.2f} s"
+
+
+# ------ Trace of one request ------ #
+
+
+class Trace:
+    """Stage timings, counts, cache hits and errors of one request, e.g. one chat message.
+
+    Stages can be nested, each one also records its self time, without the
+    stages which ran inside it in the same thread. Stages, counts, cache
+    lookups and errors can be recorded from several threads.
+    """
+
+    def __init__(self, name: str, tracer: Optional["Tracer"] = None):
+        self.name = name
+        self.tracer = tracer
+        self.start_time = time.time()
+        self.duration = None
+        self.stages: List[dict] = []
+        self.counts: Dict[str, float] = {}
+        self.cache_lookups: Dict[str, Dict[str, int]] = {}
+        self.errors: List[dict] = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name: str, **attributes):
+        stack = self._local.__dict__.setdefault("stack", [])
+        record = {"name": name, "children": 0.0, "attributes": attributes}
+        record["parent"] = stack[-1]["index"] if stack else None
+        with self._lock:
+            record["index"] = len(self.stages)
+            self.stages.append(record)
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            stack.pop()
+            record.update(offset=start - self._start, duration=end - start)
+            record["self_duration"] = record["duration"] - record.pop("children")
+            if stack:
+                stack[-1]["children"] += end - start
+
+    def add_stage(self, name: str, start: float, end: float, **attributes):
+        """Records a stage timed elsewhere, `start` and `end` from `time.perf_counter()`."""
+        with self._lock:
+            self.stages.append(
+                {
+                    "name": name,
+                    "index": len(self.stages),
+                    "parent": None,
+                    "attributes": attributes,
+                    "offset": start - self._start,
+                    "duration": end - start,
+                    "self_duration": end - start,
+                }
+            )
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def cache(self, name: str, hit: bool):
+        with self._lock:
+            lookups = self.cache_lookups.setdefault(name, {"hit": 0, "miss": 0})
+            lookups["hit" if hit else "miss"] += 1
+
+    def error(self, stage: str, error: BaseException):
+        """Records an error handled by the app, e.g. a url which failed to be indexed."""
+        with self._lock:
+            self.errors.append(
+                {
+                    "stage": stage,
+                    "type": type(error).__name__,
+                    "message": str(error),
+                    "offset": time.perf_counter() - self._start,
+                }
+            )
+
+    @contextmanager
+    def activate(self):
+        """Makes this trace the one the module level helpers record into."""
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    def finish(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        if self.tracer is not None:
+            self.tracer.export(self)
+
+    def totals(self) -> Dict[str, float]:
+        """Self time of each stage name, in the order they first ran."""
+        totals = {}
+        for record in self.stages:
+            if "self_duration" in record:
+                totals[record["name"]] = totals.get(record["name"], 0.0) + record["self_duration"]
+        return totals
+
+    def summary(self) -> str:
+        parts = [f"{name} {format_duration(seconds)}" for name, seconds in self.totals().items()]
+        for record in self.stages:
+            if "first_token" in record["attributes"]:
+                parts.append(f"first token {format_duration(record['attributes']['first_token'])}")
+                break
+        parts += [f"{name.replace('_', ' ')} {value:g}" for name, value in self.counts.items()]
+        parts += [
+            f"{name} cache {lookups['hit']}/{lookups['hit'] + lookups['miss']} hits"
+            for name, lookups in self.cache_lookups.items()
+        ]
+        parts += [f"{record['stage']} failed: {record['type']}" for record in self.errors]
+        if self.duration is not None:
+            parts.insert(0, f"total {format_duration(self.duration)}")
+        return " · ".join(parts)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "stages": [
+                {key: value for key, value in record.items() if key != "children"}
+                for record in self.stages
+            ],
+            "counts": dict(self.counts),
+            "cache_lookups": {name: dict(lookups) for name, lookups in self.cache_lookups.items()},
+            "errors": [dict(record) for record in self.errors],
+        }
+
+
+# ------ Helpers recording into the current trace ------ #
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    trace = current_trace()
+    if trace is None:
+        yield None
+    else:
+        with trace.stage(name, **attributes) as record:
+            yield record
+
+
+def count(name: str, value: float = 1):
+    trace = current_trace()
+    if trace is not None:
+        trace.count(name, value)
+
+
+def cache(name: str, hit: bool):
+    trace = current_trace()
+    if trace is not None:
+        trace.cache(name, hit)
+
+
+def error(stage: str, error: BaseException):
+    trace = current_trace()
+    if trace is not None:
+        trace.error(stage, error)
+
+
+def propagate(fn: Callable) -> Callable:
+    """Wraps `fn` to record into the current trace when it runs in another thread."""
+    trace = current_trace()
+
+    def wrapper(*args, **kwargs):
+        token = _current_trace.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+
+    return wrapper
+
+
+def traced_stream(
+    tokens: Iterable[str], name: str = "llm_generation", count_name: str = "completion_tokens"
+) -> Iterator[str]:
+    """Passes `tokens` through, recording the stage until the stream ends.
+
+    The time to the first token is an attribute of the stage, and every
+    streamed delta counts as one token.
+    """
+    trace = current_trace()
+    if trace is None:
+        return iter(tokens)
+
+    def generate():
+        start, first_token, n_tokens = time.perf_counter(), None, 0
+        try:
+            for token in tokens:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                n_tokens += 1
+                yield token
+        finally:
+            attributes = {} if first_token is None else {"first_token": first_token}
+            trace.add_stage(name, start, time.perf_counter(), **attributes)
+            trace.count(count_name, n_tokens)
+
+    return generate()
+
+
+# ------ Exporters ------ #
+
+
+class Tracer:
+    """Creates traces and exports the finished ones.
+
+    - With `prometheus_port` and `prometheus_client` installed, stage self
+      times, request durations, counts, cache lookups and errors are exposed as
+      Prometheus metrics on that port.
+    - With `opentelemetry` and the `opentelemetry-api` package installed, each
+      trace is exported as a span with one child span per stage, through the
+      tracer provider configured for the process (e.g. by
+      `opentelemetry-instrument`).
+
+    Without either, traces are only kept for display.
+
+    Args:
+        app (str): Name of the app, a label of every metric.
+        prometheus_port (int, optional): Port of the metrics endpoint. Default: None.
+        opentelemetry (bool, optional): Export OpenTelemetry spans. Default: False.
+    """
+
+    def __init__(self, app: str, prometheus_port: Optional[int] = None, opentelemetry: bool = False):
+        self.app = app
+        self._metrics = None
+        if prometheus_port is not None and prometheus_client is not None:
+            self._metrics = {
+                "stage": prometheus_client.Histogram(
+                    "cookbook_stage_seconds", "Self time of each stage", ["app", "stage"]
+                ),
+                "request": prometheus_client.Histogram(
+                    "cookbook_request_seconds", "Duration of each request", ["app", "name"]
+                ),
+                "count": prometheus_client.Counter(
+                    "cookbook_events", "Token and other counts", ["app", "name"]
+                ),
+                "cache": prometheus_client.Counter(
+                    "cookbook_cache_lookups", "Cache lookups", ["app", "cache", "result"]
+                ),
+                "error": prometheus_client.Counter(
+                    "cookbook_errors", "Errors handled by the app", ["app", "stage", "type"]
+                ),
+            }
+            prometheus_client.start_http_server(prometheus_port)
+        self._otel = None
+        if opentelemetry and otel_trace is not None:
+            self._otel = otel_trace.get_tracer(f"cookbook.{app}")
+
+    def start_trace(self, name: str) -> Trace:
+        return Trace(name, tracer=self)
+
+    def export(self, trace: Trace):
+        if self._metrics is not None:
+            for record in trace.stages:
+                if "self_duration" in record:
+                    self._metrics["stage"].labels(self.app, record["name"]).observe(
+                        record["self_duration"]
+                    )
+            self._metrics["request"].labels(self.app, trace.name).observe(trace.duration)
+            for name, value in trace.counts.items():
+                self._metrics["count"].labels(self.app, name).inc(value)
+            for name, lookups in trace.cache_lookups.items():
+                for result, value in lookups.items():
+                    self._metrics["cache"].labels(self.app, name, result).inc(value)
+            for record in trace.errors:
+                self._metrics["error"].labels(self.app, record["stage"], record["type"]).inc()
+        if self._otel is not None:
+            self._export_spans(trace)
+
+    def _export_spans(self, trace: Trace):
+        def ns(seconds: float) -> int:
+            return int(seconds * 1e9)
+
+        root = self._otel.start_span(
+            trace.name, start_time=ns(trace.start_time), attributes={"app": self.app}
+        )
+        for name, value in trace.counts.items():
+            root.set_attribute(f"count.{name}", value)
+        for name, lookups in trace.cache_lookups.items():
+            root.set_attribute(f"cache.{name}.hit", lookups["hit"])
+            root.set_attribute(f"cache.{name}.miss", lookups["miss"])
+        for record in trace.errors:
+            root.add_event(
+                "exception",
+                attributes={
+                    "stage": record["stage"],
+                    "exception.type": record["type"],
+                    "exception.message": record["message"],
+                },
+                timestamp=ns(trace.start_time + record["offset"]),
+            )
+
+        spans = {}
+        for record in trace.stages:
+            if "duration" not in record:
+                continue
+            parent = spans.get(record["parent"], root)
+            span = self._otel.start_span(
+                record["name"],
+                context=otel_trace.set_span_in_context(parent),
+                start_time=ns(trace.start_time + record["offset"]),
+                attributes={
+                    key: value
+                    for key, value in record["attributes"].items()
+                    if isinstance(value, (str, bool, int, float))
+                },
+            )
+            span.end(end_time=ns(trace.start_time + record["offset"] + record["duration"]))
+            spans[record["index"]] = span
+        root.end(end_time=ns(trace.start_time + trace.duration))
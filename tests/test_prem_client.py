@@ -0,0 +1,97 @@
+"""Retries of the shared Prem client on streamed chat completions.
+
+The copies of `prem_client.py` are identical (see `test_shared_modules.py`),
+so the one of arxiv-ml-qna is tested.
+"""
+
+import sys
+import json
+import inspect
+from types import SimpleNamespace
+from pathlib import Path
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+premai = pytest.importorskip("premai")
+from premai.api.chat_completions.v1_chat_completions_create import (  # noqa: E402
+    ChatCompletionResponseStreamContainer,
+)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "arxiv-ml-qna"))
+from prem_client import RateLimitedPrem  # noqa: E402
+
+CHUNK = {
+    "id": "chunk-1",
+    "model": "gpt-4o",
+    "object": "chat.completion.chunk",
+    "created": 1,
+    "choices": [{"index": 0, "delta": {"content": "Hello"}, "finish_reason": None}],
+}
+
+
+class FakeStreamingPrem:
+    """Returns the lazy stream container of premai, over one response per call."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        status_code, body = self.responses[min(self.calls, len(self.responses) - 1)]
+        self.calls += 1
+        transport = httpx.MockTransport(lambda request: httpx.Response(status_code, content=body))
+        http_client = httpx.Client(transport=transport, base_url="https://app.premai.io")
+        return ChatCompletionResponseStreamContainer(
+            http_client.stream("POST", "/v1/chat/completions", json=kwargs)
+        )
+
+
+def test_premai_stream_container_wraps_the_stream_in_stream():
+    # open_premai_stream sends the request through this private attribute,
+    # an upgrade of the pinned premai which changes it has to update it
+    http_client = httpx.Client(transport=httpx.MockTransport(lambda request: httpx.Response(200)))
+    stream = http_client.stream("POST", "https://app.premai.io/v1/chat/completions")
+    container = ChatCompletionResponseStreamContainer(stream)
+
+    assert list(inspect.signature(ChatCompletionResponseStreamContainer).parameters) == ["stream"]
+    assert container._stream is stream
+
+
+def stream_chat(client):
+    response = client.chat.completions.create(
+        project_id=1, messages=[{"role": "user", "content": "Hi"}], stream=True
+    )
+    return [chunk.choices[0].delta["content"] for chunk in response]
+
+
+def test_streamed_chat_is_retried_after_429():
+    fake = FakeStreamingPrem(
+        (429, b'{"detail": "Rate limit exceeded"}'),
+        (200, f"data: {json.dumps(CHUNK)}\n\n".encode()),
+    )
+    client = RateLimitedPrem(fake, base_delay=0.0)
+
+    assert stream_chat(client) == ["Hello"]
+    assert fake.calls == 2
+    assert client.stats()["retries"] == 1
+
+
+def test_streamed_chat_raises_on_client_error():
+    fake = FakeStreamingPrem((401, b'{"detail": "Invalid API key"}'))
+    client = RateLimitedPrem(fake, base_delay=0.0)
+
+    with pytest.raises(premai.errors.UnexpectedStatus) as error:
+        stream_chat(client)
+    assert error.value.status_code == 401
+    assert fake.calls == 1
+
+
+def test_streamed_chat_gives_up_after_max_retries():
+    fake = FakeStreamingPrem((503, b"Service Unavailable"))
+    client = RateLimitedPrem(fake, max_retries=2, base_delay=0.0)
+
+    with pytest.raises(premai.errors.UnexpectedStatus):
+        stream_chat(client)
+    assert fake.calls == 3
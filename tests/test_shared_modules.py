@@ -0,0 +1,38 @@
+"""Every recipe runs on its own, so the helper modules they share are copied
+into each recipe directory instead of imported. These tests fail as soon as
+one copy is changed without the others.
+
+    python -m pytest tests
+"""
+
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Module -> recipe directories holding a copy of it
+SHARED_MODULES = {
+    "tracing.py": ["arxiv-ml-qna", "chat-with-pdf", "chat-with-sql", "url-summarizer"],
+    "embedding_store.py": ["arxiv-ml-qna", "chat-with-sql"],
+    "prem_client.py": ["arxiv-ml-qna", "chat-with-pdf", "chat-with-sql", "url-summarizer"],
+    "streaming.py": ["arxiv-ml-qna", "chat-with-pdf", "chat-with-sql"],
+}
+
+
+@pytest.mark.parametrize("module", sorted(SHARED_MODULES))
+def test_copies_are_identical(module):
+    recipes = SHARED_MODULES[module]
+    copies = {recipe: (ROOT / recipe / module).read_bytes() for recipe in recipes}
+    reference = copies[recipes[0]]
+    drifted = [recipe for recipe, content in copies.items() if content != reference]
+    assert not drifted, (
+        f"{module} of {', '.join(drifted)} differs from the one of {recipes[0]}, "
+        "make the same change in every copy"
+    )
+
+
+def test_every_copy_is_listed():
+    for module, recipes in SHARED_MODULES.items():
+        found = sorted(path.parent.name for path in ROOT.glob(f"*/{module}"))
+        assert found == sorted(recipes), f"Copies of {module}: {found}, listed: {recipes}"
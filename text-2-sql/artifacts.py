@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import hashlib
+from typing import Callable, Dict, List, Optional
+
+import dspy
+
+# Artifacts written with another format version are compiled again
+FORMAT_VERSION = 1
+
+
+def trainset_hash(trainset: List[dspy.Example]) -> str:
+    content = json.dumps(
+        [
+            {"example": example.toDict(), "inputs": sorted(example.inputs().keys())}
+            for example in trainset
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def program_hash(program: dspy.Module) -> str:
+    """Hash of the signature of every predictor of `program`, instructions and fields included."""
+    content = json.dumps(
+        [
+            {
+                "predictor": name,
+                "instructions": predictor.signature.instructions,
+                "fields": {
+                    field_name: field.json_schema_extra
+                    for field_name, field in predictor.signature.fields.items()
+                },
+            }
+            for name, predictor in program.named_predictors()
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def artifact_key(
+    program_name: str,
+    optimizer_name: str,
+    optimizer_config: dict,
+    trainset_digest: str,
+    program_digest: str,
+) -> str:
+    content = json.dumps(
+        {
+            "format_version": FORMAT_VERSION,
+            "program": program_name,
+            "program_hash": program_digest,
+            "optimizer": optimizer_name,
+            "config": optimizer_config,
+            "trainset": trainset_digest,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def to_jsonable(value):
+    if hasattr(value, "toDict"):
+        return value.toDict()
+    return str(value)
+
+
+def save_json_atomic(path: str, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2, default=to_jsonable)
+    os.replace(tmp_path, path)
+
+
+# ------ Compiled program artifacts ------ #
+
+
+class ArtifactStore:
+    """Compiled program states on disk, one versioned directory per artifact.
+
+    An artifact is keyed by the program and the hash of its signatures, the
+    optimizer and its config, and the hash of the trainset, so compiling the
+    same program on the same data happens once, and editing a signature or
+    its instructions compiles it again. Each artifact directory holds the program state (the
+    `Module.dump_state` of dspy) and a manifest, and `aliases.json` maps
+    names such as `"few_shot_k4"` to the last artifact saved under that
+    name, which is what the serving entry point loads.
+
+    Args:
+        root_dir (str): Directory of the artifacts. Default: `".artifacts"`.
+    """
+
+    def __init__(self, root_dir: str = ".artifacts"):
+        os.makedirs(root_dir, exist_ok=True)
+        self.root_dir = root_dir
+        self._aliases_path = os.path.join(root_dir, "aliases.json")
+
+    def _paths(self, key: str) -> Dict[str, str]:
+        artifact_dir = os.path.join(self.root_dir, key)
+        return {
+            "dir": artifact_dir,
+            "program": os.path.join(artifact_dir, "program.json"),
+            "manifest": os.path.join(artifact_dir, "manifest.json"),
+        }
+
+    def aliases(self) -> Dict[str, str]:
+        if not os.path.exists(self._aliases_path):
+            return {}
+        with open(self._aliases_path) as f:
+            return json.load(f)
+
+    def resolve(self, name_or_key: str) -> str:
+        return self.aliases().get(name_or_key, name_or_key)
+
+    def manifest(self, name_or_key: str) -> Optional[dict]:
+        path = self._paths(self.resolve(name_or_key))["manifest"]
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        return manifest if manifest.get("format_version") == FORMAT_VERSION else None
+
+    def exists(self, name_or_key: str) -> bool:
+        return self.manifest(name_or_key) is not None
+
+    def save(self, key: str, program: dspy.Module, manifest: dict, alias: Optional[str] = None):
+        paths = self._paths(key)
+        os.makedirs(paths["dir"], exist_ok=True)
+        save_json_atomic(paths["program"], program.dump_state())
+        # The manifest is written last, an artifact without one is incomplete
+        save_json_atomic(
+            paths["manifest"],
+            {**manifest, "key": key, "format_version": FORMAT_VERSION, "created_at": time.time()},
+        )
+        if alias is not None:
+            save_json_atomic(self._aliases_path, {**self.aliases(), alias: key})
+
+    def load(self, name_or_key: str, program: dspy.Module) -> dspy.Module:
+        """Loads the state of an artifact into `program` and returns it."""
+        key = self.resolve(name_or_key)
+        if not self.exists(key):
+            raise FileNotFoundError(f"No artifact {name_or_key!r} in {self.root_dir}")
+        with open(self._paths(key)["program"]) as f:
+            program.load_state(json.load(f))
+        # load_state leaves the demos as dicts
+        for predictor in program.predictors():
+            predictor.demos = [
+                dspy.Example(**demo) if isinstance(demo, dict) else demo
+                for demo in predictor.demos
+            ]
+        return program
+
+    def compile_or_load(
+        self,
+        student: dspy.Module,
+        optimizer_factory: Callable,
+        optimizer_config: dict,
+        trainset: List[dspy.Example],
+        alias: Optional[str] = None,
+    ) -> dspy.Module:
+        """`optimizer_factory(**optimizer_config).compile(student, trainset=...)`, or its saved result."""
+        optimizer_name = getattr(optimizer_factory, "__name__", str(optimizer_factory))
+        trainset_digest = trainset_hash(trainset)
+        program_digest = program_hash(student)
+        key = artifact_key(
+            type(student).__name__, optimizer_name, optimizer_config, trainset_digest, program_digest
+        )
+        if self.exists(key):
+            program = self.load(key, student.reset_copy())
+            if alias is not None and self.aliases().get(alias) != key:
+                save_json_atomic(self._aliases_path, {**self.aliases(), alias: key})
+            return program
+
+        program = optimizer_factory(**optimizer_config).compile(student, trainset=trainset)
+        self.save(
+            key,
+            program,
+            manifest={
+                "program": type(student).__name__,
+                "program_hash": program_digest,
+                "optimizer": optimizer_name,
+                "optimizer_config": optimizer_config,
+                "trainset_hash": trainset_digest,
+                "trainset_size": len(trainset),
+                "dspy_version": getattr(dspy, "__version__", None),
+            },
+            alias=alias,
+        )
+        return program
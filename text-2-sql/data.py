@@ -0,0 +1,105 @@
+import os
+import json
+import random
+import hashlib
+from typing import Dict, List, Optional
+
+import dspy
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DATASET_NAME = "gretelai/synthetic_text_to_sql"
+FIELDS = ("sql_prompt", "sql_context", "sql")
+INPUT_KEYS = ("sql_prompt", "sql_context")
+SPLITS = ("train", "val", "test")
+
+
+def sample(dataset: List[dspy.Example], n: Optional[int], seed: int) -> List[dspy.Example]:
+    if n is None or n >= len(dataset):
+        return list(dataset)
+    return random.Random(seed).sample(dataset, n)
+
+
+# ------ Split snapshots ------ #
+
+
+def snapshot_dir_for(root_dir: str, config: dict) -> str:
+    key = hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(root_dir, key)
+
+
+def save_snapshot(snapshot_dir: str, splits: Dict[str, List[dspy.Example]], config: dict):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    for name, examples in splits.items():
+        table = pa.Table.from_pylist(
+            [{field: example[field] for field in FIELDS} for example in examples],
+            schema=pa.schema([(field, pa.string()) for field in FIELDS]),
+        )
+        pq.write_table(table, os.path.join(snapshot_dir, f"{name}.parquet"))
+    # Written last, a snapshot without it is incomplete
+    with open(os.path.join(snapshot_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def load_snapshot(snapshot_dir: str) -> Optional[Dict[str, List[dspy.Example]]]:
+    if not os.path.exists(os.path.join(snapshot_dir, "config.json")):
+        return None
+    return {
+        name: [
+            dspy.Example(**row).with_inputs(*INPUT_KEYS)
+            for row in pq.read_table(os.path.join(snapshot_dir, f"{name}.parquet")).to_pylist()
+        ]
+        for name in SPLITS
+    }
+
+
+def load_splits(
+    train_size: int = 100,
+    test_size: Optional[int] = 75,
+    val_fraction: float = 0.25,
+    seed: int = 1399,
+    snapshot_root: Optional[str] = ".splits",
+) -> Dict[str, List[dspy.Example]]:
+    """Samples the train, val and test splits used in the notebook.
+
+    `test_size=None` keeps the whole test split. The samples only depend on
+    `seed`, so two runs evaluate the same examples. They are saved as Parquet
+    files under `snapshot_root`, keyed by the sampling settings, and later
+    calls read them back without loading the dataset from HuggingFace.
+    """
+    config = {
+        "dataset": DATASET_NAME,
+        "train_size": train_size,
+        "test_size": test_size,
+        "val_fraction": val_fraction,
+        "seed": seed,
+    }
+    if snapshot_root:
+        snapshot_dir = snapshot_dir_for(snapshot_root, config)
+        splits = load_snapshot(snapshot_dir)
+        if splits is not None:
+            return splits
+
+    # Only imported when the splits are not in a snapshot, it loads `datasets`
+    from dspy.datasets import DataLoader
+
+    data_loader = DataLoader()
+    trainset = data_loader.from_huggingface(
+        dataset_name=DATASET_NAME, fields=FIELDS, input_keys=INPUT_KEYS, split="train"
+    )
+    testset = data_loader.from_huggingface(
+        dataset_name=DATASET_NAME, fields=FIELDS, input_keys=INPUT_KEYS, split="test"
+    )
+
+    trainset = sample(trainset, train_size, seed)
+    _trainval = data_loader.train_test_split(
+        dataset=trainset, test_size=val_fraction, random_state=seed
+    )
+    splits = {
+        "train": _trainval["train"],
+        "val": _trainval["test"],
+        "test": sample(testset, test_size, seed),
+    }
+    if snapshot_root:
+        save_snapshot(snapshot_dir, splits, config)
+    return splits
@@ -0,0 +1,322 @@
+"""Concurrent evaluation of Text2SQLProgram.
+
+Example, sweeping the number of few shot examples over the whole test split:
+
+    PREMAI_API_KEY=... PREMAI_PROJECT_ID=... python evaluation.py --split test --test-size 0 --k 0 2 4 8
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import dspy
+from dspy.teleprompt import LabeledFewShot
+
+from artifacts import ArtifactStore
+from data import load_splits
+from program import Text2SQLProgram, compare_sqls, format_sql
+from sql_sandbox import ExecutionMetric
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def to_jsonable(value):
+    if hasattr(value, "toDict"):
+        return value.toDict()
+    return str(value)
+
+
+def program_fingerprint(program: dspy.Module, lm=None) -> str:
+    """Hash of what decides the LM outputs of `program`: signatures, demos and LM settings."""
+    lm = lm or dspy.settings.lm
+    content = json.dumps(
+        {
+            "signatures": [repr(predictor.signature) for predictor in program.predictors()],
+            "state": program.dump_state(),
+            "lm": {
+                "class": type(lm).__name__,
+                "model": getattr(lm, "model", None),
+                "kwargs": getattr(lm, "kwargs", {}),
+            },
+        },
+        sort_keys=True,
+        default=to_jsonable,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+# ------ Rate limiting and prediction cache ------ #
+
+
+class RateLimiter:
+    """Spaces out calls evenly, at most `requests_per_minute`, across threads."""
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+class PredictionCache:
+    """Outputs of a program on disk, keyed by (program fingerprint, inputs).
+
+    Running the same program on the same examples again, e.g. a sweep which
+    revisits a setting, does not call the LM at all.
+
+    Args:
+        cache_dir (str): Directory of the sqlite file. Default: `".lm_cache"`.
+    """
+
+    def __init__(self, cache_dir: str = ".lm_cache"):
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, "predictions.sqlite"), check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, outputs TEXT)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(fingerprint: str, inputs: dict) -> str:
+        content = json.dumps({"program": fingerprint, "inputs": inputs}, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT outputs FROM predictions WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, outputs: dict):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO predictions (key, outputs) VALUES (?, ?)",
+                (key, json.dumps(outputs, default=str)),
+            )
+            self._db.commit()
+
+
+# ------ Evaluation ------ #
+
+
+@dataclass
+class EvaluationReport:
+    name: str
+    num_examples: int
+    score: float
+    num_errors: int
+    cache_hits: int
+    wall_seconds: float
+    throughput: float
+    latency_p50: Optional[float]
+    latency_p90: Optional[float]
+    latency_p99: Optional[float]
+    # Number of errors of each exception type, and the first few messages
+    error_types: Dict[str, int] = field(default_factory=dict)
+    first_errors: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def __str__(self) -> str:
+        latencies = ", ".join(
+            f"{name}={value:.2f}s"
+            for name, value in [
+                ("p50", self.latency_p50),
+                ("p90", self.latency_p90),
+                ("p99", self.latency_p99),
+            ]
+            if value is not None
+        )
+        return (
+            f"{self.name}: score={self.score:.2f}% on {self.num_examples} examples "
+            f"({self.num_errors} errors, {self.cache_hits} cached) in {self.wall_seconds:.1f}s, "
+            f"{self.throughput:.1f} examples/s, LM latency {latencies or 'n/a'}"
+        )
+
+
+def precompute_ground_truth(examples: List[dspy.Example]):
+    """Formats every ground truth SQL once, `compare_sqls` then finds it in the cache."""
+    for example in examples:
+        format_sql(example.sql)
+
+
+def evaluate_program(
+    program: dspy.Module,
+    examples: List[dspy.Example],
+    metric: Callable = compare_sqls,
+    num_threads: int = 8,
+    requests_per_minute: Optional[float] = None,
+    cache: Optional[PredictionCache] = None,
+    name: str = "program",
+    max_error_messages: int = 5,
+) -> EvaluationReport:
+    """Scores `program` on `examples` with a bounded thread pool.
+
+    Only the predictions missing from `cache` call the LM, and only those are
+    rate limited and counted in the latency percentiles. A prediction which
+    fails scores 0, its error is counted by type in the report, which keeps
+    the first `max_error_messages` messages. A metric with a `score_batch` method (e.g. ExecutionMetric)
+    scores all the predictions at once, after they are made.
+    """
+    precompute_ground_truth(examples)
+    limiter = RateLimiter(requests_per_minute) if requests_per_minute else None
+    fingerprint = program_fingerprint(program) if cache is not None else None
+
+    def predict(example: dspy.Example):
+        inputs = dict(example.inputs().items())
+        key = cache.make_key(fingerprint, inputs) if cache is not None else None
+        outputs = cache.get(key) if cache is not None else None
+        if outputs is not None:
+            return dspy.Prediction(**outputs), None
+        if limiter is not None:
+            limiter.acquire()
+        start = time.perf_counter()
+        prediction = program(**inputs)
+        latency = time.perf_counter() - start
+        if cache is not None:
+            cache.put(key, dict(prediction.items()))
+        return prediction, latency
+
+    scores, latencies, num_errors = [], [], 0
+    predicted, error_types, first_errors = [], {}, []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {executor.submit(predict, example): example for example in examples}
+        for future in as_completed(futures):
+            try:
+                prediction, latency = future.result()
+                if not hasattr(metric, "score_batch"):
+                    scores.append(float(metric(futures[future], prediction)))
+            except Exception as e:
+                num_errors += 1
+                error_types[type(e).__name__] = error_types.get(type(e).__name__, 0) + 1
+                if len(first_errors) < max_error_messages:
+                    first_errors.append(f"{type(e).__name__}: {e}")
+                scores.append(0.0)
+                continue
+            predicted.append((futures[future], prediction))
+            if latency is not None:
+                latencies.append(latency)
+    if hasattr(metric, "score_batch") and predicted:
+        scores.extend(float(score) for score in metric.score_batch(*zip(*predicted)))
+    wall_seconds = time.perf_counter() - start
+
+    return EvaluationReport(
+        name=name,
+        num_examples=len(examples),
+        score=100 * sum(scores) / max(len(scores), 1),
+        num_errors=num_errors,
+        cache_hits=len(examples) - num_errors - len(latencies),
+        wall_seconds=wall_seconds,
+        throughput=len(examples) / max(wall_seconds, 1e-9),
+        latency_p50=percentile(latencies, 50),
+        latency_p90=percentile(latencies, 90),
+        latency_p99=percentile(latencies, 99),
+        error_types=error_types,
+        first_errors=first_errors,
+    )
+
+
+def few_shot_programs(
+    trainset: List[dspy.Example], ks: List[int], store: Optional[ArtifactStore] = None
+) -> Dict[str, dspy.Module]:
+    """Zero shot and LabeledFewShot programs, compiled once when `store` is given."""
+    text2sql = Text2SQLProgram()
+    programs = {}
+    for k in ks:
+        if k == 0:
+            programs["zero_shot"] = text2sql
+        elif store is not None:
+            programs[f"few_shot_k{k}"] = store.compile_or_load(
+                text2sql, LabeledFewShot, {"k": k}, trainset, alias=f"few_shot_k{k}"
+            )
+        else:
+            programs[f"few_shot_k{k}"] = LabeledFewShot(k=k).compile(
+                student=text2sql, trainset=trainset
+            )
+    return programs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate Text2SQLProgram on gretelai/synthetic_text_to_sql")
+    parser.add_argument("--split", choices=["val", "test"], default="val")
+    parser.add_argument("--train-size", type=int, default=100)
+    parser.add_argument("--test-size", type=int, default=75, help="0 for the whole test split")
+    parser.add_argument("--k", type=int, nargs="+", default=[0, 4], help="few shot examples, 0 for none")
+    parser.add_argument(
+        "--metric",
+        choices=["string", "execution"],
+        default="string",
+        help="compare the formatted SQL, or the results of running it on SQLite",
+    )
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--rpm", type=float, default=None, help="max LM requests per minute")
+    parser.add_argument("--cache-dir", default=".lm_cache", help="'' to disable the prediction cache")
+    parser.add_argument("--splits-dir", default=".splits", help="'' to always sample from HuggingFace")
+    parser.add_argument("--artifacts-dir", default=".artifacts", help="'' to always compile")
+    parser.add_argument("--output", default=None, help="write the reports to this JSON file")
+    args = parser.parse_args()
+
+    generation_kwargs = {"temperature": 0.1, "max_tokens": 1000}
+    lm = dspy.PremAI(
+        project_id=os.environ["PREMAI_PROJECT_ID"],
+        api_key=os.environ["PREMAI_API_KEY"],
+        **generation_kwargs,
+    )
+    dspy.configure(lm=lm)
+
+    splits = load_splits(
+        train_size=args.train_size,
+        test_size=args.test_size or None,
+        snapshot_root=args.splits_dir or None,
+    )
+    cache = PredictionCache(args.cache_dir) if args.cache_dir else None
+    store = ArtifactStore(args.artifacts_dir) if args.artifacts_dir else None
+    metric = ExecutionMetric() if args.metric == "execution" else compare_sqls
+
+    reports = []
+    for name, program in few_shot_programs(splits["train"], args.k, store).items():
+        report = evaluate_program(
+            program,
+            splits[args.split],
+            metric=metric,
+            num_threads=args.threads,
+            requests_per_minute=args.rpm,
+            cache=cache,
+            name=name,
+        )
+        print(report)
+        for message in report.first_errors:
+            print(f"  Error: {message}")
+        reports.append(report.to_dict())
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
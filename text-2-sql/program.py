@@ -0,0 +1,69 @@
+import re
+from functools import lru_cache
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+import dspy
+import sqlparse
+
+
+class Text2SQLSignature(dspy.Signature):
+    """Transform a natural language query into a SQL query.
+    You will be given the sql_prompt which will tell what you need to do
+    and a sql_context which will give some additional context to generate the right SQL.
+    Only generate the SQL query nothing else. You should give one correct answer.
+    starting and ending with ```
+    """
+
+    sql_prompt = dspy.InputField(desc="Natural language query")
+    sql_context = dspy.InputField(desc="Context for the query")
+    sql = dspy.OutputField(desc="SQL Query")
+
+
+class Text2SQLProgram(dspy.Module):
+    def __init__(self, signature: dspy.Signature = Text2SQLSignature):
+        super().__init__()
+        self.program = dspy.Predict(signature=signature)
+
+    def forward(self, sql_prompt, sql_context):
+        return self.program(sql_prompt=sql_prompt, sql_context=sql_context)
+
+    def forward_batch(
+        self, inputs: List[dict], max_workers: int = 8, return_exceptions: bool = False
+    ) -> list:
+        """Runs `forward` on many `{"sql_prompt", "sql_context"}` inputs concurrently.
+
+        Results are in the order of `inputs`. With `return_exceptions`, a failed
+        input gets its exception in place of the prediction.
+        """
+
+        def forward(example):
+            try:
+                return self(sql_prompt=example["sql_prompt"], sql_context=example["sql_context"])
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(forward, inputs))
+
+
+# ------ String based SQL comparison ------ #
+
+
+def normalise_sql_string(sql_string):
+    normalized = re.sub(r"```", "", sql_string).strip()
+    return re.sub(r"\s+", " ", normalized)
+
+
+@lru_cache(maxsize=100_000)
+def format_sql(sql_string):
+    """Normalised and `sqlparse` formatted SQL, computed once per distinct string."""
+    return sqlparse.format(
+        normalise_sql_string(sql_string=sql_string), reindent=True, keyword_case="upper"
+    ).strip()
+
+
+def compare_sqls(ground_truth, prediction, trace=None):
+    return format_sql(ground_truth.sql) == format_sql(prediction.sql)
@@ -0,0 +1,60 @@
+"""Serves a compiled Text2SQLProgram without compiling it again.
+
+Reads one JSON object per line on stdin, with `sql_prompt` and `sql_context`,
+and writes one JSON object per line with the generated `sql`:
+
+    echo '{"sql_prompt": "...", "sql_context": "..."}' | python serve.py --artifact few_shot_k4
+
+The artifacts are written by `evaluation.py`, see the README.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import dspy
+
+from artifacts import ArtifactStore
+from program import Text2SQLProgram
+
+
+def load_program(artifact: str, artifacts_dir: str = ".artifacts") -> Text2SQLProgram:
+    return ArtifactStore(artifacts_dir).load(artifact, Text2SQLProgram())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a compiled Text2SQLProgram")
+    parser.add_argument("--artifact", default="few_shot_k4", help="alias or key of the artifact")
+    parser.add_argument("--artifacts-dir", default=".artifacts")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    program = load_program(args.artifact, args.artifacts_dir)
+    print(f"Loaded {args.artifact} in {time.perf_counter() - start:.3f}s", file=sys.stderr)
+
+    generation_kwargs = {"temperature": 0.1, "max_tokens": 1000}
+    lm = dspy.PremAI(
+        project_id=os.environ["PREMAI_PROJECT_ID"],
+        api_key=os.environ["PREMAI_API_KEY"],
+        **generation_kwargs,
+    )
+    dspy.configure(lm=lm)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        try:
+            prediction = program(
+                sql_prompt=request["sql_prompt"], sql_context=request.get("sql_context", "")
+            )
+            response = {"sql": prediction.sql}
+        except Exception as e:
+            response = {"error": str(e)}
+        print(json.dumps(response), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+
+from program import compare_sqls
+
+# Compiled contexts kept by each worker process
+_contexts: "OrderedDict[str, sqlite3.Connection]" = OrderedDict()
+_contexts_lock = threading.Lock()
+
+
+def extract_sql(sql_string: str) -> str:
+    """SQL of a prediction, without the ``` fences and the `sql` language tag."""
+    sql_string = re.sub(r"```(?:sql|sqlite)?", "", sql_string, flags=re.IGNORECASE)
+    return sql_string.strip()
+
+
+def context_key(sql_context: str) -> str:
+    return hashlib.sha1(sql_context.encode("utf-8")).hexdigest()
+
+
+def compile_context(sql_context: str, max_contexts: int = 256) -> sqlite3.Connection:
+    """In-memory database with the tables and rows of `sql_context`, built once per context."""
+    key = context_key(sql_context)
+    with _contexts_lock:
+        if key in _contexts:
+            _contexts.move_to_end(key)
+            return _contexts[key]
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+        try:
+            connection.executescript(sql_context)
+        except sqlite3.Error:
+            connection.close()
+            raise
+        _contexts[key] = connection
+        if len(_contexts) > max_contexts:
+            _contexts.popitem(last=False)[1].close()
+        return connection
+
+
+def normalize_value(value):
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+def run_query(
+    sql_context: str, sql: str, timeout_ms: int = 2000, max_rows: int = 10_000
+) -> Counter:
+    """Multiset of the rows returned by `sql` on a fresh copy of the context database.
+
+    The copy is restored from the compiled context, so a statement which
+    writes can not change the database of the next query.
+    """
+    connection = sqlite3.connect(":memory:")
+    try:
+        context = compile_context(sql_context)
+        with _contexts_lock:
+            context.backup(connection)
+        deadline = time.monotonic() + timeout_ms / 1000
+        # A non zero return value interrupts the statement
+        connection.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        cursor = connection.execute(sql)
+        rows = cursor.fetchmany(max_rows + 1)
+        if len(rows) > max_rows:
+            raise sqlite3.OperationalError(f"More than {max_rows} rows")
+        return Counter(tuple(normalize_value(value) for value in row) for row in rows)
+    finally:
+        connection.close()
+
+
+def execution_match(
+    sql_context: str, ground_truth: str, prediction: str, timeout_ms: int = 2000
+) -> Tuple[Optional[bool], Optional[str]]:
+    """Whether both queries return the same rows, ignoring their order.
+
+    Returns `(None, error)` when the context or the ground truth does not run
+    on SQLite, the example can then not be scored by execution.
+    """
+    try:
+        expected = run_query(sql_context, extract_sql(ground_truth), timeout_ms)
+    except sqlite3.Error as e:
+        return None, f"ground truth: {e}"
+    try:
+        predicted = run_query(sql_context, extract_sql(prediction), timeout_ms)
+    except (sqlite3.Error, sqlite3.Warning) as e:
+        return False, f"prediction: {e}"
+    return expected == predicted, None
+
+
+def _execution_match_job(job: Tuple[str, str, str, int]) -> Tuple[Optional[bool], Optional[str]]:
+    return execution_match(*job)
+
+
+# ------ Execution based metric ------ #
+
+
+class ExecutionMetric:
+    """Execution based accuracy, the predicted and ground truth SQL run on SQLite.
+
+    Each example's `sql_context` (its CREATE TABLE and INSERT statements) is
+    loaded into an in-memory SQLite database, compiled once per distinct
+    context and worker process. Both queries run with a timeout and their
+    results are compared as multisets of rows, so equivalent queries written
+    differently match. Examples whose context or ground truth does not run on
+    SQLite fall back to `compare_sqls`.
+
+    The instance is a dspy metric, `score_batch` scores many predictions in
+    a process pool.
+
+    Args:
+        timeout_ms (int): Timeout of each query. Default: 2000.
+        max_workers (int): Worker processes of `score_batch`. Default: number of CPUs.
+    """
+
+    def __init__(self, timeout_ms: int = 2000, max_workers: Optional[int] = None):
+        self.timeout_ms = timeout_ms
+        self.max_workers = max_workers
+        self.fallbacks = 0
+
+    def _score(self, example, prediction, match: Optional[bool]) -> bool:
+        if match is None:
+            self.fallbacks += 1
+            return compare_sqls(example, prediction)
+        return match
+
+    def __call__(self, example, prediction, trace=None) -> bool:
+        match, _ = execution_match(
+            example.sql_context, example.sql, prediction.sql, self.timeout_ms
+        )
+        return self._score(example, prediction, match)
+
+    def score_batch(self, examples: List, predictions: List) -> List[bool]:
+        jobs = [
+            (example.sql_context, example.sql, prediction.sql, self.timeout_ms)
+            for example, prediction in zip(examples, predictions)
+        ]
+        # Examples sharing a context are sent together, to the same worker
+        order = sorted(range(len(jobs)), key=lambda idx: jobs[idx][0])
+        chunksize = max(1, len(jobs) // (4 * (self.max_workers or 8)))
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(
+                executor.map(_execution_match_job, [jobs[idx] for idx in order], chunksize=chunksize)
+            )
+        matches = [None] * len(jobs)
+        for idx, (match, _) in zip(order, results):
+            matches[idx] = match
+        return [
+            self._score(example, prediction, match)
+            for example, prediction, match in zip(examples, predictions, matches)
+        ]
@@ -1,10 +1,15 @@
 import os
-import json
+import premai
 import streamlit as st
 from urllib.parse import urlparse
 from langchain_community.chat_models.premai import ChatPremAI
+from langchain_community.embeddings import PremAIEmbeddings
 
-from utils import summarize_url
+from utils import summarize_urls, get_index_chunks, answer_question
+from tracing import Tracer
+from prem_client import RateLimitedPrem
+from summary_cache import SummaryCache
+from url_index import UrlIndex
 
 # Some helper functions
 
@@ -18,40 +23,173 @@ def is_valid_url(url: str):
 
 
 def summarize_component(urls: list[str], client: ChatPremAI):
+    # Summaries of the passed urls, and the (url, error) of the failed ones
     passed, failed = [], []
-    with st.spinner("Please wait while we summarize the content"):
-        for url in urls:
-            if not is_valid_url(url):
-                failed.append(url)
-            else:
-                results = summarize_url(url, llm=client)
-                if results:
-                    passed.append(
-                        {
-                            "url": url,
-                            "document": results["input_documents"],
-                            "intermediate": results["intermediate_steps"],
-                            "summary": results["output_text"],
-                        }
-                    )
-                    with st.expander(label=f"URL: {url}"):
-                        st.write(results["output_text"])
-                else:
-                    failed.append(url)
+    valid_urls = []
+    for url in dict.fromkeys(urls):
+        if is_valid_url(url):
+            valid_urls.append(url)
+        else:
+            failed.append((url, "Invalid url"))
+
+    progress_text = "Please wait while we summarize the content"
+    progress_bar = st.progress(0, text=progress_text)
+
+    # Results are rendered in the order the urls finish, not the input order
+    for num_done, (url, results, error) in enumerate(
+        summarize_urls(
+            valid_urls,
+            llm=client,
+            max_concurrency=max_concurrency,
+            url_timeout=url_timeout,
+            max_workers=map_workers,
+            context_window=context_window,
+            cache=summary_cache,
+            tracer=tracer,
+        ),
+        start=1,
+    ):
+        progress_bar.progress(num_done / len(valid_urls), text=progress_text)
+        if results:
+            passed.append(
+                {
+                    "url": url,
+                    "document": results["input_documents"],
+                    "intermediate": results["intermediate_steps"],
+                    "summary": results["output_text"],
+                }
+            )
+            with st.expander(label=f"URL: {url}"):
+                st.write(results["output_text"])
+                st.caption(results["trace"].summary())
+                # Index the chunks and the summary which were just computed
+                trace = tracer.start_trace("index_url")
+                try:
+                    with trace.activate(), trace.stage("index"):
+                        url_index.add_url(
+                            url,
+                            chunks=get_index_chunks(results["input_documents"]),
+                            summary=results["output_text"],
+                            embed_fn=embeddings.embed_documents,
+                        )
+                except Exception as e:
+                    trace.error("index", e)
+                    st.warning(f"Failed to index, questions will not use this url: {e}")
+                finally:
+                    trace.finish()
+        else:
+            failed.append((url, str(error)))
 
-        if len(failed) > 0:
-            st.json(json.dumps(failed))
+    progress_bar.empty()
+    for url, error in failed:
+        with st.expander(label=f"URL: {url}"):
+            st.error(f"Failed to summarize: {error}")
     return passed, failed
 
 
+def qna_component(client: ChatPremAI):
+    st.markdown("#### Ask questions about the summarized urls")
+    if "messages" not in st.session_state:
+        st.session_state.messages = []
+
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+    if question := st.chat_input("Ask a question"):
+        st.session_state.messages.append({"role": "user", "content": question})
+        with st.chat_message("user"):
+            st.markdown(question)
+
+        with st.chat_message("assistant"):
+            trace = tracer.start_trace("qna")
+            try:
+                with trace.activate():
+                    hits, tokens = answer_question(
+                        question,
+                        llm=client,
+                        url_index=url_index,
+                        embeddings=embeddings,
+                        k=qna_top_k,
+                    )
+                    answer = st.write_stream(tokens)
+                trace.finish()
+                with st.expander(label="Sources"):
+                    for url in dict.fromkeys(hit["url"] for hit in hits):
+                        st.markdown(f"- [{url_index.urls[url]['title']}]({url})")
+                    st.caption(trace.summary())
+            except Exception as e:
+                trace.error("answer", e)
+                trace.finish()
+                answer = "Failed to respond"
+                st.error(f"{answer}: {e}")
+        st.session_state.messages.append({"role": "assistant", "content": answer})
+
+
 st.set_page_config(page_title="url summary and qna", page_icon="💬")
 
 # Set all the settings here
 # Please set a valid PROJECT ID when running this code
 premai_api_key = st.secrets.premai_api_key
 premai_project_id = 123456789
+# Number of urls summarized at the same time, and how long one url may take
+max_concurrency = 4
+url_timeout = 180
+# Concurrent map calls per url, and the context window of the Prem model
+map_workers = 4
+context_window = 8192
+# Embedding model of the url index, and the number of chunks used per answer
+embedding_model_name = "mistral-embed"
+qna_top_k = 4
+# Stage timings are exported as Prometheus metrics on this port (needs
+# `prometheus-client`) and as OpenTelemetry spans (needs `opentelemetry-api`)
+prometheus_port = None
+opentelemetry_enabled = False
+# Limits of the Prem client shared by every session, set them to the limits
+# of your Prem plan. Requests over them wait instead of failing with a 429
+prem_rate_limits = dict(requests_per_minute=300, tokens_per_minute=None)
 os.environ["PREMAI_API_KEY"] = premai_api_key
+
+
+# Rate limited, retried and coalesced across every session of this process
+@st.cache_resource
+def get_shared_prem_client() -> RateLimitedPrem:
+    return RateLimitedPrem(premai.Prem(api_key=premai_api_key), **prem_rate_limits)
+
+
+shared_prem_client = get_shared_prem_client()
+# The LangChain wrappers create their own client, it is replaced by the shared one
 prem_client = ChatPremAI(project_id=premai_project_id)
+prem_client.client = shared_prem_client
+
+
+# Pages, chunk summaries and final summaries are shared by every session
+@st.cache_resource
+def get_summary_cache() -> SummaryCache:
+    return SummaryCache(cache_dir=".summary_cache", ttl=3600)
+
+
+# The url index persists across sessions and restarts
+@st.cache_resource
+def get_url_index() -> UrlIndex:
+    return UrlIndex(index_dir=".url_index")
+
+
+# One tracer per process, the metrics endpoint can only be started once
+@st.cache_resource
+def get_tracer() -> Tracer:
+    return Tracer(
+        app="url-summarizer",
+        prometheus_port=prometheus_port,
+        opentelemetry=opentelemetry_enabled,
+    )
+
+
+summary_cache = get_summary_cache()
+tracer = get_tracer()
+url_index = get_url_index()
+embeddings = PremAIEmbeddings(project_id=premai_project_id, model=embedding_model_name)
+embeddings.client = shared_prem_client
 
 with st.sidebar:
     st.image("logo.png", use_column_width=True)
@@ -85,3 +223,6 @@ with st.form("Dump all URLs here"):
     if button:
         urls = [url.strip() for url in input_urls.split(",")]
         _, _ = summarize_component(urls=urls, client=prem_client)
+
+if len(url_index.urls) > 0:
+    qna_component(client=prem_client)
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Optional
+
+from langchain_core.documents import Document
+
+
+def content_hash(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def documents_to_json(docs: List[Document]) -> str:
+    return json.dumps(
+        [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+    )
+
+
+def documents_from_json(data: str) -> List[Document]:
+    return [Document(**doc) for doc in json.loads(data)]
+
+
+# ------ Summary cache ------ #
+
+
+class SummaryCache:
+    """Content addressed cache for fetched pages, chunk map outputs and summaries.
+
+    Three sqlite tables live in `cache_dir`:
+
+    - `pages`: url -> validators (ETag / Last-Modified), hash and loaded documents.
+      A page fetched less than `ttl` seconds ago is served without any request,
+      after that it is revalidated with a conditional GET.
+    - `maps`: hash of a chunk -> its map output, so a page which changed only
+      slightly sends only its changed chunks through the map step again.
+    - `summaries`: hash of the page content -> split chunks, map outputs and
+      the final summary.
+
+    Once the stored data grows over `max_bytes`, the least recently used rows
+    are evicted.
+    """
+
+    TABLES = ("pages", "maps", "summaries")
+
+    def __init__(self, cache_dir: str = ".summary_cache", ttl: float = 3600, max_bytes: int = 256 * 1024**2):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = {table: 0 for table in self.TABLES}
+        self.misses = {table: 0 for table in self.TABLES}
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, "cache.sqlite"), check_same_thread=False
+        )
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, hash TEXT,
+                documents TEXT, fetched_at REAL, size INTEGER, last_used REAL
+            );
+            CREATE TABLE IF NOT EXISTS maps (
+                key TEXT PRIMARY KEY, output TEXT, size INTEGER, last_used REAL
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                key TEXT PRIMARY KEY, split_documents TEXT, intermediate_steps TEXT,
+                output_text TEXT, size INTEGER, last_used REAL
+            );
+            """
+        )
+
+    def _get(self, table: str, key: str, columns: str) -> Optional[tuple]:
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {columns} FROM {table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses[table] += 1
+                return None
+            self.hits[table] += 1
+            self._db.execute(
+                f"UPDATE {table} SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+            return row
+
+    def _put(self, table: str, values: dict):
+        values = {**values, "last_used": time.time()}
+        values["size"] = sum(len(v) for v in values.values() if isinstance(v, str))
+        columns = ", ".join(values)
+        placeholders = ", ".join("?" * len(values))
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {table} ({columns}) VALUES ({placeholders})",
+                list(values.values()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = sum(
+            self._db.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+            for table in self.TABLES
+        )
+        while total > self.max_bytes:
+            oldest = min(
+                (row + (table,))
+                for table in self.TABLES
+                for row in self._db.execute(
+                    f"SELECT last_used, key, size FROM {table} ORDER BY last_used LIMIT 1"
+                )
+            )
+            last_used, key, size, table = oldest
+            self._db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            total -= size
+
+    # ---- pages ---- #
+
+    def get_page(self, url: str) -> Optional[dict]:
+        row = self._get("pages", url, "etag, last_modified, hash, documents, fetched_at")
+        if row is None:
+            return None
+        etag, last_modified, page_hash, documents, fetched_at = row
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "hash": page_hash,
+            "documents": documents_from_json(documents),
+            "fresh": time.time() - fetched_at < self.ttl,
+        }
+
+    def put_page(self, url: str, docs: List[Document], page_hash: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        self._put(
+            "pages",
+            {
+                "key": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "hash": page_hash,
+                "documents": documents_to_json(docs),
+                "fetched_at": time.time(),
+            },
+        )
+
+    def touch_page(self, url: str):
+        """Marks a page as revalidated, e.g. after a 304 Not Modified."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE pages SET fetched_at = ? WHERE key = ?", (time.time(), url)
+            )
+            self._db.commit()
+
+    # ---- map outputs ---- #
+
+    def get_map(self, key: str) -> Optional[str]:
+        row = self._get("maps", key, "output")
+        return None if row is None else row[0]
+
+    def put_map(self, key: str, output: str):
+        self._put("maps", {"key": key, "output": output})
+
+    # ---- summaries ---- #
+
+    def get_summary(self, key: str) -> Optional[dict]:
+        row = self._get("summaries", key, "split_documents, intermediate_steps, output_text")
+        if row is None:
+            return None
+        split_documents, intermediate_steps, output_text = row
+        return {
+            "input_documents": documents_from_json(split_documents),
+            "intermediate_steps": json.loads(intermediate_steps),
+            "output_text": output_text,
+        }
+
+    def put_summary(self, key: str, result: dict):
+        self._put(
+            "summaries",
+            {
+                "key": key,
+                "split_documents": documents_to_json(result["input_documents"]),
+                "intermediate_steps": json.dumps(result["intermediate_steps"]),
+                "output_text": result["output_text"],
+            },
+        )
+
+    def stats(self) -> dict:
+        return {"hits": dict(self.hits), "misses": dict(self.misses)}
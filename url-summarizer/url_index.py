@@ -0,0 +1,186 @@
+import os
+import json
+import threading
+from typing import Callable, List
+
+import numpy as np
+from langchain_core.documents import Document
+
+from summary_cache import content_hash
+
+VECTORS_FILE = "vectors.f32"
+CHUNKS_FILE = "chunks.jsonl"
+URLS_FILE = "urls.json"
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+# ------ URL index ------ #
+
+
+class UrlIndex:
+    """Persistent vector index over the chunks and summaries of summarized urls.
+
+    The index directory holds the L2-normalized embeddings as a raw float32
+    matrix, one JSON line per row and `urls.json`, which records the committed
+    row count and maps every url to the ids of its current rows. Rows are
+    identified by the hash of their content, so adding a url again only embeds
+    the chunks which are new. Rows of a previous version of a page stay in the
+    files but are skipped by `search`.
+
+    Args:
+        index_dir (str): Directory of the index. Default: `".url_index"`.
+    """
+
+    def __init__(self, index_dir: str = ".url_index"):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self._lock = threading.Lock()
+        self._vectors_path = os.path.join(index_dir, VECTORS_FILE)
+        self._chunks_path = os.path.join(index_dir, CHUNKS_FILE)
+        self._urls_path = os.path.join(index_dir, URLS_FILE)
+
+        self.dim, self.count, self.urls = None, 0, {}
+        if os.path.exists(self._urls_path):
+            with open(self._urls_path) as f:
+                meta = json.load(f)
+            self.dim, self.count, self.urls = meta["dim"], meta["count"], meta["urls"]
+
+        # Rows are only trusted up to the count committed in `urls.json`
+        self.chunks, self.row_by_id = [], {}
+        kept_bytes = 0
+        if os.path.exists(self._chunks_path):
+            with open(self._chunks_path, "rb") as f:
+                for line in f:
+                    if len(self.chunks) == self.count:
+                        break
+                    chunk = json.loads(line)
+                    self.row_by_id[chunk["id"]] = len(self.chunks)
+                    self.chunks.append(chunk)
+                    kept_bytes += len(line)
+        for path, size in [
+            (self._chunks_path, kept_bytes),
+            (self._vectors_path, self.count * (self.dim or 0) * 4),
+        ]:
+            with open(path, "ab") as f:
+                f.truncate(size)
+        # `vectors` is a view of the first `count` rows of a buffer with spare
+        # capacity, so adding rows does not copy the whole matrix every time
+        self._buffer = np.fromfile(self._vectors_path, dtype=np.float32).reshape(
+            self.count, self.dim or 0
+        )
+        self.vectors = self._buffer
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.urls
+
+    def add_url(
+        self,
+        url: str,
+        chunks: List[Document],
+        summary: str,
+        embed_fn: Callable[[List[str]], List[List[float]]],
+    ) -> int:
+        """Makes `chunks` and `summary` the searchable content of `url`.
+
+        Only the texts which are not in the index yet are passed to `embed_fn`.
+        Returns how many rows were embedded.
+        """
+        entries = [
+            {"url": url, "kind": "chunk", "text": chunk.page_content} for chunk in chunks
+        ]
+        entries.append({"url": url, "kind": "summary", "text": summary})
+        for entry in entries:
+            entry["id"] = content_hash(url, entry["kind"], entry["text"])
+
+        with self._lock:
+            new_entries = list(
+                {
+                    entry["id"]: entry
+                    for entry in entries
+                    if entry["id"] not in self.row_by_id
+                }.values()
+            )
+        vectors = None
+        if new_entries:
+            vectors = np.asarray(
+                embed_fn([entry["text"] for entry in new_entries]), dtype=np.float32
+            )
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            if vectors is not None:
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    self._buffer = self.vectors = self._buffer.reshape(0, self.dim)
+                if vectors.shape[1] != self.dim:
+                    raise ValueError(
+                        f"Expected embeddings of size {self.dim}, got {vectors.shape[1]}"
+                    )
+                # Another session may have added some of the rows meanwhile
+                keep = [
+                    idx
+                    for idx, entry in enumerate(new_entries)
+                    if entry["id"] not in self.row_by_id
+                ]
+                new_entries, vectors = [new_entries[idx] for idx in keep], vectors[keep]
+                with open(self._vectors_path, "ab") as f:
+                    f.write(vectors.tobytes())
+                with open(self._chunks_path, "a") as f:
+                    for entry in new_entries:
+                        self.row_by_id[entry["id"]] = len(self.chunks)
+                        self.chunks.append(entry)
+                        f.write(json.dumps(entry) + "\n")
+                self._append_vectors(vectors)
+                self.count = len(self.chunks)
+
+            self.urls[url] = {
+                "title": (chunks[0].metadata.get("title") if chunks else None) or url,
+                "ids": [entry["id"] for entry in entries],
+            }
+            tmp_path = f"{self._urls_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"dim": self.dim, "count": self.count, "urls": self.urls}, f)
+            os.replace(tmp_path, self._urls_path)
+            return len(new_entries)
+
+    def _append_vectors(self, vectors: np.ndarray):
+        n_rows = len(self.vectors) + len(vectors)
+        if n_rows > len(self._buffer):
+            # Doubling keeps the copies linear in the number of rows added
+            capacity = max(n_rows, 2 * len(self._buffer), 1024)
+            buffer = np.empty((capacity, self.dim), dtype=np.float32)
+            buffer[: len(self.vectors)] = self.vectors
+            self._buffer = buffer
+        self._buffer[len(self.vectors) : n_rows] = vectors
+        self.vectors = self._buffer[:n_rows]
+
+    def search(self, query_vector: List[float], k: int = 4) -> List[dict]:
+        """Returns the `k` rows most similar to the query, best first, with a `score`."""
+        with self._lock:
+            current_rows = np.array(
+                [
+                    self.row_by_id[row_id]
+                    for entry in self.urls.values()
+                    for row_id in entry["ids"]
+                    if row_id in self.row_by_id
+                ],
+                dtype=np.int64,
+            )
+            if len(current_rows) == 0:
+                return []
+            query = np.asarray(query_vector, dtype=np.float32)
+            query = query / max(np.linalg.norm(query), 1e-12)
+            scores = self.vectors[current_rows] @ query
+            top = _top_k(scores, k)
+            return [
+                {**self.chunks[current_rows[idx]], "score": float(scores[idx])}
+                for idx in top
+            ]
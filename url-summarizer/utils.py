@@ -1,11 +1,25 @@
-from langchain_community.document_loaders import WebBaseLoader
-from langchain_community.chat_models.premai import ChatPremAI
+import re
+import math
+import time
+import hashlib
+from typing import Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-from langchain.chains.llm import LLMChain
+import requests
+import tiktoken
+from bs4 import BeautifulSoup
+from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_community.document_loaders.web_base import default_header_template
+from langchain_community.chat_models.premai import ChatPremAI
+from langchain_community.embeddings import PremAIEmbeddings
 from langchain_text_splitters import CharacterTextSplitter
-from langchain.chains.combine_documents.stuff import StuffDocumentsChain
-from langchain.chains import MapReduceDocumentsChain, ReduceDocumentsChain
+
+import tracing
+from tracing import Tracer
+from summary_cache import SummaryCache, content_hash
+from url_index import UrlIndex
 
 map_template = """
 The following is a set of documents
@@ -31,44 +45,359 @@ that will help them. Include the following sub headings
 Helpful Answer:
 """
 
+qna_template = """
+The following are excerpts of web pages and summaries of them:
+{context}
+Answer the question using only these excerpts. If they do not contain the
+answer, say that you do not know. Mention the urls you used.
+Question: {question}
+Helpful Answer:
+"""
 
-def summarize_url(url: str, llm: ChatPremAI) -> dict:
-    # Step 1: Load the WebBasedLoader and CharacterTextSplitter to load and split documents
-    loader = WebBaseLoader(url)
-    docs = loader.load()
-    text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=1000, chunk_overlap=0
-    )
-    split_docs = text_splitter.split_documents(docs)
 
-    # Step 2: Get the prompts from prompt templates
-    map_prompt = PromptTemplate.from_template(template=map_template)
-    reduce_prompt = PromptTemplate.from_template(template=reduce_template)
+# Tokens kept free in the context window for the prompt template and the answer
+RESERVED_TOKENS = 1500
 
-    # Step 3: Make the map and reduce LLM chains
-    map_chain = LLMChain(llm=llm, prompt=map_prompt)
-    reduce_chain = LLMChain(llm=llm, prompt=reduce_prompt)
+encoding = tiktoken.get_encoding("cl100k_base")
 
-    # Step 4: Define `combined_document_chain` which combines all the summarized chunks
-    combined_documents_chain = StuffDocumentsChain(
-        llm_chain=reduce_chain, document_variable_name="docs"
-    )
 
-    # Step 5: Define `reduce_document_chain`
-    reduce_documents_chain = ReduceDocumentsChain(
-        combine_documents_chain=combined_documents_chain,
-        collapse_documents_chain=combined_documents_chain,
-        token_max=4000,
+def count_tokens(text: str) -> int:
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_documents(docs: List[Document], chunk_size: int) -> List[Document]:
+    """Content defined chunking over the paragraphs of the documents.
+
+    A chunk is cut after a paragraph whose hash hits a fixed pattern (once the
+    chunk is half full) or before it would overflow `chunk_size`. Boundaries
+    only depend on the nearby paragraphs, so editing one part of a page leaves
+    the chunks of the other parts, and their cached map outputs, unchanged.
+    """
+    fallback_splitter = CharacterTextSplitter.from_tiktoken_encoder(
+        chunk_size=chunk_size, chunk_overlap=0
     )
+    split_docs = []
+    for doc in docs:
+        chunk, chunk_tokens = [], 0
+
+        def flush():
+            nonlocal chunk, chunk_tokens
+            if chunk:
+                split_docs.append(
+                    Document(page_content="\n\n".join(chunk), metadata=doc.metadata)
+                )
+            chunk, chunk_tokens = [], 0
+
+        for paragraph in re.split(r"\n\s*\n", doc.page_content):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            paragraph_tokens = count_tokens(paragraph)
+            if paragraph_tokens > chunk_size:
+                flush()
+                split_docs.extend(
+                    fallback_splitter.split_documents(
+                        [Document(page_content=paragraph, metadata=doc.metadata)]
+                    )
+                )
+                continue
+
+            if chunk_tokens + paragraph_tokens > chunk_size:
+                flush()
+            chunk.append(paragraph)
+            chunk_tokens += paragraph_tokens
+            paragraph_hash = int(hashlib.md5(paragraph.encode("utf-8")).hexdigest(), 16)
+            if chunk_tokens >= chunk_size // 2 and paragraph_hash % 4 == 0:
+                flush()
+        flush()
+    return split_docs
+
+
+def pick_chunk_size(n_tokens: int, token_budget: int, max_workers: int) -> int:
+    """Spreads the document over at least `max_workers` chunks, within the budget.
+
+    Sizes are rounded to powers of two times 1000 tokens, so a page whose
+    length changed a little keeps the same chunk size.
+    """
+    chunks_of_1000 = max(1, math.ceil(n_tokens / (max_workers * 1000)))
+    return min(token_budget, 1000 * 2 ** math.ceil(math.log2(chunks_of_1000)))
+
+
+def get_model_name(llm: ChatPremAI) -> str:
+    return str(getattr(llm, "model", None) or "default")
+
+
+def map_documents(
+    split_docs: List[Document],
+    llm: ChatPremAI,
+    max_workers: int,
+    cache: Optional[SummaryCache] = None,
+) -> List[str]:
+    keys = [
+        content_hash(map_template, get_model_name(llm), doc.page_content)
+        for doc in split_docs
+    ]
+    outputs = [cache.get_map(key) if cache else None for key in keys]
+    missing = [idx for idx, output in enumerate(outputs) if output is None]
+    if cache:
+        for output in outputs:
+            tracing.cache("map", hit=output is not None)
+    if not missing:
+        return outputs
+
+    map_chain = PromptTemplate.from_template(map_template) | llm | StrOutputParser()
+    with tracing.stage("map", chunks=len(missing)):
+        computed = map_chain.batch(
+            [{"docs": split_docs[idx].page_content} for idx in missing],
+            config={"max_concurrency": max_workers},
+        )
+    tracing.count("prompt_tokens", sum(count_tokens(split_docs[idx].page_content) for idx in missing))
+    tracing.count("completion_tokens", sum(count_tokens(output) for output in computed))
+    for idx, output in zip(missing, computed):
+        outputs[idx] = output
+        if cache:
+            cache.put_map(keys[idx], output)
+    return outputs
+
+
+def reduce_summaries(
+    summaries: List[str], llm: ChatPremAI, max_workers: int, token_budget: int
+) -> str:
+    """Tree reduce: collapses groups of summaries in parallel until they fit the budget."""
+    reduce_chain = PromptTemplate.from_template(reduce_template) | llm | StrOutputParser()
+
+    while len(summaries) > 1 and count_tokens("\n\n".join(summaries)) > token_budget:
+        groups, group, group_tokens = [], [], 0
+        for summary in summaries:
+            summary_tokens = count_tokens(summary)
+            if group and group_tokens + summary_tokens > token_budget:
+                groups.append(group)
+                group, group_tokens = [], 0
+            group.append(summary)
+            group_tokens += summary_tokens
+        groups.append(group)
+
+        if len(groups) == len(summaries):
+            # Every summary is already over budget on its own, collapse them pairwise
+            groups = [summaries[i : i + 2] for i in range(0, len(summaries), 2)]
+        with tracing.stage("reduce", groups=len(groups)):
+            summaries = reduce_chain.batch(
+                [{"docs": "\n\n".join(group)} for group in groups],
+                config={"max_concurrency": max_workers},
+            )
+
+    with tracing.stage("reduce", groups=1):
+        return reduce_chain.invoke({"docs": "\n\n".join(summaries)})
+
 
-    # Step 6: Define the final map-reduce-chain which combines all of the above and run in one single pipeline
-    map_reduce_chain = MapReduceDocumentsChain(
-        llm_chain=map_chain,
-        reduce_documents_chain=reduce_documents_chain,
-        document_variable_name="docs",
-        return_intermediate_steps=True,
+def summarize_documents(
+    docs: List[Document],
+    llm: ChatPremAI,
+    max_workers: int = 4,
+    context_window: int = 8192,
+    cache: Optional[SummaryCache] = None,
+) -> dict:
+    token_budget = context_window - RESERVED_TOKENS
+    n_tokens = sum(count_tokens(doc.page_content) for doc in docs)
+
+    # Short pages fit in a single "stuff" call, no map-reduce needed
+    if n_tokens <= token_budget:
+        output_text = reduce_summaries(
+            [doc.page_content for doc in docs], llm, max_workers, token_budget
+        )
+        return {"input_documents": docs, "intermediate_steps": [], "output_text": output_text}
+
+    chunk_size = pick_chunk_size(n_tokens, token_budget, max_workers)
+    split_docs = split_documents(docs, chunk_size=chunk_size)
+    intermediate_steps = map_documents(split_docs, llm, max_workers, cache=cache)
+    output_text = reduce_summaries(intermediate_steps, llm, max_workers, token_budget)
+    return {
+        "input_documents": split_docs,
+        "intermediate_steps": intermediate_steps,
+        "output_text": output_text,
+    }
+
+
+def page_metadata(soup: BeautifulSoup, url: str) -> dict:
+    """Source, title, description and language of the page, as WebBaseLoader sets them."""
+    metadata = {"source": url}
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "No description found.")
+    if html := soup.find("html"):
+        metadata["language"] = html.get("lang", "No language found.")
+    return metadata
+
+
+def fetch_page(url: str, fetch_timeout: float, cached_page: Optional[dict] = None):
+    """Loads the page like WebBaseLoader, revalidating `cached_page` if given.
+
+    Returns `(docs, etag, last_modified)`, or None when the server answered
+    304 Not Modified.
+    """
+    headers = dict(default_header_template)
+    if cached_page is not None:
+        if cached_page["etag"]:
+            headers["If-None-Match"] = cached_page["etag"]
+        if cached_page["last_modified"]:
+            headers["If-Modified-Since"] = cached_page["last_modified"]
+
+    with tracing.stage("fetch"):
+        response = requests.get(url, headers=headers, timeout=fetch_timeout)
+        if response.status_code == 304 and cached_page is not None:
+            return None
+        response.raise_for_status()
+        response.encoding = response.apparent_encoding
+
+    with tracing.stage("parse"):
+        soup = BeautifulSoup(response.text, "html.parser")
+    docs = [Document(page_content=soup.get_text(), metadata=page_metadata(soup, url))]
+    return docs, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+
+def summarize_url(
+    url: str,
+    llm: ChatPremAI,
+    fetch_timeout: float = 30,
+    max_workers: int = 4,
+    context_window: int = 8192,
+    cache: Optional[SummaryCache] = None,
+) -> dict:
+    # Step 1: Load the page, from the cache when it is fresh or not modified
+    cached_page = cache.get_page(url) if cache else None
+    if cached_page is not None and cached_page["fresh"]:
+        tracing.cache("page", hit=True)
+        docs, page_hash = cached_page["documents"], cached_page["hash"]
+    else:
+        fetched = fetch_page(url, fetch_timeout, cached_page)
+        if cache:
+            tracing.cache("page", hit=fetched is None)
+        if fetched is None:
+            cache.touch_page(url)
+            docs, page_hash = cached_page["documents"], cached_page["hash"]
+        else:
+            docs, etag, last_modified = fetched
+            page_hash = content_hash(*(doc.page_content for doc in docs))
+            if cache:
+                cache.put_page(url, docs, page_hash, etag=etag, last_modified=last_modified)
+
+    # Step 2: Same content, same settings: the summary is already known
+    summary_key = content_hash(
+        page_hash, get_model_name(llm), str(context_window), map_template, reduce_template
     )
+    if cache and (result := cache.get_summary(summary_key)) is not None:
+        tracing.cache("summary", hit=True)
+        return result
+    if cache:
+        tracing.cache("summary", hit=False)
 
-    # Step 7: Run the chain and get the results back
-    result = map_reduce_chain.invoke(split_docs)
+    # Step 3: Summarize it. The chunk size follows the page length and the
+    # context window, the map calls run concurrently and the reduce is a tree
+    result = summarize_documents(
+        docs,
+        llm=llm,
+        max_workers=max_workers,
+        context_window=context_window,
+        cache=cache,
+    )
+    if cache:
+        cache.put_summary(summary_key, result)
     return result
+
+
+def summarize_urls(
+    urls: list[str],
+    llm: ChatPremAI,
+    max_concurrency: int = 4,
+    url_timeout: float = 180,
+    fetch_timeout: float = 30,
+    max_workers: int = 4,
+    context_window: int = 8192,
+    cache: Optional[SummaryCache] = None,
+    tracer: Optional[Tracer] = None,
+) -> Iterator[Tuple[str, Optional[dict], Optional[Exception]]]:
+    """Summarizes the urls concurrently and yields `(url, result, error)` as each one finishes.
+
+    At most `max_concurrency` urls are fetched and summarized at the same time.
+    A url still running `url_timeout` seconds after it started is reported as
+    failed; its worker is left to finish in the background. A failing url
+    never stops the others. Each result has the `"trace"` of its url.
+    """
+    started = {}
+
+    def run(idx: int, url: str) -> dict:
+        started[idx] = time.monotonic()
+        trace = tracer.start_trace("summarize_url") if tracer else tracing.Trace("summarize_url")
+        try:
+            with trace.activate():
+                result = summarize_url(
+                    url,
+                    llm=llm,
+                    fetch_timeout=fetch_timeout,
+                    max_workers=max_workers,
+                    context_window=context_window,
+                    cache=cache,
+                )
+        except Exception as e:
+            trace.error("summarize", e)
+            raise
+        finally:
+            trace.finish()
+        # The cached result is shared, the trace only goes in this copy
+        return {**result, "trace": trace}
+
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    pending = {executor.submit(run, idx, url): (idx, url) for idx, url in enumerate(urls)}
+    try:
+        while pending:
+            done, _ = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                _, url = pending.pop(future)
+                try:
+                    yield url, future.result(), None
+                except Exception as e:
+                    yield url, None, e
+
+            now = time.monotonic()
+            for future, (idx, url) in list(pending.items()):
+                if idx in started and now - started[idx] > url_timeout:
+                    del pending[future]
+                    yield url, None, TimeoutError(f"Timed out after {url_timeout}s")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ---- Q&A over the summarized urls ---- #
+
+
+def get_index_chunks(docs: List[Document], chunk_size: int = 1000) -> List[Document]:
+    """Reuses the chunks of the summary for the index, only splitting the long ones.
+
+    Short pages are summarized in a single call and come back whole.
+    """
+    index_chunks = []
+    for doc in docs:
+        if count_tokens(doc.page_content) > chunk_size:
+            index_chunks.extend(split_documents([doc], chunk_size=chunk_size))
+        else:
+            index_chunks.append(doc)
+    return index_chunks
+
+
+def answer_question(
+    question: str,
+    llm: ChatPremAI,
+    url_index: UrlIndex,
+    embeddings: PremAIEmbeddings,
+    k: int = 4,
+) -> Tuple[List[dict], Iterator[str]]:
+    """Retrieves the `k` closest chunks of all the indexed urls and streams the answer."""
+    with tracing.stage("embed"):
+        query_vector = embeddings.embed_query(question)
+    with tracing.stage("vector_search"):
+        hits = url_index.search(query_vector, k=k)
+    context = "\n\n".join(f"[{hit['url']}]\n{hit['text']}" for hit in hits)
+    tracing.count("prompt_tokens", count_tokens(qna_template) + count_tokens(context) + count_tokens(question))
+    qna_chain = PromptTemplate.from_template(qna_template) | llm | StrOutputParser()
+    return hits, tracing.traced_stream(qna_chain.stream({"context": context, "question": question}))